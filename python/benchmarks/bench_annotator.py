@@ -0,0 +1,131 @@
+"""Compares the throughput of the Google Language and local annotators.
+
+The local model is fitted on `dataset/euvsdisinfo.tar.bz2` in a temporary
+folder (see local_annotator.py), then the english texts of the dump are
+annotated:
+
+    api: one request per text to the stand-in of the Google Language api
+        (see fake_services.py), by as many threads as the annotate stage
+    local: one text per call of the local provider, by the same threads
+    batch: batches of texts in a pool of processes, as `reannotate` does
+
+The stand-in answers after `--latency` seconds, the default is the order
+of magnitude of the real api. Run from the `python` folder:
+
+    python benchmarks/bench_annotator.py
+    python benchmarks/bench_annotator.py --docs 20000 --processes 8
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle, islice
+from os import cpu_count
+from os.path import abspath, dirname, join
+from sys import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+_BENCHMARKS = dirname(abspath(__file__))
+_SCRIPTS = join(_BENCHMARKS, '..', 'scripts')
+_DATASET = join(_BENCHMARKS, '..', '..', 'dataset', 'euvsdisinfo.tar.bz2')
+
+path.insert(0, _BENCHMARKS)
+path.insert(0, _SCRIPTS)
+
+
+def _timed(function, texts):
+    start = perf_counter()
+    function(texts)
+    return len(texts) / (perf_counter() - start)
+
+
+def _api(url, threads):
+    from http_pool import post
+
+    def annotate(text):
+        response = post(url, json={'text': text})
+        assert response.status_code == 200, response.text
+        return response.json()
+
+    def run(texts):
+        with ThreadPoolExecutor(threads) as executor:
+            return list(executor.map(annotate, texts))
+
+    return run
+
+
+def _local(model_path, threads):
+    import local_annotator
+
+    local_annotator._get_annotator(model_path)
+
+    def run(texts):
+        with ThreadPoolExecutor(threads) as executor:
+            return list(executor.map(local_annotator.annotate, texts))
+
+    return run
+
+
+def _batch(model_path, processes, batch_size):
+    import local_annotator
+
+    def run(texts):
+        batches = [texts[start:start + batch_size]
+                   for start in range(0, len(texts), batch_size)]
+        return list(local_annotator.annotate_stream(
+            batches, processes=processes, path=model_path))
+
+    return run
+
+
+def main():
+    parser = ArgumentParser(description='Compares the annotators.')
+    parser.add_argument('--dataset', default=_DATASET)
+    parser.add_argument('--docs', type=int, default=2000,
+                        help='Texts annotated, the dump texts are repeated.')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='Seconds of each request to the api.')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Threads of the annotate stage.')
+    parser.add_argument('--processes', type=int, default=cpu_count())
+    parser.add_argument('--batch-size', type=int, default=200)
+    options = parser.parse_args()
+
+    from dataset_dump import iter_news
+    from fake_services import LanguageService
+    import local_annotator
+
+    news_list = list(iter_news(options.dataset))
+    annotations = {news['text_en']: {
+        'sentiment_score': news['sentiment_score'],
+        'sentiment_magnitude': news['sentiment_magnitude'],
+        'entities': [[entity['name'], entity['type'], entity['salience'],
+                      entity['wikipedia_url']]
+                     for entity in news.get('entities') or []]}
+        for news in news_list if news.get('text_analysed')}
+    texts = list(islice(cycle(sorted(annotations)), options.docs))
+    service = LanguageService(annotations, latency=options.latency)
+    url = service.start()
+
+    with TemporaryDirectory() as folder:
+        model_path = join(folder, 'local_annotator.json')
+        start = perf_counter()
+        model = local_annotator.build(news_list, model_path)
+        print('model      %d entities, %d words, built in %.1f s, '
+              'numpy %s' % (model['entities'], model['words'],
+                            perf_counter() - start,
+                            local_annotator.numpy is not None))
+        results = [
+            ('api', _timed(_api(url, options.threads), texts)),
+            ('local', _timed(_local(model_path, options.threads), texts)),
+            ('batch', _timed(_batch(model_path, options.processes,
+                                    options.batch_size), texts))]
+    service.stop()
+    for name, docs_per_second in results:
+        print('%-10s %6d docs %9.1f docs/s %7.1fx api' % (
+            name, len(texts), docs_per_second,
+            docs_per_second / results[0][1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""Compares the queries of the single and partitioned index layouts.
+
+The news of `dataset/euvsdisinfo.tar.bz2` are loaded in the single `unfact`
+index, the queries of the scripts and of the Kibana dashboard are timed,
+then the index is migrated to the partitioned layout (see index_layout.py)
+and the same queries are timed again on the `unfact` alias:
+
+    exists: the existence check of 01_scrape_links on 100 urls
+    backlog: a page of the news waiting for the text analysis
+    dashboard: the terms aggregations of kibana_dashboard.json
+    discover: the latest 50 news, as listed by Kibana
+
+For each query the p50/p99 milliseconds and the response size are
+reported, and the store size of the indices when the cluster reports it.
+By default the queries run on the in-memory stand-in of fake_elastic.py,
+which shows the size of the responses rather than the cost on disk. Run
+from the `python` folder:
+
+    python benchmarks/bench_index_layout.py --limit 5000
+    python benchmarks/bench_index_layout.py --elastic http://127.0.0.1:9201
+
+The `--elastic` cluster must not hold an `unfact` index.
+"""
+
+from argparse import ArgumentParser
+from os.path import abspath, dirname, join
+from sys import exit, path
+from time import perf_counter
+
+_BENCHMARKS = dirname(abspath(__file__))
+_SCRIPTS = join(_BENCHMARKS, '..', 'scripts')
+_DATASET = join(_BENCHMARKS, '..', '..', 'dataset', 'euvsdisinfo.tar.bz2')
+_LOAD_BATCH = 500
+_DASHBOARD_FIELDS = ['authors.keyword', 'language', 'domain.keyword',
+                     'entities.name.keyword']
+
+path.insert(0, _BENCHMARKS)
+path.insert(0, _SCRIPTS)
+
+
+def _queries(news):
+    from dao import ANALYSIS_EXCLUDES
+
+    short_urls = [item['short_url'] for item in news[:100]]
+    full_urls = [item['full_url'] for item in news[:100]]
+    return {
+        'exists': {
+            'size': 0,
+            'query': {'constant_score': {'filter': {'bool': {'should': [
+                {'terms': {'short_url': short_urls}},
+                {'terms': {'full_url': full_urls}}]}}}},
+            'aggs': {field: {'terms': {'field': field, 'include': values,
+                                       'size': len(values)}}
+                     for field, values in [('short_url', short_urls),
+                                           ('full_url', full_urls)]}},
+        'backlog': {
+            'size': 300, '_source': {'excludes': ANALYSIS_EXCLUDES},
+            'query': {'constant_score': {'filter': {'bool': {'must_not': [
+                {'term': {'skip': 'true'}},
+                {'term': {'text_analysed': 'true'}},
+                {'exists': {'field': 'error_class'}}]}}}}},
+        'dashboard': {
+            'size': 0,
+            'aggs': {field: {'terms': {'field': field, 'size': 20}}
+                     for field in _DASHBOARD_FIELDS}},
+        'discover': {
+            'size': 50, 'sort': [{'newsletter_date': 'desc'}],
+            'query': {'match_all': {}}},
+    }
+
+
+def _percentile(values, percentile):
+    index = max(0, int(round(percentile / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def _measure(base_host, queries, repeat):
+    from http_pool import post
+
+    results = {}
+    for name, body in queries.items():
+        seconds = []
+        size = 0
+        for _ in range(repeat):
+            start = perf_counter()
+            response = post('%s/unfact/_search' % base_host, json=body)
+            seconds.append(perf_counter() - start)
+            assert response.status_code == 200, response.text
+            size = len(response.content)
+        seconds.sort()
+        results[name] = {'p50': _percentile(seconds, 50) * 1000,
+                         'p99': _percentile(seconds, 99) * 1000,
+                         'kb': size / 1024.0}
+    return results
+
+
+def _store_mb(base_host, patterns):
+    """The store size of the indices, None when not reported."""
+
+    from http_pool import get
+
+    response = get('%s/_cat/indices/%s?format=json&bytes=b' % (
+        base_host, ','.join(patterns)))
+    if response.status_code != 200:
+        return None
+    return sum(int(index['store.size']) for index in response.json()) \
+        / 1024.0 / 1024.0
+
+
+def _load(dao, news):
+    from http_pool import post
+
+    dao.init_schema()
+    for start in range(0, len(news), _LOAD_BATCH):
+        dao.import_many([dict(item)
+                         for item in news[start:start + _LOAD_BATCH]])
+    post('%s/unfact/_refresh' % dao.base_host)
+
+
+def main():
+    parser = ArgumentParser(description='Compares the index layouts.')
+    parser.add_argument('--dataset', default=_DATASET)
+    parser.add_argument('--limit', type=int, default=0,
+                        help='News of the dataset used, 0 for all.')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--elastic',
+                        help='An empty cluster, the in-memory stand-in by '
+                             'default.')
+    options = parser.parse_args()
+
+    from dao_elastic import DaoElastic
+    from dataset_dump import iter_news
+    from fake_elastic import FakeElastic
+    from http_pool import head, post
+    import index_layout
+
+    base_host = options.elastic
+    if base_host is None:
+        base_host = FakeElastic().start()
+    elif head('%s/unfact' % base_host).status_code != 404:
+        print('The cluster [%s] already holds an [unfact] index.' % base_host)
+        exit(1)
+    news = []
+    for item in iter_news(options.dataset):
+        news.append(item)
+        if options.limit and len(news) >= options.limit:
+            break
+    queries = _queries(news)
+
+    _load(DaoElastic(base_host, layout='single'), news)
+    results = {'single': _measure(base_host, queries, options.repeat)}
+    stores = {'single': _store_mb(base_host, ['unfact'])}
+    index_layout.migrate(base_host)
+    index_layout.switch(base_host)
+    post('%s/unfact-*,text-unfact-*/_refresh' % base_host)
+    results['partitioned'] = _measure(base_host, queries, options.repeat)
+    stores['partitioned'] = _store_mb(base_host,
+                                      ['unfact-*', 'text-unfact-*'])
+
+    print('%d news, %d runs per query' % (len(news), options.repeat))
+    for name in queries:
+        for layout in ['single', 'partitioned']:
+            result = results[layout][name]
+            print('%-10s %-12s p50 %8.2f ms  p99 %8.2f ms  %9.1f KB' % (
+                name, layout, result['p50'], result['p99'], result['kb']))
+    for layout, store in stores.items():
+        if store is not None:
+            print('store      %-12s %8.1f MB' % (layout, store))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Compares the PDF link extraction with the former textract path.
+
+Each method runs in its own process, which reports the wall time, the
+links found and its peak memory, including the converters started by
+textract. Run from the `python` folder:
+
+    python benchmarks/bench_pdf_links.py
+"""
+
+from glob import glob
+from json import dumps, loads
+from os.path import abspath, dirname, join
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from subprocess import run
+from sys import argv, executable, path
+from time import perf_counter
+
+path.insert(0, join(dirname(abspath(__file__)), '..', 'scripts'))
+
+_RESOURCES = join(dirname(abspath(__file__)), '..', '..', 'resources')
+_LINK_PREFIX = 'http://bit.ly/'
+_METHODS = ['textract', 'pdf_links', 'pdf_links_pool']
+
+
+def _textract_links(file_names):
+    from textract import process
+
+    result = {}
+    for file_name in file_names:
+        text = process(file_name).decode('utf-8')
+        result[file_name] = [word for word in text.split()
+                             if word.startswith(_LINK_PREFIX)]
+    return result
+
+
+def _pdf_links(file_names):
+    from pdf_links import extract_links
+
+    return {file_name: extract_links(file_name, _LINK_PREFIX)
+            for file_name in file_names}
+
+
+def _pdf_links_pool(file_names):
+    from pdf_links import extract_links_from_files
+
+    return extract_links_from_files(file_names, _LINK_PREFIX)
+
+
+def _run_method(method):
+    file_names = sorted(glob(join(_RESOURCES, '*.pdf')))
+    function = {'textract': _textract_links,
+                'pdf_links': _pdf_links,
+                'pdf_links_pool': _pdf_links_pool}[method]
+    start = perf_counter()
+    links = function(file_names)
+    seconds = perf_counter() - start
+    print(dumps({'method': method,
+                 'files': len(file_names),
+                 'links': sum(len(set(value)) for value in links.values()),
+                 'seconds': seconds,
+                 'max_rss_kb': max(getrusage(RUSAGE_SELF).ru_maxrss,
+                                   getrusage(RUSAGE_CHILDREN).ru_maxrss)}))
+
+
+def main():
+    for method in _METHODS:
+        completed = run([executable, __file__, method],
+                        capture_output=True, text=True)
+        if completed.returncode != 0:
+            print('%-15s failed: %s' % (
+                method, completed.stderr.strip().splitlines()[-1]))
+            continue
+        result = loads(completed.stdout.strip().splitlines()[-1])
+        print('%-15s %3d files %5d links %8.2f s %10d KB max RSS' % (
+            method, result['files'], result['links'], result['seconds'],
+            result['max_rss_kb']))
+
+
+if __name__ == '__main__':
+    if len(argv) > 1:
+        _run_method(argv[1])
+    else:
+        main()
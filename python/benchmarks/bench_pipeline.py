@@ -0,0 +1,430 @@
+"""Replays the pipeline offline and measures its throughput.
+
+The news of `dataset/euvsdisinfo.tar.bz2` and the PDFs of `resources/` are
+served by local stand-ins of bit.ly, eeas.europa.eu, Diffbot, Microsoft
+Translator, the Google Natural Language api and Elasticsearch (see
+fake_services.py and fake_elastic.py). Each scenario runs in its own
+process in a temporary folder, so the caches and journals start empty:
+
+    scrape_from_path: 01_scrape_links.scrape_from_path
+    scrape_from_urls: 01_scrape_links.scrape_from_urls
+    extract: 02_extract_article_content.run
+
+For each scenario the documents written per second, the p50/p99 seconds of
+each stage and the peak memory are reported. Run from the `python` folder:
+
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --latency 0.05 --error-rate 0.01
+    python benchmarks/bench_pipeline.py --save-baseline
+    python benchmarks/bench_pipeline.py --compare
+
+The baseline is only meaningful on the machine where it was saved.
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from glob import glob
+from importlib.util import module_from_spec, spec_from_file_location
+from json import dump, dumps, load, loads
+from os import environ, makedirs
+from os.path import abspath, basename, dirname, exists, join
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from shutil import copy
+from subprocess import run
+from sys import argv, executable, exit, modules, path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+_BENCHMARKS = dirname(abspath(__file__))
+_SCRIPTS = join(_BENCHMARKS, '..', 'scripts')
+_RESOURCES = join(_BENCHMARKS, '..', '..', 'resources')
+_DATASET = join(_BENCHMARKS, '..', '..', 'dataset', 'euvsdisinfo.tar.bz2')
+_BASELINE = join(_BENCHMARKS, 'baseline.json')
+_SCENARIOS = ['scrape_from_path', 'scrape_from_urls', 'extract']
+_NEWSLETTER_FOLDER = '/sites/eeas/files/'
+# Requests per second given to every provider, high enough to measure the
+# pipeline rather than the plans.
+_REQUESTS_PER_SECOND = 1000
+# A p99 below this many seconds is not compared with the baseline.
+_MIN_COMPARED_SECONDS = 0.005
+
+path.insert(0, _BENCHMARKS)
+path.insert(0, _SCRIPTS)
+
+
+def _load_script(file_name, name):
+    """Imports a numbered script as a module called `name`."""
+
+    spec = spec_from_file_location(name, join(_SCRIPTS, file_name))
+    module = module_from_spec(spec)
+    # Registered before running, so the pool workers can unpickle its
+    # functions.
+    modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class _StageTimer(object):
+    """Appends the seconds of each call to a file, one line per call.
+
+    The file is opened in append mode for each line, so the pool workers
+    and the pipeline threads can share it.
+    """
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+
+    def _record(self, stage, seconds):
+        with open(self._file_name, 'a') as file:
+            file.write('%s %.6f\n' % (stage, seconds))
+
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._record(stage, perf_counter() - start)
+
+        return timed
+
+    def wrap_coroutine(self, stage, function):
+        async def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                self._record(stage, perf_counter() - start)
+
+        return timed
+
+
+def _patch_common(config):
+    import http_pool
+
+    http_pool.configure(pool_sizes={config['elastic']: 20})
+    environ['DAO_BACKEND'] = 'elastic'
+    environ['ELASTIC_URL'] = config['elastic']
+
+
+def _patch_scrape(config, timer):
+    import link_resolver
+
+    module = _load_script('01_scrape_links.py', 'scrape_links')
+    module._NEWSLETTER_PATH = config['newsletters'] + _NEWSLETTER_FOLDER
+    resolver_class = link_resolver.LinkResolver
+    resolver_class.__init__.__kwdefaults__['requests_per_second'] = \
+        _REQUESTS_PER_SECOND
+    request = resolver_class._request
+
+    async def redirected_request(self, method, short_url):
+        return await request(self, method, config['redirector'] +
+                             short_url[len('http://bit.ly'):])
+
+    resolver_class._request = redirected_request
+    module._download = timer.wrap('download', module._download)
+    module.extract_links = timer.wrap('extract_links', module.extract_links)
+    resolver_class.resolve = timer.wrap_coroutine('resolve',
+                                                  resolver_class.resolve)
+    module._merge_values = timer.wrap('merge', module._merge_values)
+    return module
+
+
+def _patch_extract(config, timer):
+    import http_pool
+    import providers
+
+    module = _load_script('02_extract_article_content.py',
+                          'extract_article_content')
+    module._DIFFBOT_API_URL = config['extractor'] + '/v3/article'
+    module._MICROSOFT_API_URL = config['translator'] + '/TranslateArray'
+    module._PROVIDER_LIMITS = {
+        provider: {'requests_per_second': _REQUESTS_PER_SECOND}
+        for provider in module._PROVIDER_LIMITS}
+
+    def annotation(text_en):
+        module._get_rate_limiter().acquire('google_language', len(text_en))
+        response = http_pool.post(config['language'], json={'text': text_en})
+        assert response.status_code == 200, \
+            'Invalid response status [%d].' % response.status_code
+        return response.json()
+
+    providers.register('annotator', 'bench_language', annotation)
+    environ['ANNOTATOR'] = 'bench_language'
+    module._STAGES = [(name, timer.wrap(name, function))
+                      for name, function in module._STAGES]
+    return module
+
+
+def _run_scenario(config):
+    """Runs in the scenario process, in the temporary `python` folder."""
+
+    _patch_common(config)
+    timer = _StageTimer(config['timings'])
+    scenario = config['scenario']
+    if scenario == 'extract':
+        module = _patch_extract(config, timer)
+        start = perf_counter()
+        module.run()
+    else:
+        module = _patch_scrape(config, timer)
+        start = perf_counter()
+        if scenario == 'scrape_from_path':
+            module.scrape_from_path(config['days'])
+        else:
+            module.scrape_from_urls(
+                [{'url': url, 'date': datetime.strptime(date, '%Y-%m-%d')}
+                 for url, date in config['urls']])
+    seconds = perf_counter() - start
+    with open(config['result'], 'w') as file:
+        dump({'seconds': seconds,
+              'max_rss_kb': max(getrusage(RUSAGE_SELF).ru_maxrss,
+                                getrusage(RUSAGE_CHILDREN).ru_maxrss)}, file)
+
+
+def _load_dataset(dump_path, limit):
+    from dataset_dump import iter_news
+
+    news = []
+    for item in iter_news(dump_path):
+        news.append(item)
+        if limit and len(news) >= limit:
+            break
+    return news
+
+
+def _newsletter_files():
+    """Returns (file name, newsletter date, path) of the PDFs."""
+
+    files = []
+    for file_path in sorted(glob(join(_RESOURCES, '*.pdf'))):
+        name = basename(file_path)
+        date = datetime.strptime(name.split('_')[2], '%d.%m.%Y')
+        files.append((name, date, file_path))
+    return sorted(files, key=lambda file: file[1])
+
+
+def _percentile(values, percentile):
+    index = max(0, int(round(percentile / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def _stage_stats(file_name):
+    seconds = {}
+    if exists(file_name):
+        with open(file_name) as file:
+            for line in file:
+                stage, value = line.split()
+                seconds.setdefault(stage, []).append(float(value))
+    stats = {}
+    for stage, values in seconds.items():
+        values.sort()
+        stats[stage] = {'count': len(values),
+                        'p50': _percentile(values, 50),
+                        'p99': _percentile(values, 99),
+                        'mean': sum(values) / len(values)}
+    return stats
+
+
+def _news_document(news):
+    """The news as saved by the scraper, before the text analysis."""
+
+    document = {field: news.get(field) for field in
+                ['id', 'short_url', 'full_url', 'domain', 'skip',
+                 'newsletter_date']}
+    document['text_analysed'] = False
+    return document
+
+
+def _benchmark(scenario, dataset, options):
+    from fake_elastic import FakeElastic
+    from fake_services import ExtractorService, LanguageService, \
+        NewsletterServer, Redirector, TranslatorService
+    from dao_elastic import DaoElastic
+
+    service_options = {'latency': options.latency,
+                       'error_rate': options.error_rate,
+                       'seed': options.seed}
+    full_urls = {news['short_url']: news['full_url'] for news in dataset}
+    domains = sorted({news['domain'] for news in dataset
+                      if news.get('domain')}) or ['example.com']
+    articles = {news['full_url']: {'text': news['text_original'],
+                                   'authors': news.get('authors'),
+                                   'language': news['language']}
+                for news in dataset if news.get('text_original')}
+    annotations = {news['text_original']: {
+        'sentiment_score': news['sentiment_score'],
+        'sentiment_magnitude': news['sentiment_magnitude'],
+        'entities': [[entity['name'], entity['type'], entity['salience'],
+                      entity['wikipedia_url']]
+                     for entity in news.get('entities') or []]}
+        for news in dataset if news.get('text_analysed')}
+    # scrape_from_path requests the newsletters of the last days, each PDF
+    # is served for one of them, today excluded.
+    files = _newsletter_files()
+    today = datetime.utcnow()
+    served_files = {name: file_path for name, _, file_path in files}
+    served_files.update({
+        'disinformation_review_%s_eng.pdf' % (
+            today - timedelta(days=days)).strftime('%d.%m.%Y'): file_path
+        for days, (_, _, file_path) in enumerate(files, 1)})
+
+    elastic = FakeElastic(latency=options.elastic_latency)
+    services = {'redirector': Redirector(full_urls, domains,
+                                         **service_options),
+                'newsletters': NewsletterServer(served_files,
+                                                **service_options),
+                'extractor': ExtractorService(articles, **service_options),
+                'translator': TranslatorService(**service_options),
+                'language': LanguageService(annotations, **service_options)}
+    index = DaoElastic._INDEX
+    with open(join(_RESOURCES, 'mapping.json')) as file:
+        mapping = load(file)
+    elastic.indices[index] = {'mappings': mapping.get('mappings', {}),
+                              'docs': {}}
+    if scenario == 'extract':
+        elastic.indices[index]['docs'] = {
+            news['id']: {'source': _news_document(news), 'version': 1}
+            for news in dataset}
+
+    with TemporaryDirectory() as work:
+        makedirs(join(work, 'python'))
+        makedirs(join(work, 'resources'))
+        for name in ['filter_domains.txt', 'mapping.json']:
+            copy(join(_RESOURCES, name), join(work, 'resources'))
+        config = {'scenario': scenario,
+                  'elastic': elastic.start(),
+                  'timings': join(work, 'timings.txt'),
+                  'result': join(work, 'result.json'),
+                  'days': len(files),
+                  'urls': [(_NEWSLETTER_FOLDER + name, date.strftime(
+                      '%Y-%m-%d')) for name, date, _ in files]}
+        for name, service in services.items():
+            config[name] = service.start()
+        config['urls'] = [(config['newsletters'] + url, date)
+                          for url, date in config['urls']]
+        try:
+            completed = run([executable, abspath(__file__), '--run-scenario',
+                             dumps(config)], cwd=join(work, 'python'),
+                            capture_output=True, text=True)
+            if completed.returncode != 0 or not exists(config['result']):
+                lines = completed.stderr.strip().splitlines()
+                return {'error': lines[-1] if lines else
+                        'Exit code [%d]' % completed.returncode}
+            with open(config['result']) as file:
+                result = load(file)
+            stages = _stage_stats(config['timings'])
+        finally:
+            elastic.stop()
+            for service in services.values():
+                service.stop()
+
+    documents = elastic.documents(index)
+    if scenario == 'extract':
+        docs = sum(1 for document in documents
+                   if document.get('text_analysed'))
+    else:
+        docs = len(documents)
+    return {'docs': docs,
+            'seconds': result['seconds'],
+            'docs_per_second': docs / result['seconds'],
+            'peak_rss_mb': result['max_rss_kb'] / 1024.0,
+            'stages': stages,
+            'elastic_requests': elastic.requests,
+            'services': {name: service.stats()
+                         for name, service in services.items()}}
+
+
+def _print_result(scenario, result):
+    if 'error' in result:
+        print('%-17s failed: %s' % (scenario, result['error']))
+        return
+    print('%-17s %6d docs %8.2f s %9.1f docs/s %8.1f MB peak RSS' % (
+        scenario, result['docs'], result['seconds'],
+        result['docs_per_second'], result['peak_rss_mb']))
+    for stage, stats in sorted(result['stages'].items()):
+        print('    %-15s %6d calls  p50 %8.4f s  p99 %8.4f s' % (
+            stage, stats['count'], stats['p50'], stats['p99']))
+
+
+def _regressions(baseline, results, tolerance):
+    """Returns the descriptions of the measures worse than the baseline."""
+
+    found = []
+    for scenario, result in results.items():
+        previous = baseline['results'].get(scenario)
+        if previous is None or 'error' in previous:
+            continue
+        if 'error' in result:
+            found.append('%s: %s' % (scenario, result['error']))
+            continue
+        if result['docs_per_second'] < \
+                previous['docs_per_second'] * (1 - tolerance):
+            found.append('%s: [%.1f] docs/s, baseline [%.1f]' % (
+                scenario, result['docs_per_second'],
+                previous['docs_per_second']))
+        if result['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + tolerance):
+            found.append('%s: [%.1f] MB peak RSS, baseline [%.1f]' % (
+                scenario, result['peak_rss_mb'], previous['peak_rss_mb']))
+        for stage, stats in result['stages'].items():
+            previous_stats = previous['stages'].get(stage)
+            if previous_stats is None or \
+                    stats['p99'] < _MIN_COMPARED_SECONDS:
+                continue
+            if stats['p99'] > previous_stats['p99'] * (1 + tolerance):
+                found.append('%s: stage [%s] p99 [%.4f] s, baseline '
+                             '[%.4f] s' % (scenario, stage, stats['p99'],
+                                           previous_stats['p99']))
+    return found
+
+
+def main():
+    parser = ArgumentParser(description='Replays the pipeline offline.')
+    parser.add_argument('scenarios', nargs='*', default=_SCENARIOS,
+                        help='Any of [%s].' % ', '.join(_SCENARIOS))
+    parser.add_argument('--dataset', default=_DATASET)
+    parser.add_argument('--limit', type=int, default=0,
+                        help='News of the dataset used, 0 for all.')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to each external request.')
+    parser.add_argument('--elastic-latency', type=float, default=0.0,
+                        help='Seconds added to each Elasticsearch request.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of external requests failing with 503.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare', action='store_true',
+                        help='Exits with 1 when worse than the baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    options = parser.parse_args()
+    for scenario in options.scenarios:
+        if scenario not in _SCENARIOS:
+            parser.error('Unknown scenario [%s].' % scenario)
+
+    dataset = _load_dataset(options.dataset, options.limit)
+    results = {}
+    for scenario in options.scenarios:
+        results[scenario] = _benchmark(scenario, dataset, options)
+        _print_result(scenario, results[scenario])
+    if options.save_baseline:
+        with open(options.baseline, 'w') as file:
+            dump({'options': vars(options), 'results': results}, file,
+                 indent=2, sort_keys=True)
+        print('Baseline saved to [%s].' % options.baseline)
+    if options.compare:
+        with open(options.baseline) as file:
+            regressions = _regressions(load(file), results,
+                                       options.tolerance)
+        for regression in regressions:
+            print('Regression %s' % regression)
+        if regressions:
+            exit(1)
+        print('No regression against [%s].' % options.baseline)
+
+
+if __name__ == '__main__':
+    if len(argv) > 2 and argv[1] == '--run-scenario':
+        _run_scenario(loads(argv[2]))
+    else:
+        main()
@@ -0,0 +1,431 @@
+"""In-memory stand-in for the subset of the Elasticsearch 5 api used by the
+scripts: index creation, document get/put/create/update, `_bulk`, `_mget`,
+`_search` with scroll, sliced scrolls, `_source` filtering and terms
+aggregations, index templates and aliases.
+"""
+
+from copy import deepcopy
+from fnmatch import fnmatch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from json import dumps, loads
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, urlsplit
+from zlib import crc32
+
+
+def _values(document, field):
+    values = [document]
+    for name in field.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, list):
+                found.extend(item.get(name) for item in value
+                             if isinstance(item, dict))
+            elif isinstance(value, dict) and name in value:
+                found.append(value[name])
+        values = found
+    result = []
+    for value in values:
+        if isinstance(value, list):
+            result.extend(value)
+        elif value is not None:
+            result.append(value)
+    return result
+
+
+def _normalize(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+
+def _matches(document, query):
+    if not query or 'match_all' in query:
+        return True
+    name, body = next(iter(query.items()))
+    if name == 'constant_score':
+        return _matches(document, body['filter'])
+    if name == 'bool':
+        for key in ['must', 'filter']:
+            clauses = body.get(key, [])
+            clauses = clauses if isinstance(clauses, list) else [clauses]
+            if not all(_matches(document, clause) for clause in clauses):
+                return False
+        clauses = body.get('must_not', [])
+        clauses = clauses if isinstance(clauses, list) else [clauses]
+        if any(_matches(document, clause) for clause in clauses):
+            return False
+        clauses = body.get('should', [])
+        clauses = clauses if isinstance(clauses, list) else [clauses]
+        if clauses and not any(_matches(document, clause)
+                               for clause in clauses):
+            return False
+        return True
+    if name == 'ids':
+        return document.get('_id') in body['values']
+    field, condition = next(iter(body.items()))
+    values = [_normalize(value) for value in _values(document, field)]
+    if name == 'term':
+        if isinstance(condition, dict):
+            condition = condition['value']
+        return _normalize(condition) in values
+    if name == 'terms':
+        return any(_normalize(term) in values for term in condition)
+    if name == 'exists':
+        return len(_values(document, condition)) > 0
+    if name == 'range':
+        checks = {'gt': lambda a, b: a > b, 'gte': lambda a, b: a >= b,
+                  'lt': lambda a, b: a < b, 'lte': lambda a, b: a <= b}
+        return any(all(checks[op](value, bound)
+                       for op, bound in condition.items() if op in checks)
+                   for value in values)
+    raise ValueError('Unsupported query [%s]' % name)
+
+
+def _filter_source(source, spec):
+    if spec is None or spec is True:
+        return source
+    if spec is False:
+        return {}
+    if isinstance(spec, (list, str)):
+        spec = {'includes': spec if isinstance(spec, list) else [spec]}
+    includes = spec.get('includes', spec.get('include'))
+    excludes = spec.get('excludes', spec.get('exclude', []))
+    result = {key: value for key, value in source.items()
+              if key not in excludes}
+    if includes:
+        result = {key: value for key, value in result.items()
+                  if key in includes}
+    return result
+
+
+class FakeElastic(object):
+    """Keeps the indices in memory and serves them over HTTP."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.indices = {}
+        self.templates = {}
+        self.aliases = {}
+        self.requests = 0
+        self._scrolls = {}
+        self._scroll_ids = count()
+        self._lock = Lock()
+        self._server = None
+
+    def start(self, port=0):
+        handler = type('Handler', (_Handler,), {'elastic': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:%d' % self._server.server_port
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def documents(self, index):
+        return [entry['source'] for entry in
+                self.indices.get(index, {}).get('docs', {}).values()]
+
+    def _index(self, name, create=True):
+        if name not in self.indices and create:
+            self.indices[name] = {'mappings': {}, 'docs': {}}
+            for template in sorted(self.templates.values(),
+                                   key=lambda item: item.get('order', 0)):
+                if fnmatch(name, template['template']):
+                    self.indices[name]['mappings'].update(
+                        template.get('mappings', {}))
+                    for alias in template.get('aliases', {}):
+                        self.aliases.setdefault(alias, set()).add(name)
+        return self.indices.get(name)
+
+    def _resolve(self, names):
+        """The indices of a list of indices, aliases and patterns."""
+
+        resolved = []
+        for name in names:
+            if name in self.indices:
+                matches = [name]
+            elif name in self.aliases:
+                matches = sorted(self.aliases[name])
+            elif '*' in name:
+                matches = sorted(
+                    {index for index in self.indices if fnmatch(index, name)}
+                    | {index for alias, indices in self.aliases.items()
+                       if fnmatch(alias, name) for index in indices})
+            else:
+                matches = []
+            resolved.extend(index for index in matches
+                            if index not in resolved)
+        return resolved
+
+    def _update_aliases(self, actions):
+        for action in actions:
+            (operation, spec), = action.items()
+            indices = self._resolve([spec['index']])
+            if operation == 'add':
+                self.aliases.setdefault(spec['alias'], set()).update(indices)
+            elif operation == 'remove':
+                self.aliases.get(spec['alias'], set()).difference_update(
+                    indices)
+
+    def _write(self, index, doc_id, source, op_type, version=None):
+        docs = self._index(index)['docs']
+        entry = docs.get(doc_id)
+        if op_type == 'create' and entry is not None:
+            return 409, {'_id': doc_id, 'status': 409, 'error': {
+                'type': 'version_conflict_engine_exception'}}
+        if version is not None and (entry is None
+                                    or entry['version'] != int(version)):
+            return 409, {'_id': doc_id, 'status': 409, 'error': {
+                'type': 'version_conflict_engine_exception'}}
+        if op_type == 'update':
+            if entry is None:
+                return 404, {'_id': doc_id, 'status': 404, 'error': {
+                    'type': 'document_missing_exception'}}
+            merged = dict(entry['source'])
+            merged.update(source)
+            source = merged
+        new_version = 1 if entry is None else entry['version'] + 1
+        docs[doc_id] = {'source': source, 'version': new_version}
+        status = 201 if entry is None else 200
+        return status, {'_index': index, '_id': doc_id, 'status': status,
+                        '_version': new_version,
+                        'result': 'created' if entry is None else 'updated'}
+
+    def _hit(self, index, doc_id, entry, source_spec, with_version):
+        hit = {'_index': index, '_type': 'news', '_id': doc_id,
+               '_score': 1.0,
+               '_source': deepcopy(_filter_source(entry['source'],
+                                                  source_spec))}
+        if with_version:
+            hit['_version'] = entry['version']
+        return hit
+
+    def _search(self, index_names, body, params):
+        query = body.get('query', {})
+        slice_spec = body.get('slice')
+        matches = []
+        for index in index_names:
+            for doc_id, entry in list(self.indices[index]['docs'].items()):
+                document = dict(entry['source'], _id=doc_id)
+                if slice_spec is not None and \
+                        crc32(doc_id.encode('utf8')) % slice_spec['max'] \
+                        != slice_spec['id']:
+                    continue
+                if _matches(document, query):
+                    matches.append((index, doc_id, entry))
+        for sort in reversed(body.get('sort', [])):
+            if isinstance(sort, dict):
+                field, order = next(iter(sort.items()))
+                order = order if isinstance(order, str) else order['order']
+                matches.sort(key=lambda match: (_values(
+                    match[2]['source'], field) or [''])[0],
+                    reverse=order == 'desc')
+        aggregations = {}
+        for name, spec in body.get('aggs', body.get('aggregations',
+                                                    {})).items():
+            terms = spec['terms']
+            counts = {}
+            for _, _, entry in matches:
+                for value in set(_values(entry['source'], terms['field'])):
+                    if 'include' in terms and value not in terms['include']:
+                        continue
+                    counts[value] = counts.get(value, 0) + 1
+            buckets = sorted(counts.items(), key=lambda item: -item[1])
+            aggregations[name] = {'buckets': [
+                {'key': key, 'doc_count': doc_count}
+                for key, doc_count in buckets[:terms.get('size', 10)]]}
+        start = int(body.get('from', params.get('from', 0)))
+        size = int(body.get('size', params.get('size', 10)))
+        source_spec = body.get('_source')
+        with_version = body.get('version', False)
+        hits = [self._hit(index, doc_id, entry, source_spec, with_version)
+                for index, doc_id, entry in matches]
+        result = {'took': 1, 'timed_out': False,
+                  'hits': {'total': len(hits), 'max_score': 1.0}}
+        if aggregations:
+            result['aggregations'] = aggregations
+        if 'scroll' in params:
+            scroll_id = str(next(self._scroll_ids))
+            self._scrolls[scroll_id] = {'hits': hits[size:], 'size': size}
+            result['_scroll_id'] = scroll_id
+            result['hits']['hits'] = hits[:size]
+        else:
+            result['hits']['hits'] = hits[start:start + size]
+        return result
+
+    def _scroll(self, scroll_id):
+        scroll = self._scrolls.get(scroll_id)
+        if scroll is None:
+            return 404, {'error': 'search_context_missing_exception'}
+        hits = scroll['hits'][:scroll['size']]
+        scroll['hits'] = scroll['hits'][scroll['size']:]
+        return 200, {'_scroll_id': scroll_id,
+                     'hits': {'total': len(hits), 'hits': hits}}
+
+    def _bulk(self, default_index, body):
+        lines = [line for line in body.split('\n') if line.strip()]
+        items = []
+        position = 0
+        while position < len(lines):
+            action = loads(lines[position])
+            op_type, meta = next(iter(action.items()))
+            index = meta.get('_index', default_index)
+            doc_id = meta['_id']
+            version = meta.get('_version', meta.get('version'))
+            if op_type == 'delete':
+                removed = self._index(index)['docs'].pop(doc_id, None)
+                status = 200 if removed else 404
+                items.append({op_type: {'_id': doc_id, 'status': status}})
+                position += 1
+                continue
+            source = loads(lines[position + 1])
+            if op_type == 'update':
+                source = source['doc']
+            status, result = self._write(index, doc_id, source, op_type,
+                                         version)
+            items.append({op_type: result})
+            position += 2
+        return {'took': 1, 'items': items,
+                'errors': any(next(iter(item.values()))['status'] >= 300
+                              for item in items)}
+
+    def handle(self, method, path, params, body):
+        parts = [part for part in path.split('/') if part]
+        if parts[:2] == ['_search', 'scroll']:
+            data = loads(body) if body else {}
+            if method == 'DELETE':
+                for scroll_id in data.get('scroll_id', []):
+                    self._scrolls.pop(scroll_id, None)
+                return 200, {'succeeded': True}
+            return self._scroll(data.get('scroll_id'))
+        if parts == ['_bulk']:
+            return 200, self._bulk(None, body)
+        if parts[:1] == ['_template'] and len(parts) == 2:
+            if method == 'PUT':
+                self.templates[parts[1]] = loads(body)
+            return 200, {'acknowledged': True}
+        if parts == ['_aliases']:
+            self._update_aliases(loads(body)['actions'])
+            return 200, {'acknowledged': True}
+        if parts[:1] == ['_alias'] and len(parts) == 2:
+            indices = self.aliases.get(parts[1])
+            if not indices:
+                return 404, {'error': 'aliases_not_found_exception'}
+            return 200, {index: {'aliases': {parts[1]: {}}}
+                         for index in indices}
+        if parts and parts[0] == '_cluster':
+            return 200, {'acknowledged': True}
+        if not parts:
+            return 200, {'version': {'number': '5.3.0'}}
+        names = parts[0].split(',')
+        if len(parts) == 1:
+            if method == 'PUT':
+                if names[0] in self.indices or names[0] in self.aliases:
+                    return 400, {'error': 'index_already_exists_exception'}
+                index = self._index(names[0])
+                if body:
+                    index['mappings'].update(loads(body).get('mappings', {}))
+                return 200, {'acknowledged': True}
+            if method == 'DELETE':
+                for name in names:
+                    self.indices.pop(name, None)
+                    for indices in self.aliases.values():
+                        indices.discard(name)
+                return 200, {'acknowledged': True}
+            if method == 'HEAD':
+                return (200 if self._resolve(names) else 404), None
+        if parts[-1] == '_refresh':
+            return 200, {'_shards': {}}
+        if parts[-1] == '_search':
+            existing = self._resolve(names)
+            if not existing and not any('*' in name for name in names):
+                return 404, {'error': 'index_not_found_exception'}
+            data = loads(body) if body else {}
+            if 'slice' in data and 'scroll' not in params:
+                return 400, {'error': {
+                    'type': 'action_request_validation_exception',
+                    'reason': 'Validation Failed: 1: [slice] can only be '
+                              'used with [scroll] requests;'}}
+            return 200, self._search(existing, data, params)
+        if parts[-1] == '_bulk':
+            return 200, self._bulk(parts[0], body)
+        if parts[-1] == '_mget':
+            index = self._index(parts[0], create=False) or {'docs': {}}
+            data = loads(body)
+            ids = data.get('ids') or [doc['_id'] for doc in data['docs']]
+            docs = []
+            for doc_id in ids:
+                entry = index['docs'].get(doc_id)
+                if entry is None:
+                    docs.append({'_id': doc_id, 'found': False})
+                else:
+                    hit = self._hit(parts[0], doc_id, entry,
+                                    data.get('_source'), True)
+                    hit['found'] = True
+                    docs.append(hit)
+            return 200, {'docs': docs}
+        if len(parts) >= 2 and parts[1] == '_mapping':
+            return (200 if names[0] in self.indices else 404), None
+        if len(parts) == 3 and parts[2] == '_mapping':
+            return (200 if names[0] in self.indices else 404), None
+        if len(parts) == 4 and parts[3] in ['_create', '_update']:
+            op_type = parts[3][1:]
+            data = loads(body)
+            if op_type == 'update':
+                data = data['doc']
+            status, result = self._write(parts[0], parts[2], data, op_type,
+                                         params.get('version'))
+            return status, result
+        if len(parts) == 3:
+            index = self._index(parts[0], create=method != 'GET')
+            if method == 'GET':
+                entry = index['docs'].get(parts[2]) if index else None
+                if entry is None:
+                    return 404, {'_id': parts[2], 'found': False}
+                hit = self._hit(parts[0], parts[2], entry, None, True)
+                hit['found'] = True
+                return 200, hit
+            if method == 'DELETE':
+                removed = index['docs'].pop(parts[2], None)
+                return (200 if removed else 404), {'_id': parts[2]}
+            op_type = 'create' if params.get('op_type') == 'create' \
+                else 'index'
+            return self._write(parts[0], parts[2], loads(body), op_type,
+                               params.get('version'))
+        return 400, {'error': 'Unsupported request [%s %s]' % (method, path)}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    elastic = None
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf8') if length else ''
+        url = urlsplit(self.path)
+        params = {key: values[0]
+                  for key, values in parse_qs(url.query).items()}
+        if self.elastic.latency:
+            sleep(self.elastic.latency)
+        with self.elastic._lock:
+            self.elastic.requests += 1
+            status, result = self.elastic.handle(
+                self.command, url.path, params, body)
+        payload = b'' if result is None else dumps(result).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _handle
+
@@ -0,0 +1,217 @@
+"""Local stand-ins of the external services used by the scripts.
+
+Each service answers over HTTP on 127.0.0.1, waits `latency` seconds per
+request and fails a share `error_rate` of the requests with a 503:
+
+    Redirector: bit.ly, redirects each short url to its full url
+    NewsletterServer: eeas.europa.eu, serves the newsletter PDFs
+    ExtractorService: Diffbot article api
+    TranslatorService: Microsoft TranslateArray api
+    LanguageService: entities and sentiment of a text, as the Google api
+"""
+
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+from os.path import basename
+from random import Random
+from threading import Lock, Thread
+from time import sleep
+from urllib.parse import parse_qs, quote, urlsplit
+from xml.etree import ElementTree
+
+_ARRAYS_NS = 'http://schemas.microsoft.com/2003/10/Serialization/Arrays'
+_SERVICE_NS = \
+    'http://schemas.datacontract.org/2004/07/Microsoft.MT.Web.Service.V2'
+
+_URL_SAFE = ":/?#[]@!$&'()*+,;=%~"
+
+
+def _pick(items, key):
+    """Picks an item deterministically from the key."""
+
+    digest = sha256(key.encode('utf8')).digest()
+    return items[int.from_bytes(digest[:4], 'big') % len(items)]
+
+
+class FakeService(object):
+    """Base of the services, subclasses implement `handle`."""
+
+    def __init__(self, *, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.failures = 0
+        self._random = Random(seed)
+        self._lock = Lock()
+        self._server = None
+
+    def start(self):
+        handler = type('Handler', (_Handler,), {'service': self})
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:%d' % self._server.server_port
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _should_fail(self):
+        with self._lock:
+            self.requests += 1
+            if self._random.random() < self.error_rate:
+                self.failures += 1
+                return True
+        return False
+
+    def handle(self, method, path, params, body):
+        """
+        Returns:
+            (tuple) The status, the headers dict and the body bytes
+        """
+
+        raise NotImplementedError()
+
+    def stats(self):
+        return {'requests': self.requests, 'failures': self.failures}
+
+
+class Redirector(FakeService):
+    """Redirects `/<code>` to the full url of `http://bit.ly/<code>`.
+
+    The short urls not in `full_urls` redirect to a made up url on one of
+    the given domains.
+    """
+
+    def __init__(self, full_urls, domains=('example.com',), **kwargs):
+        super().__init__(**kwargs)
+        self._full_urls = full_urls
+        self._domains = list(domains)
+
+    def handle(self, method, path, params, body):
+        short_url = 'http://bit.ly' + path
+        full_url = self._full_urls.get(short_url)
+        if full_url is None:
+            full_url = 'http://%s/replay%s' % (
+                _pick(self._domains, short_url), path)
+        # Headers are latin-1, as bit.ly the url is sent percent-encoded.
+        return 301, {'Location': quote(full_url, safe=_URL_SAFE)}, b''
+
+
+class NewsletterServer(FakeService):
+    """Serves the PDF files by name, whatever the folder of the request.
+
+    Arguments:
+        files (dict): Requested file name -> path of the served file
+    """
+
+    def __init__(self, files, **kwargs):
+        super().__init__(**kwargs)
+        self._files = files
+
+    def handle(self, method, path, params, body):
+        file_path = self._files.get(basename(path))
+        if file_path is None:
+            return 404, {}, b'Not found'
+        with open(file_path, 'rb') as file:
+            return 200, {'Content-Type': 'application/pdf'}, file.read()
+
+
+class ExtractorService(FakeService):
+    """Answers as the Diffbot article api.
+
+    Arguments:
+        articles (dict): Full url -> dict with `text`, `authors` and
+            `language`. Other urls get the article of a random url.
+    """
+
+    def __init__(self, articles, **kwargs):
+        super().__init__(**kwargs)
+        self._articles = articles
+        self._urls = sorted(articles)
+
+    def handle(self, method, path, params, body):
+        full_url = params.get('url', '')
+        article = self._articles.get(full_url) or \
+            self._articles[_pick(self._urls, full_url)]
+        result = {'text': article['text'],
+                  'humanLanguage': article['language']}
+        if article.get('authors'):
+            result['author'] = article['authors']
+        return 200, {'Content-Type': 'application/json'}, \
+            dumps({'objects': [result]}).encode('utf8')
+
+
+class TranslatorService(FakeService):
+    """Answers as the Microsoft TranslateArray api, texts are echoed."""
+
+    def handle(self, method, path, params, body):
+        try:
+            request = ElementTree.XML(body)
+        except ElementTree.ParseError:
+            return 400, {}, b'Malformed request'
+        response = ElementTree.Element(
+            '{%s}ArrayOfTranslateArrayResponse' % _SERVICE_NS)
+        for text in request.iter('{%s}string' % _ARRAYS_NS):
+            item = ElementTree.SubElement(
+                response, '{%s}TranslateArrayResponse' % _SERVICE_NS)
+            ElementTree.SubElement(
+                item, '{%s}From' % _SERVICE_NS).text = 'xx'
+            ElementTree.SubElement(
+                item, '{%s}TranslatedText' % _SERVICE_NS).text = text.text
+        return 200, {'Content-Type': 'application/xml'}, \
+            ElementTree.tostring(response, encoding='utf-8')
+
+
+class LanguageService(FakeService):
+    """Returns the entities and sentiment of a text.
+
+    Arguments:
+        annotations (dict): Text -> dict with `sentiment_score`,
+            `sentiment_magnitude` and `entities`. Other texts get the
+            annotation of a random text.
+    """
+
+    def __init__(self, annotations, **kwargs):
+        super().__init__(**kwargs)
+        self._annotations = annotations
+        self._texts = sorted(annotations)
+
+    def handle(self, method, path, params, body):
+        text = loads(body)['text']
+        annotation = self._annotations.get(text) or \
+            self._annotations[_pick(self._texts, text)]
+        return 200, {'Content-Type': 'application/json'}, \
+            dumps(annotation).encode('utf8')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    service = None
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        url = urlsplit(self.path)
+        params = {key: values[0]
+                  for key, values in parse_qs(url.query).items()}
+        if self.service.latency:
+            sleep(self.service.latency)
+        if self.service._should_fail():
+            status, headers, payload = 503, {}, b'Service unavailable'
+        else:
+            status, headers, payload = self.service.handle(
+                self.command, url.path, params, body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_HEAD = _handle
@@ -0,0 +1,100 @@
+"""Loads the news dump `dataset/euvsdisinfo.tar.bz2` into a backend.
+
+The archive is decompressed as a stream and its lines are parsed in
+batches by a process pool (see dataset_dump.py). Each batch is written
+with one bulk request, at most `depth` requests are in flight, reading and
+parsing wait when the backend is slower. The news already present are
+left as they are, so the load can be run again.
+
+Usage, from the `python` folder:
+
+    python scripts/00_load_dataset.py --backend elastic
+
+The index is created when missing, as with `python scripts/dao.py init`.
+"""
+
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dao import BACKENDS, TEXT_FIELDS, create_dao
+from dataset_dump import HEAVY_FIELDS, iter_news_batches
+from structured_log import get_logger
+from time import perf_counter
+
+_DEFAULT_PATH = '../dataset/euvsdisinfo.tar.bz2'
+_BATCH_SIZE = 200
+_PROCESSES = 4
+_DEPTH = 4
+
+_logger = get_logger('load')
+
+
+def load(dao, path=_DEFAULT_PATH, *, batch_size=_BATCH_SIZE,
+         processes=_PROCESSES, depth=_DEPTH, strip=HEAVY_FIELDS):
+    """
+    Arguments:
+        dao (Dao): The backend
+        path (str): The dump archive
+        batch_size (int): News per bulk request
+        processes (int): Parsing processes
+        depth (int): Maximum number of bulk requests in flight
+        strip (list of str): Fields left out of the news
+    Returns:
+        (dict): The number of news `read`, `created` and already present
+            (`conflicts`) and the rejected items (`errors`)
+    """
+
+    assert depth > 0
+    totals = {'read': 0, 'created': 0, 'conflicts': 0, 'errors': []}
+
+    def add(result):
+        totals['created'] += result['sent']
+        totals['conflicts'] += result['conflicts']
+        totals['errors'].extend(result['errors'])
+
+    with ThreadPoolExecutor(depth) as executor:
+        pending = deque()
+        for news_batch in iter_news_batches(
+                path, batch_size=batch_size, processes=processes,
+                strip=strip):
+            totals['read'] += len(news_batch)
+            if len(pending) >= depth:
+                add(pending.popleft().result())
+            pending.append(executor.submit(dao.import_many, news_batch))
+        while pending:
+            add(pending.popleft().result())
+    return totals
+
+
+def run(backend=None, path=_DEFAULT_PATH, batch_size=_BATCH_SIZE,
+        processes=_PROCESSES, depth=_DEPTH, include_text=True):
+    dao = create_dao(backend, batch_size=batch_size)
+    dao.init_schema()
+    strip = HEAVY_FIELDS if include_text else HEAVY_FIELDS + TEXT_FIELDS
+    start = perf_counter()
+    totals = load(dao, path, batch_size=batch_size, processes=processes,
+                  depth=depth, strip=strip)
+    seconds = perf_counter() - start
+    for error in totals['errors']:
+        _logger.error('News not loaded.', **error)
+    _logger.info('Dataset loaded.', path=path, dao=type(dao).__name__,
+                 read=totals['read'], created=totals['created'],
+                 already_present=totals['conflicts'],
+                 errors=len(totals['errors']), seconds=round(seconds, 2),
+                 news_per_second=round(totals['read'] / seconds, 1))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Loads the news dump.')
+    parser.add_argument('--backend', choices=BACKENDS,
+                        help='Defaults to the DAO_BACKEND variable.')
+    parser.add_argument('--path', default=_DEFAULT_PATH)
+    parser.add_argument('--batch-size', type=int, default=_BATCH_SIZE)
+    parser.add_argument('--processes', type=int, default=_PROCESSES)
+    parser.add_argument('--depth', type=int, default=_DEPTH,
+                        help='Bulk requests in flight.')
+    parser.add_argument('--no-text', action='store_true',
+                        help='Leaves out text_original and text_en.')
+    args = parser.parse_args()
+    run(args.backend, args.path, args.batch_size, args.processes,
+        args.depth, not args.no_text)
@@ -1,10 +1,18 @@
+from asyncio import create_task, run as run_async
+from dao import AsyncDao, create_dao
 from datetime import datetime, timedelta
-from dao_elastic import DaoElastic
+from domain_filter import DomainFilter
+from http_pool import get
+from link_resolver import LinkResolver
+from metrics import clear, flush, increment, serve
 from multiprocessing import Pool
+from os import rename
 from os.path import exists
-from pymongo.errors import DuplicateKeyError
-from requests import get
-from textract import process
+from pdf_links import extract_links
+from scrape_journal import DOWNLOADED, MERGED, MISSING, PARSED, \
+    ScrapeJournal
+from structured_log import get_logger
+from url_cache import ResolutionCache
 
 
 _NEWSLETTER_URLS = [{'url': 'https://gallery.mailchimp.com/cd23226ada1699a77000eb60b/files/6f01d319-21d5-4e25-ad77-d3543a3b7911/Disinformation_Review_09.02.2017_eng.pdf',
@@ -13,119 +21,264 @@ _NEWSLETTER_PATH = 'https://eeas.europa.eu/sites/eeas/files/'
 _FILE_PREFIX = 'disinformation_review_'
 _FILE_SUFFIX = '_eng.pdf'
 _LINK_FAKE_SUFFIX = 'http://bit.ly/'
-_FILTER_DOMAINS = ['youtube.com', 'un.org', 'europa.eu', 'nato.int',
-                   'state.gov', 'securitycouncilreport.org', 'defense.gov',
-                   'stopfake.org', 'theguardian.com', 'amnesty.org',
-                   'justice.gov', 'telegraph.co.uk', 'euobserver.com',
-                   'martenscentre.eu']
+# Days after which a newsletter not found is not requested anymore.
+_MISSING_RETRY_DAYS = 7
+# Short urls resolved together, the links of a batch are saved together.
+_RESOLVE_BATCH_SIZE = 100
 
+_dao = None
+_resolution_cache = None
+_journal = None
+_domain_filter = None
+_logger = get_logger('scrape')
 
-def _is_filtered(domain):
-    for word in _FILTER_DOMAINS:
-        if domain.rfind(word) >= 0:
-            return True
-    return False
 
+def _get_dao():
+    global _dao
+    if _dao is None:
+        _dao = create_dao()
+    return _dao
 
-def _get_domain(full_url):
-    start = full_url.find('://') + len('://')
-    end = full_url.find('/', start)
-    assert start > 0
-    assert end > start
-    return full_url[start:end]
 
+def _get_resolution_cache():
+    global _resolution_cache
+    if _resolution_cache is None:
+        _resolution_cache = ResolutionCache()
+    return _resolution_cache
 
-def _get_full_url(short_url):
-    response = get(short_url, allow_redirects=False)
-    assert response.status_code in [301, 302], \
-        'Error: link [%s] returned [%d]' % (short_url, response.status_code)
-    html = response.text
-    start = html.find('<a href="') + len('<a href="')
-    end = html.find('">moved here')
-    assert start > 0
-    assert end > start
-    return html[start:end]
+
+def _get_domain_filter():
+    global _domain_filter
+    if _domain_filter is None:
+        _domain_filter = DomainFilter()
+    return _domain_filter
+
+
+def _get_journal():
+    global _journal
+    if _journal is None:
+        _journal = ScrapeJournal()
+    return _journal
+
+
+def _new_links(full_urls, known_full_urls, saved_full_urls, date):
+    """
+    Returns:
+        (list of dict): The links of the full urls not saved yet
+    """
+
+    links = []
+    classified = _get_domain_filter().classify(full_urls.values())
+    for (short_url, full_url), (domain, skip) in zip(
+            full_urls.items(), classified):
+        if full_url in known_full_urls or full_url in saved_full_urls:
+            continue
+        if domain is None:
+            _logger.warning('Link ignored, invalid url.',
+                            short_url=short_url, full_url=full_url)
+            continue
+        saved_full_urls.add(full_url)
+        links.append({'short_url': short_url, 'full_url': full_url,
+                      'domain': domain, 'skip': skip,
+                      'newsletter_date': date})
+    return links
+
+
+async def _merge_batches(async_dao, short_urls, date):
+    """Resolves the short urls and saves the new links, batch by batch.
+
+    The links of a batch are saved while the next batch is resolved.
+
+    Returns:
+        (tuple): The `save_new_links` result of each batch and the number of
+            short urls not resolved for a temporary reason
+    """
+
+    results = []
+    saved_full_urls = set()
+    saving = None
+    async with LinkResolver(cache=_get_resolution_cache()) as resolver:
+        for start in range(0, len(short_urls), _RESOLVE_BATCH_SIZE):
+            full_urls, errors = await resolver.resolve(
+                short_urls[start:start + _RESOLVE_BATCH_SIZE])
+            increment('links_total', len(full_urls), outcome='resolved')
+            increment('links_total', len(errors), outcome='not_resolved')
+            for short_url, error in errors.items():
+                _logger.warning('Link not resolved.', short_url=short_url,
+                                error=error)
+            _, known_full_urls = await async_dao.find_existing_urls(
+                full_urls=full_urls.values())
+            links = _new_links(full_urls, known_full_urls, saved_full_urls,
+                               date)
+            if saving is not None:
+                results.append(await saving)
+            saving = create_task(async_dao.save_new_links(links))
+    if saving is not None:
+        results.append(await saving)
+    return results, len(resolver.retryable)
 
 
 def _merge_values(fake_links, date):
-    dao = DaoElastic()
-    for short_url in fake_links:
-        if not dao.exists_short_url(short_url=short_url):
-            full_url = _get_full_url(short_url)
-            if not dao.exists_full_url(full_url=full_url):
-                domain = _get_domain(full_url)
-                skip = _is_filtered(domain)
-                try:
-                    dao.save_new_link(short_url=short_url, full_url=full_url,
-                                      domain=domain, skip=skip,
-                                      newsletter_date=date)
-                except DuplicateKeyError:
-                    print('Duplicated url [%s] from [%s], ignored.'
-                          % (full_url, short_url))
-
-
-def _get_fake_links(text):
-    result = []
-    for word in text.decode("utf-8").split():
-        if word.startswith(_LINK_FAKE_SUFFIX):
-            result.append(word)
-    return result
-
-
-def _try_scarpe_url(url):
+    """
+    Returns:
+        (int): The number of links to merge again, not resolved for a
+            temporary reason or rejected by the storage
+    """
+
+    dao = _get_dao()
+    known_short_urls, _ = dao.find_existing_urls(short_urls=fake_links)
+    new_short_urls = [short_url for short_url in dict.fromkeys(fake_links)
+                      if short_url not in known_short_urls]
+    async_dao = AsyncDao(dao)
     try:
-        file_name = '../resources' + url[url.rfind('/'):].lower()
-        if not exists(file_name):
-            response = get(url=url, allow_redirects=False)
-            assert response.status_code == 200
-            print('Downloading file [%s].' % file_name)
-            with open(file_name, 'wb') as file:
-                for chunk in response:
-                    file.write(chunk)
-        else:
-            print('Download skipped, file [%s] already downloaded.'
-                  % file_name)
-        fake_links = _get_fake_links(process(file_name))
-        print('File [%s] contains links: [%r]' % (file_name, fake_links))
-        return fake_links
-    except AssertionError:
-        pass
+        results, retryable = run_async(
+            _merge_batches(async_dao, new_short_urls, date))
+    finally:
+        async_dao.close()
+    saved = sum(result['sent'] for result in results)
+    increment('links_total', saved, outcome='saved')
+    rejected = sum(len(result['errors']) for result in results)
+    _logger.info('Links merged.', newsletter_date=date, saved=saved,
+                 already_present=sum(result['conflicts']
+                                     for result in results),
+                 retryable=retryable, rejected=rejected,
+                 resolution_cache=_get_resolution_cache().stats())
+    for result in results:
+        for error in result['errors']:
+            _logger.error('Error while saving link.', id=error['id'],
+                          status=error['status'], error=error['error'])
+    return retryable + rejected
 
 
-def _process_date(date):
-    url = _NEWSLETTER_PATH + _FILE_PREFIX + date.strftime('%d.%m.%Y') + \
-          _FILE_SUFFIX
-    links = _try_scarpe_url(url=url)
-    if links:
-        _merge_values(links, date)
+def _download(url, file_name):
+    """
+    Returns:
+        (bool): False when the newsletter does not exist
+    Raises:
+        ValueError: On any other answer than 200 or 404, so the newsletter
+            is requested again on the next run
+    """
+
+    response = get(url=url, allow_redirects=False)
+    if response.status_code == 404:
+        return False
+    if response.status_code != 200:
+        raise ValueError('Error: newsletter [%s] returned [%d]' % (
+            url, response.status_code))
+    _logger.info('Downloading file.', url=url, file_name=file_name)
+    part_name = file_name + '.part'
+    with open(part_name, 'wb') as file:
+        for chunk in response:
+            file.write(chunk)
+    rename(part_name, file_name)
+    return True
+
+
+def _try_scarpe_url(url, date):
+    """
+    Returns:
+        (dict) The `links`, `file_name` and `digest` of a newsletter not
+            merged yet, None when there is nothing to merge
+    """
+
+    journal = _get_journal()
+    entry = journal.get_url(url)
+    if entry is not None and entry['status'] == MISSING and \
+            datetime.utcnow() - date > timedelta(days=_MISSING_RETRY_DAYS):
+        return None
+    file_name = '../resources' + url[url.rfind('/'):].lower()
+    if not exists(file_name):
+        if not _download(url, file_name):
+            journal.set_url(url, MISSING, newsletter_date=date)
+            return None
+    else:
+        _logger.info('Download skipped, file already downloaded.',
+                     file_name=file_name)
+    digest = journal.file_digest(file_name)
+    if entry is not None and entry['status'] == MERGED and \
+            entry['sha256'] == digest:
+        _logger.info('File already merged.', file_name=file_name)
+        return None
+    journal.set_url(url, DOWNLOADED, newsletter_date=date,
+                    file_name=file_name, digest=digest)
+    fake_links = journal.get_links(file_name, digest)
+    if fake_links is None:
+        fake_links = extract_links(file_name, _LINK_FAKE_SUFFIX)
+        journal.set_links(file_name, digest, fake_links)
+    _logger.info('Links found.', file_name=file_name, links=len(fake_links))
+    journal.set_url(url, PARSED, newsletter_date=date,
+                    file_name=file_name, digest=digest)
+    return {'links': fake_links, 'file_name': file_name, 'digest': digest}
 
 
 def _process_url(url, date):
-    links = _try_scarpe_url(url=url)
-    if links:
-        _merge_values(links, date)
+    try:
+        scraped = _try_scarpe_url(url, date)
+        if scraped is None:
+            return
+        if scraped['links'] and _merge_values(scraped['links'], date):
+            # Left parsed, the failed links are merged again on next run.
+            _logger.warning('Newsletter not merged, links to retry.',
+                            file_name=scraped['file_name'])
+            return
+        _get_journal().set_url(url, MERGED, newsletter_date=date,
+                               file_name=scraped['file_name'],
+                               digest=scraped['digest'])
+    finally:
+        # The pool workers exit without running atexit hooks.
+        flush()
+
+
+def _wait(tasks):
+    """Waits for the pool tasks, logging the failed ones.
+
+    Arguments:
+        tasks (list of tuple): The name and AsyncResult of each task
+    """
+
+    for name, task in tasks:
+        try:
+            task.get()
+            increment('newsletters_total', outcome='ok')
+        except Exception as e:
+            increment('newsletters_total', outcome='error')
+            _logger.error('Newsletter not processed.', task=name,
+                          error=str(e), error_class=e.__class__.__name__,
+                          exc_info=e)
+
+
+def _process_date(date):
+    url = _NEWSLETTER_PATH + _FILE_PREFIX + date.strftime('%d.%m.%Y') + \
+          _FILE_SUFFIX
+    _process_url(url, date)
 
 
 def scrape_from_path(days):
     end_date = datetime.utcnow()
     start_date = datetime.utcnow() - timedelta(days=days)
     date = start_date
+    tasks = []
     with Pool(4) as pool:
         while date <= end_date:
-            pool.apply_async(_process_date, [date])
+            tasks.append((date.strftime('%Y-%m-%d'),
+                          pool.apply_async(_process_date, [date])))
             date += timedelta(days=1)
         pool.close()
+        _wait(tasks)
         pool.join()
 
 
 def scrape_from_urls(urls):
     with Pool(4) as pool:
-        for url in urls:
-            pool.apply_async(_process_url, [url['url'], url['date']])
+        tasks = [(url['url'], pool.apply_async(
+            _process_url, [url['url'], url['date']])) for url in urls]
         pool.close()
+        _wait(tasks)
         pool.join()
 
 
 if __name__ == '__main__':
+    clear()
+    serve()
     scrape_from_path(10)
     scrape_from_urls(_NEWSLETTER_URLS)
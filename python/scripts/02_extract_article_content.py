@@ -1,10 +1,19 @@
-from bs4 import BeautifulSoup
-from dao_elastic import DaoElastic
-from google.cloud import language, translate
-from google.cloud.exceptions import GoogleCloudError
+from aggregates import AggregateStore
+from concurrent.futures import ThreadPoolExecutor
+from dao import Entity, create_dao
+from http_pool import get, post
 from json import dumps
-from multiprocessing import Pool
-from requests import get
+from leases import ClaimLost, LeaseKeeper
+from metrics import clear, increment, serve, timed
+from near_duplicates import NearDuplicateIndex, minhash
+from pipeline import Pipeline, Stage
+from providers import client, lazy_import, register, selected, \
+    startup_report
+from rate_limit import QuotaDeferred, RateLimiter
+from result_cache import ResultCache
+from structured_log import get_logger
+from text_chunker import batch_texts, chunk_text
+from time import time
 from urllib.parse import quote_plus
 from xml.etree import ElementTree
 
@@ -13,21 +22,95 @@ _DIFFBOT_API_URL = 'https://api.diffbot.com/v3/article'
 _EMBEDLY_API_KEY = '<yourapikey>'
 _EMBEDLY_API_URL = 'https://api.embedly.com/1/extract'
 _EMBEDLY_LANGUAGES = {'English': 'en'}
+_MICROSOFT_API_URL = \
+    'https://api.microsofttranslator.com/v2/http.svc/TranslateArray'
+_MICROSOFT_ARRAYS_NS = \
+    'http://schemas.microsoft.com/2003/10/Serialization/Arrays'
+_MICROSOFT_SERVICE_NS = \
+    'http://schemas.datacontract.org/2004/07/Microsoft.MT.Web.Service.V2'
+# Characters and texts allowed in a single TranslateArray request.
+_MICROSOFT_MAX_SIZE = 10000
+_MICROSOFT_MAX_COUNT = 2000
+_GOOGLE_MAX_SIZE = 5000
+_GOOGLE_MAX_COUNT = 128
+# Concurrent requests used to translate the chunks of a single text.
+_TRANSLATION_THREADS = 4
+# Worker threads of each processing stage.
+_STAGE_WORKERS = {'extract': 8, 'translate': 4, 'annotate': 4, 'persist': 2}
+_QUEUE_SIZE = 50
+# Requests per second and characters per day allowed by each provider plan.
+_PROVIDER_LIMITS = {
+    'diffbot': {'requests_per_second': 5},
+    'embedly': {'requests_per_second': 10},
+    'microsoft': {'requests_per_second': 10,
+                  'characters_per_day': 2000000},
+    'google_translate': {'requests_per_second': 10,
+                         'characters_per_day': 2000000},
+    'google_language': {'requests_per_second': 10}}
+# Answers deferring the news instead of saving an error: 429 for every
+# provider, and the 403 of Google with one of these error reasons.
+_QUOTA_STATUS = 429
+_GOOGLE_QUOTA_REASONS = ['dailyLimitExceeded', 'quotaExceeded',
+                         'rateLimitExceeded', 'userRateLimitExceeded']
 # To get this token curl --header 'Ocp-Apim-Subscription-Key: <yourapikey>' --data "" 'https://api.cognitive.microsoft.com/sts/v1.0/issueToken'
 _AZURE_COGNITIVE_TOKEN = 'eyJ0eXAiOiJKV1QiLCJhbGciOiJIUzI1NiJ9.eyJzY29wZSI6Imh0dHBzOi8vYXBpLm1pY3Jvc29mdHRyYW5zbGF0b3IuY29tLyIsInN1YnNjcmlwdGlvbi1pZCI6IjBiYjVhOGUzYTgzYzRjMGRhZWIyMzA3ZmFhNDM5ZTVlIiwicHJvZHVjdC1pZCI6IlRleHRUcmFuc2xhdG9yLkYwIiwiY29nbml0aXZlLXNlcnZpY2VzLWVuZHBvaW50IjoiaHR0cHM6Ly9hcGkuY29nbml0aXZlLm1pY3Jvc29mdC5jb20vaW50ZXJuYWwvdjEuMC8iLCJhenVyZS1yZXNvdXJjZS1pZCI6Ii9zdWJzY3JpcHRpb25zL2QwYmMwYTYzLWNmZjktNGNiZi04OWRjLWYzOTAzZWMzN2RjNy9yZXNvdXJjZUdyb3Vwcy91bmZhY3QvcHJvdmlkZXJzL01pY3Jvc29mdC5Db2duaXRpdmVTZXJ2aWNlcy9hY2NvdW50cy91bmZhY3QiLCJpc3MiOiJ1cm46bXMuY29nbml0aXZlc2VydmljZXMiLCJhdWQiOiJ1cm46bXMubWljcm9zb2Z0dHJhbnNsYXRvciIsImV4cCI6MTQ4NzY5NDczOX0.17hhcXacTdzDDoTXviKIbYnYXBHaHA6KPZIkwXGJ9NQ'
 
+_dao = None
+_result_cache = None
+_near_duplicates = None
+# The LeaseKeeper of the running `run`, None outside of it.
+_leases = None
+_rate_limiter = None
+_logger = get_logger('extract')
 
-dao = DaoElastic()
+
+def _get_dao():
+    global _dao
+    if _dao is None:
+        _dao = create_dao(aggregates=AggregateStore())
+    return _dao
+
+
+def _get_rate_limiter():
+    global _rate_limiter
+    if _rate_limiter is None:
+        _rate_limiter = RateLimiter(_PROVIDER_LIMITS)
+    return _rate_limiter
+
+
+def _defer(provider, retry_after=None):
+    """Blocks the provider and raises QuotaDeferred."""
+
+    retry_at = _get_rate_limiter().penalize(provider, retry_after)
+    raise QuotaDeferred(provider, retry_at)
+
+
+def _check_quota(provider, response):
+    if response.status_code == _QUOTA_STATUS:
+        retry_after = response.headers.get('Retry-After')
+        _defer(provider, float(retry_after)
+               if retry_after and retry_after.isdigit() else None)
+
+
+def _is_google_quota(error):
+    if error.code == _QUOTA_STATUS:
+        return True
+    return error.code == 403 and any(
+        item.get('reason') in _GOOGLE_QUOTA_REASONS
+        for item in getattr(error, 'errors', None) or [])
 
 
 def _get_article_content_diffbot(full_url):
     url = '%s?token=%s&url=%s' % (
         _DIFFBOT_API_URL, _DIFFBOT_API_KEY, quote_plus(full_url.strip()))
-    response = get(url)
-    assert response.status_code == 200, \
-        'Invalid response [%d] for url [%s].' % \
-        (response.status_code, full_url)
-    content_json = response.json()
+    _get_rate_limiter().acquire('diffbot')
+    with timed('extract', provider='diffbot'):
+        response = get(url)
+        _check_quota('diffbot', response)
+        assert response.status_code == 200, \
+            'Invalid response [%d] for url [%s].' % \
+            (response.status_code, full_url)
+        content_json = response.json()
     assert 'objects' in content_json, \
         'Diffbot bad response: [%s]' % dumps(content_json)
     assert len(content_json['objects']) == 1, \
@@ -43,14 +126,17 @@ def _get_article_content_diffbot(full_url):
 def _get_article_content_embedly(full_url):
     url = '%s?key=%s&url=%s' % (
         _EMBEDLY_API_URL, _EMBEDLY_API_KEY, quote_plus(full_url.strip()))
-    response = get(url)
-    assert response.status_code == 200, \
-        'Invalid response [%d] for url [%s].' % \
-        (response.status_code, full_url)
-    json = response.json()
+    _get_rate_limiter().acquire('embedly')
+    with timed('extract', provider='embedly'):
+        response = get(url)
+        _check_quota('embedly', response)
+        assert response.status_code == 200, \
+            'Invalid response [%d] for url [%s].' % \
+            (response.status_code, full_url)
+        json = response.json()
     content = json['content']
     assert content, 'Not content extracted for [%s].' % full_url
-    soup = BeautifulSoup(content, 'html.parser')
+    soup = lazy_import('bs4').BeautifulSoup(content, 'html.parser')
     authors = ','.join(json['authors'] if 'authors' in json else None)
     return {'text': soup.get_text(),
             'authors': authors,
@@ -58,124 +144,406 @@ def _get_article_content_embedly(full_url):
             'extractor': 'embedly'}
 
 
-def _internal_translate_microsoft(text_part):
-    """
+def _translate_in_chunks(text_content, translate_batch, max_chunk_size,
+                         max_batch_size, max_batch_count):
+    """Translates a text of any length.
+
+    The text is split in chunks, the chunks are grouped in batches and the
+    batches are translated concurrently.
+
     Args:
-        text_part (str) The text to be translated
+        text_content (str) The text to be translated
+        translate_batch (function) Translates a list of texts, returns the
+            list of translations in the same order
+        max_chunk_size (int) Maximum characters of a chunk
+        max_batch_size (int) Maximum characters of a batch
+        max_batch_count (int) Maximum chunks of a batch
     Returns:
         (str) The text translation
     """
-    params = {
-        'text': text_part.encode('utf8'),
-        'to': 'en',
-        'contentType': 'text/plain'}
+
+    chunks = chunk_text(text_content, max_chunk_size)
+    texts = [chunk.strip() for chunk, _ in chunks]
+    positions = [position for position, text in enumerate(texts) if text]
+    batches = [[positions[index] for index in batch] for batch in
+               batch_texts([texts[position] for position in positions],
+                           max_batch_size, max_batch_count)]
+    translations = list(texts)
+    with ThreadPoolExecutor(_TRANSLATION_THREADS) as executor:
+        results = executor.map(
+            lambda batch: translate_batch(
+                [texts[position] for position in batch]), batches)
+        for batch, result in zip(batches, results):
+            assert len(result) == len(batch), \
+                'Expected [%d] translations but [%d] found.' % (
+                    len(batch), len(result))
+            for position, translation in zip(batch, result):
+                translations[position] = translation
+    parts = []
+    for (chunk, separator), text, translation in zip(
+            chunks, texts, translations):
+        if text:
+            start = chunk.find(text)
+            parts.append(chunk[:start])
+            parts.append(translation)
+            parts.append(chunk[start + len(text):])
+        else:
+            parts.append(chunk)
+        parts.append(separator)
+    return ''.join(parts)
+
+
+def _internal_translate_microsoft(text_parts):
+    """
+    Args:
+        text_parts (list of str) The texts to be translated
+    Returns:
+        (list of str) The texts translation
+    """
+    request = ElementTree.Element('TranslateArrayRequest')
+    ElementTree.SubElement(request, 'AppId')
+    options = ElementTree.SubElement(request, 'Options')
+    ElementTree.SubElement(
+        options, '{%s}ContentType' % _MICROSOFT_SERVICE_NS).text = \
+        'text/plain'
+    texts = ElementTree.SubElement(request, 'Texts')
+    for text_part in text_parts:
+        ElementTree.SubElement(
+            texts, '{%s}string' % _MICROSOFT_ARRAYS_NS).text = text_part
+    ElementTree.SubElement(request, 'To').text = 'en'
     headers = {
         'Authorization': 'Bearer %s' % _AZURE_COGNITIVE_TOKEN,
+        'Content-Type': 'text/xml',
         'Accept': 'application/xml'}
-    url = 'https://api.microsofttranslator.com/v2/http.svc/Translate'
-    response = get(url, params=params, headers=headers)
-    if response.status_code == 414:
-        raise ValueError('Text size [%d] exceeds quota.' % len(text_part))
-    assert response.status_code == 200, \
-        'Invalid response status [%d].' % response.status_code
-    return ElementTree.XML(response.text).text
+    _get_rate_limiter().acquire(
+        'microsoft', sum(len(text_part) for text_part in text_parts))
+    with timed('translate', provider='microsoft'):
+        response = post(_MICROSOFT_API_URL,
+                        data=ElementTree.tostring(request, encoding='utf-8'),
+                        headers=headers)
+        _check_quota('microsoft', response)
+        if response.status_code in [413, 414]:
+            raise ValueError('Text size [%d] exceeds quota.' % sum(
+                len(text_part) for text_part in text_parts))
+        assert response.status_code == 200, \
+            'Invalid response status [%d].' % response.status_code
+    return [item.findtext('{%s}TranslatedText' % _MICROSOFT_SERVICE_NS)
+            for item in ElementTree.XML(response.content)]
 
 
 def _get_translation_microsoft(text_content):
-    result = ''
-    if len(text_content) > 10000:
-        for text in text_content.split('\n'):
-            result = result + _internal_translate_microsoft(text) + '\n'
-    else:
+    text_en = _translate_in_chunks(
+        text_content, _internal_translate_microsoft,
+        max_chunk_size=_MICROSOFT_MAX_SIZE,
+        max_batch_size=_MICROSOFT_MAX_SIZE,
+        max_batch_count=_MICROSOFT_MAX_COUNT)
+    return {'translator': 'microsoft', 'text_en': text_en}
+
+
+def _new_translate_client():
+    return lazy_import('google.cloud.translate').Client()
+
+
+def _internal_translate_google(text_parts):
+    """
+    Args:
+        text_parts (list of str) The texts to be translated
+    Returns:
+        (list of str) The texts translation
+    """
+    translate_client = client('google_translate', _new_translate_client)
+    errors = lazy_import('google.cloud.exceptions')
+    size = sum(len(text_part) for text_part in text_parts)
+    _get_rate_limiter().acquire('google_translate', size)
+    with timed('translate', provider='google_translate'):
         try:
-            result = _internal_translate_microsoft(text_content)
-        except ValueError:
-            for text in text_content.split('\n'):
-                result = result + _internal_translate_microsoft(text) + '\n'
-    return {'translator': 'microsoft', 'text_en': result}
+            results = translate_client.translate(text_parts,
+                                                 target_language='en')
+            return [result['translatedText'] for result in results]
+        except errors.GoogleCloudError as e:
+            if e.code == 400:
+                raise ValueError('Malformed request.')
+            elif _is_google_quota(e):
+                _defer('google_translate')
+            elif e.code == 413:
+                raise ValueError('Text size [%d] exceeds quota.' % size)
+            else:
+                raise e
 
 
 def _get_translation_google(text_content):
-    client = translate.Client()
-    try:
-        text_en = client.translate(
-            text_content, target_language='en')['translatedText']
-        return {'translator': 'google', 'text_en': text_en}
-    except GoogleCloudError as e:
-        if e.code == 400:
-            raise ValueError('Malformed request.')
-        elif e.code == 403:
-            raise ValueError('Daily limit exceeded.')
-        elif e.code == 413:
-            raise ValueError('Text size [%d] exceeds quota.' %
-                             len(text_content))
-        else:
+    text_en = _translate_in_chunks(
+        text_content, _internal_translate_google,
+        max_chunk_size=_GOOGLE_MAX_SIZE,
+        max_batch_size=_GOOGLE_MAX_SIZE,
+        max_batch_count=_GOOGLE_MAX_COUNT)
+    return {'translator': 'google', 'text_en': text_en}
+
+
+def _new_language_client():
+    return lazy_import('google.cloud.language').Client()
+
+
+def _get_annotation(text_en):
+    language_client = client('google_language', _new_language_client)
+    errors = lazy_import('google.cloud.exceptions')
+    document = language_client.document_from_text(text_en)
+    assert document is not None, 'Document object is none'
+    _get_rate_limiter().acquire('google_language', len(text_en))
+    with timed('annotate', provider='google_language'):
+        try:
+            annotated = document.annotate_text(include_syntax=False,
+                                               include_entities=True,
+                                               include_sentiment=True)
+        except errors.GoogleCloudError as e:
+            if _is_google_quota(e):
+                _defer('google_language')
             raise e
+    assert annotated is not None, 'Annotated object is none'
+    return {'sentiment_score': annotated.sentiment.score,
+            'sentiment_magnitude': annotated.sentiment.magnitude,
+            'entities': [[entity.name, entity.entity_type, entity.salience,
+                          entity.wikipedia_url]
+                         for entity in annotated.entities]}
+
+
+def _get_annotation_local(text_en):
+    return lazy_import('local_annotator').annotate(text_en)
+
+
+def _get_result_cache():
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache()
+    return _result_cache
+
+
+def _get_near_duplicates():
+    global _near_duplicates
+    if _near_duplicates is None:
+        _near_duplicates = NearDuplicateIndex()
+    return _near_duplicates
+
+
+def _reused(work, result):
+    """Returns the `translation` or `annotation` of the near-duplicate.
+
+    Returns:
+        (dict) The cached result, None without near-duplicate or when the
+            result is not cached anymore
+    """
+
+    duplicate = work.get('duplicate')
+    if duplicate is None or duplicate[result + '_key'] is None:
+        return None
+    value = _get_result_cache().get(duplicate[result + '_key'])
+    if value is not None:
+        work[result + '_key'] = duplicate[result + '_key']
+        increment('results_reused_total', result=result)
+    return value
+
+
+# The first registered provider of each kind is the default one, see
+# providers.py to select another one.
+register('extractor', 'diffbot', _get_article_content_diffbot)
+register('extractor', 'embedly', _get_article_content_embedly)
+register('translator', 'microsoft', _get_translation_microsoft)
+register('translator', 'google', _get_translation_google)
+register('annotator', 'google_language', _get_annotation)
+register('annotator', 'local', _get_annotation_local)
 
 
-# Change function body to use another article extractor.
 def _get_article_content(full_url):
-    return _get_article_content_diffbot(full_url)
+    return selected('extractor')(full_url)
 
 
-# Change function body to use another translator.
 def _get_translation(text_content):
-    return _get_translation_microsoft(text_content)
+    return selected('translator')(text_content)
+
 
+def _check_claim(news):
+    if _leases is not None:
+        _leases.check(news)
 
-def _process_text(news):
+
+def _extract_stage(work):
     """
     Args:
-        news (dict)
+        work (dict) The news being processed, filled by each stage.
     """
 
+    news = work['news']
+    _check_claim(news)
     assert news['id'], 'Missing news id for url [%s]' % news['short_url']
     assert 'skip' not in news or not news['skip'], \
         'News [%s] should not have [skip] True' % news['id']
     assert 'text_analysed' not in news or not news['text_analysed'], \
         'News [%s] should not have [text_analysed] True' % news['id']
-    try:
-        content = _get_article_content(news['full_url'])
-        text_orig = content['text']
-        if content['language'] != 'en':
-            translation = _get_translation(text_orig)
-        else:
-            translation = {'translator': 'none', 'text_en': text_orig}
-        document = language.Client().document_from_text(translation['text_en'])
-        assert document is not None, 'Document object is none'
-        annotated = document.annotate_text(include_syntax=False,
-                                           include_entities=True,
-                                           include_sentiment=True)
-        assert annotated is not None, 'Annotated object is none'
-        dao.save_text_analysis(news=news,
-                               text_original=content['text'],
-                               authors=content['authors'],
-                               text_en=translation['text_en'],
-                               translator=translation['translator'],
-                               language=content['language'],
-                               sentiment_score=
-                               annotated.sentiment.score,
-                               sentiment_magnitude=
-                               annotated.sentiment.magnitude,
-                               entities=annotated.entities,
-                               extractor=content['extractor'])
-        print('Url [%s] processed.' % news['short_url'])
-    except Exception as e:
-        print('Error while processing [%s]: [%s].' % (
-            news['short_url'], str(e)))
-        dao.save_error(news=news, error_message=str(e),
-                       error_class=e.__class__.__name__)
-
-
-def run():
-    # for news in dao.find_for_text_analysis():
-    #     _process_text(news)
-    with Pool(4) as pool:
-        for news in dao.find_for_text_analysis():
-            pool.apply_async(_process_text, [news])
-        pool.close()
-        pool.join()
+    cache = _get_result_cache()
+    work['content'] = cache.fetch(
+        cache.extraction_key(news['full_url']),
+        lambda: _get_article_content(news['full_url']))
+    return work
+
+
+def _translate_stage(work):
+    _check_claim(work['news'])
+    content = work['content']
+    # The near-duplicates of a news already analysed reuse its results.
+    work['signature'] = minhash(content['text'])
+    work['duplicate'] = None
+    if work['signature'] is not None:
+        work['duplicate'] = _get_near_duplicates().find(work['signature'])
+    if work['duplicate'] is not None:
+        _logger.info('Near-duplicate found.', id=work['news']['id'],
+                     duplicate_of=work['duplicate']['cluster'],
+                     similarity=work['duplicate']['similarity'])
+    work['translation_key'] = None
+    if content['language'] != 'en':
+        translation = _reused(work, 'translation')
+        if translation is None:
+            cache = _get_result_cache()
+            work['translation_key'] = cache.translation_key(content['text'],
+                                                            'en')
+            translation = cache.fetch(
+                work['translation_key'],
+                lambda: _get_translation(content['text']))
+        work['translation'] = translation
+    else:
+        work['translation'] = {'translator': 'none',
+                               'text_en': content['text']}
+    return work
+
+
+def _annotate_stage(work):
+    _check_claim(work['news'])
+    text_en = work['translation']['text_en']
+    annotation = _reused(work, 'annotation')
+    if annotation is None:
+        cache = _get_result_cache()
+        work['annotation_key'] = cache.annotation_key(text_en)
+        annotation = cache.fetch(work['annotation_key'],
+                                 lambda: selected('annotator')(text_en))
+    work['annotation'] = annotation
+    return work
+
+
+def _persist_stage(work):
+    news = work['news']
+    content = work['content']
+    translation = work['translation']
+    annotation = work['annotation']
+    duplicate = work['duplicate']
+    if _leases is not None:
+        _leases.done(news)
+
+    def index_signature(saved):
+        # Only the news actually stored become near-duplicate seeds.
+        _get_near_duplicates().add(
+            saved['id'], work['signature'],
+            cluster=duplicate and duplicate['cluster'],
+            translation_key=work['translation_key'],
+            annotation_key=work['annotation_key'])
+
+    dao = _get_dao()
+    dao.save_text_analysis(news=news,
+                           text_original=content['text'],
+                           authors=content['authors'],
+                           text_en=translation['text_en'],
+                           translator=translation['translator'],
+                           language=content['language'],
+                           sentiment_score=annotation['sentiment_score'],
+                           sentiment_magnitude=
+                           annotation['sentiment_magnitude'],
+                           entities=[Entity(*entity) for entity
+                                     in annotation['entities']],
+                           extractor=content['extractor'],
+                           duplicate_of=duplicate and duplicate['cluster'],
+                           on_saved=index_signature
+                           if work['signature'] is not None else None)
+    increment('news_total', outcome='processed')
+    _logger.info('Url processed.', short_url=news['short_url'],
+                 id=news['id'])
+    return work
+
+
+_STAGES = [('extract', _extract_stage),
+           ('translate', _translate_stage),
+           ('annotate', _annotate_stage),
+           ('persist', _persist_stage)]
+
+
+def _save_error(stage_name, work, e):
+    news = work['news']
+    if isinstance(e, QuotaDeferred):
+        increment('news_total', outcome='deferred', stage=stage_name)
+        _logger.info('Url deferred.', short_url=news['short_url'],
+                     provider=e.provider, retry_at=e.retry_at)
+        if _leases is not None:
+            # No worker claims the news before the quota allows it.
+            _leases.release(news, retry_after=max(e.retry_at - time(), 0))
+        return
+    if _leases is not None and not isinstance(e, ClaimLost):
+        try:
+            _leases.done(news, failed=True)
+        except ClaimLost as lost:
+            e = lost
+    if isinstance(e, ClaimLost):
+        increment('news_total', outcome='claim_lost', stage=stage_name)
+        _logger.warning('Url dropped, claimed by another worker.',
+                        short_url=news['short_url'], stage=stage_name)
+        return
+    increment('news_total', outcome='error', stage=stage_name)
+    _logger.error('Error while processing url.', short_url=news['short_url'],
+                  stage=stage_name, error=str(e),
+                  error_class=e.__class__.__name__)
+    _get_dao().save_error(news=news, error_message=str(e),
+                          error_class=e.__class__.__name__)
+
+
+def run(include_errors=False, slice_id=None, slices=None, worker_id=None):
+    """Processes the news waiting for the text analysis.
+
+    The news are claimed before being processed, see leases.py, so many
+    runs can share the work, on one or many hosts.
+
+    Args:
+        include_errors (boolean): Processes again the news in error
+        slice_id (int): The part of the news processed by this run
+        slices (int): Number of runs splitting the news
+        worker_id (str): Unique name of this run, generated by default
+    """
+
+    global _leases
+
+    _get_result_cache()
+    _get_near_duplicates()
+    _get_rate_limiter()
+    stages = [Stage(name, function, workers=_STAGE_WORKERS[name],
+                    queue_size=_QUEUE_SIZE)
+              for name, function in _STAGES]
+    # The results of all the persist workers are sent in bulk requests.
+    dao = _get_dao()
+    with LeaseKeeper(dao, worker_id) as leases, dao.bulk() as writer:
+        _leases = leases
+        try:
+            with Pipeline(stages, on_error=_save_error) as pipeline:
+                for news in leases.claimed(include_errors, slice_id=slice_id,
+                                           slices=slices):
+                    pipeline.put({'news': news})
+        finally:
+            _leases = None
+    for error in writer.errors:
+        _logger.error('News not saved.', **error)
+    if writer.conflicts:
+        _logger.warning('News not saved, lease lost.',
+                        news=writer.conflicts)
+    for name, stats in pipeline.stats().items():
+        _logger.info('Stage done.', stage=name, **stats)
+    _logger.info('Startup profile.', **startup_report())
 
 
 if __name__ == '__main__':
+    clear()
+    serve()
     run()
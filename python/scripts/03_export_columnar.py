@@ -0,0 +1,206 @@
+"""Exports the analysed news to columnar files for the analytics.
+
+Two tables are written, partitioned by newsletter month:
+
+    <output>/news/newsletter_month=2017-01/part-00000.parquet
+    <output>/entities/newsletter_month=2017-01/part-00000.parquet
+
+`entities` has one row per entity of each news. The repeated text columns
+(domain, language, entity type and name...) are dictionary encoded. With
+the `arrow` format the files are Arrow IPC files, which can be memory
+mapped, for example:
+
+    pyarrow.dataset.dataset('../export/entities', format='arrow',
+                            partitioning='hive').to_table()
+
+Each table is written in a `<table>.part` folder renamed in place of the
+previous export once complete, so no file of a previous export is left.
+"""
+
+from argparse import ArgumentParser
+from dao import BACKENDS, TEXT_FIELDS, create_dao
+from datetime import datetime
+from os import makedirs, rename
+from os.path import exists, join
+from pyarrow import RecordBatch, Table, date32, dictionary, float64, \
+    int32, schema, string
+from pyarrow import ipc, parquet
+from shutil import rmtree
+from structured_log import get_logger
+
+_DEFAULT_OUTPUT = '../export'
+_BATCH_SIZE = 50000
+_DICTIONARY = dictionary(int32(), string())
+
+_logger = get_logger('export')
+
+_NEWS_SCHEMA = schema([('id', string()),
+                       ('short_url', string()),
+                       ('full_url', string()),
+                       ('domain', _DICTIONARY),
+                       ('language', _DICTIONARY),
+                       ('translator', _DICTIONARY),
+                       ('extractor', _DICTIONARY),
+                       ('authors', string()),
+                       ('newsletter_date', date32()),
+                       ('sentiment_score', float64()),
+                       ('sentiment_magnitude', float64()),
+                       ('entities_count', int32()),
+                       ('duplicate_of', string()),
+                       ('text_original', string()),
+                       ('text_en', string())])
+_ENTITIES_SCHEMA = schema([('news_id', string()),
+                           ('domain', _DICTIONARY),
+                           ('language', _DICTIONARY),
+                           ('newsletter_date', date32()),
+                           ('type', _DICTIONARY),
+                           ('name', _DICTIONARY),
+                           ('salience', float64()),
+                           ('wikipedia_url', _DICTIONARY)])
+
+
+def _news_rows(news):
+    """Returns the news row and its entity rows."""
+
+    news_id = news.get('id') or str(news['_id'])
+    newsletter_date = datetime.strptime(
+        news['newsletter_date'][:10], '%Y-%m-%d').date() \
+        if news.get('newsletter_date') else None
+    entities = news.get('entities') or []
+    row = {'id': news_id,
+           'short_url': news.get('short_url'),
+           'full_url': news.get('full_url'),
+           'domain': news.get('domain'),
+           'language': news.get('language'),
+           'translator': news.get('translator'),
+           'extractor': news.get('extractor'),
+           'authors': news.get('authors'),
+           'newsletter_date': newsletter_date,
+           'sentiment_score': news.get('sentiment_score'),
+           'sentiment_magnitude': news.get('sentiment_magnitude'),
+           'entities_count': len(entities),
+           'duplicate_of': news.get('duplicate_of'),
+           'text_original': news.get('text_original'),
+           'text_en': news.get('text_en')}
+    entity_rows = [{'news_id': news_id,
+                    'domain': row['domain'],
+                    'language': row['language'],
+                    'newsletter_date': newsletter_date,
+                    'type': entity.get('type'),
+                    'name': entity.get('name'),
+                    'salience': entity.get('salience'),
+                    'wikipedia_url': entity.get('wikipedia_url')}
+                   for entity in entities]
+    return row, entity_rows
+
+
+class _PartitionedWriter(object):
+    """Buffers rows by partition and writes each full buffer to a file.
+
+    The files are written in a temporary folder, which replaces the `path`
+    folder on `close`.
+    """
+
+    def __init__(self, path, table_schema, file_format, batch_size):
+        self._target = path
+        self._path = path + '.part'
+        if exists(self._path):
+            rmtree(self._path)
+        self._schema = table_schema
+        self._format = file_format
+        self._batch_size = batch_size
+        self._buffers = {}
+        self._files = {}
+        self.rows = 0
+
+    def append(self, partition, row):
+        columns = self._buffers.setdefault(
+            partition, {name: [] for name in self._schema.names})
+        for name, values in columns.items():
+            values.append(row[name])
+        if len(columns[self._schema.names[0]]) >= self._batch_size:
+            self._flush(partition)
+
+    def _flush(self, partition):
+        columns = self._buffers.pop(partition)
+        batch = RecordBatch.from_pydict(columns, schema=self._schema)
+        if batch.num_rows == 0:
+            return
+        directory = join(self._path, 'newsletter_month=%s' % partition)
+        makedirs(directory, exist_ok=True)
+        number = self._files.get(partition, 0)
+        self._files[partition] = number + 1
+        file_name = join(directory, 'part-%05d.%s' % (number, self._format))
+        if self._format == 'parquet':
+            parquet.write_table(Table.from_batches([batch]), file_name,
+                                compression='zstd')
+        else:
+            with ipc.new_file(file_name, self._schema) as writer:
+                writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def close(self):
+        for partition in list(self._buffers):
+            self._flush(partition)
+        makedirs(self._path, exist_ok=True)
+        if exists(self._target + '.old'):
+            rmtree(self._target + '.old')
+        if exists(self._target):
+            rename(self._target, self._target + '.old')
+            rename(self._path, self._target)
+            rmtree(self._target + '.old')
+        else:
+            rename(self._path, self._target)
+
+
+def export(news_stream, output=_DEFAULT_OUTPUT, file_format='parquet',
+           batch_size=_BATCH_SIZE):
+    """
+    Args:
+        news_stream (iterable of dict) The analysed news
+        output (str) The output folder
+        file_format (str) `parquet` or `arrow`
+        batch_size (int) Rows per file
+    Returns:
+        (tuple of int) The news and entity rows written
+    """
+
+    assert file_format in ['parquet', 'arrow']
+    news_writer = _PartitionedWriter(join(output, 'news'), _NEWS_SCHEMA,
+                                     file_format, batch_size)
+    entities_writer = _PartitionedWriter(join(output, 'entities'),
+                                         _ENTITIES_SCHEMA, file_format,
+                                         batch_size)
+    for news in news_stream:
+        row, entity_rows = _news_rows(news)
+        partition = row['newsletter_date'].strftime('%Y-%m') \
+            if row['newsletter_date'] else 'unknown'
+        news_writer.append(partition, row)
+        for entity_row in entity_rows:
+            entities_writer.append(partition, entity_row)
+    news_writer.close()
+    entities_writer.close()
+    return news_writer.rows, entities_writer.rows
+
+
+def run(backend=None, output=_DEFAULT_OUTPUT, file_format='parquet',
+        include_text=True):
+    source_excludes = None if include_text else TEXT_FIELDS
+    news_stream = create_dao(backend).find_text_analysed(
+        source_excludes=source_excludes)
+    news_rows, entity_rows = export(news_stream, output, file_format)
+    _logger.info('Export done.', news=news_rows, entities=entity_rows,
+                 output=output)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Exports the analysed news.')
+    parser.add_argument('--backend', choices=BACKENDS,
+                        help='Defaults to the DAO_BACKEND variable.')
+    parser.add_argument('--output', default=_DEFAULT_OUTPUT)
+    parser.add_argument('--format', choices=['parquet', 'arrow'],
+                        default='parquet')
+    parser.add_argument('--no-text', action='store_true',
+                        help='Leaves out text_original and text_en.')
+    args = parser.parse_args()
+    run(args.backend, args.output, args.format, not args.no_text)
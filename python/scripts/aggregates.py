@@ -0,0 +1,213 @@
+"""Dashboard aggregates maintained incrementally.
+
+Counters are kept per dimension: entity name for each entity type, domain,
+language, near-duplicate cluster, newsletter date and sentiment
+histograms. Each news counts once
+per value. The contribution of each news is stored too, so a news analysed
+again replaces its previous counts instead of adding to them. Counters are
+indexed by count, a top-k query reads k rows.
+
+Usage, from the `python` folder:
+
+    python scripts/aggregates.py rebuild
+    python scripts/aggregates.py top entity:PERSON 20
+"""
+
+from json import dumps, loads
+from math import floor
+from sqlite_store import SqliteStore
+from sys import argv
+from threading import Lock
+
+_DEFAULT_PATH = '../cache/aggregates.sqlite'
+_SCORE_BUCKET = 0.1
+_MAGNITUDE_BUCKET = 1.0
+_REBUILD_BATCH = 1000
+
+
+def _bucket(value, size):
+    return '%.1f' % (floor(value / size + 1e-9) * size)
+
+
+def contribution(news):
+    """
+    Args:
+        news (dict) An analysed news
+    Returns:
+        (list of list) The [dimension, key] counted for the news
+    """
+
+    keys = set()
+    for entity in news.get('entities') or []:
+        if entity.get('name'):
+            keys.add(('entity:%s' % entity.get('type'), entity['name']))
+    for field in ['domain', 'language', 'duplicate_of']:
+        if news.get(field):
+            keys.add((field, news[field]))
+    if news.get('newsletter_date'):
+        keys.add(('newsletter_date', news['newsletter_date'][:10]))
+    if news.get('sentiment_score') is not None:
+        keys.add(('sentiment_score',
+                  _bucket(news['sentiment_score'], _SCORE_BUCKET)))
+    if news.get('sentiment_magnitude') is not None:
+        keys.add(('sentiment_magnitude',
+                  _bucket(news['sentiment_magnitude'], _MAGNITUDE_BUCKET)))
+    return sorted([dimension, key] for dimension, key in keys)
+
+
+class AggregateStore(SqliteStore):
+    _SCHEMA = ['CREATE TABLE IF NOT EXISTS counters ('
+               'dimension TEXT NOT NULL, '
+               'key TEXT NOT NULL, '
+               'count INTEGER NOT NULL, '
+               'PRIMARY KEY (dimension, key))',
+               'CREATE INDEX IF NOT EXISTS counters_top '
+               'ON counters (dimension, count DESC)',
+               'CREATE TABLE IF NOT EXISTS documents ('
+               'id TEXT PRIMARY KEY, '
+               'contribution TEXT NOT NULL)']
+
+    def __init__(self, path=_DEFAULT_PATH):
+        super().__init__(path)
+        self._lock = Lock()
+
+    @staticmethod
+    def _apply(connection, changes):
+        connection.executemany(
+            'INSERT INTO counters (dimension, key, count) VALUES (?, ?, ?) '
+            'ON CONFLICT (dimension, key) '
+            'DO UPDATE SET count = count + excluded.count',
+            [(dimension, key, count)
+             for (dimension, key), count in changes.items() if count])
+        # Only a decremented counter can drop to zero.
+        connection.executemany(
+            'DELETE FROM counters '
+            'WHERE dimension = ? AND key = ? AND count <= 0',
+            [(dimension, key)
+             for (dimension, key), count in changes.items() if count < 0])
+
+    def _transaction(self, function):
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(connection)
+                connection.execute('COMMIT')
+                return result
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+
+    def add(self, news):
+        """Counts an analysed news, replacing its previous counts."""
+
+        assert news['id'] is not None and len(news['id']) > 0
+        new = contribution(news)
+
+        def update(connection):
+            row = connection.execute(
+                'SELECT contribution FROM documents WHERE id = ?',
+                [news['id']]).fetchone()
+            old = loads(row[0]) if row is not None else []
+            if old == new:
+                return
+            changes = {}
+            for dimension, key in old:
+                changes[(dimension, key)] = changes.get(
+                    (dimension, key), 0) - 1
+            for dimension, key in new:
+                changes[(dimension, key)] = changes.get(
+                    (dimension, key), 0) + 1
+            self._apply(connection, changes)
+            connection.execute(
+                'INSERT OR REPLACE INTO documents (id, contribution) '
+                'VALUES (?, ?)', [news['id'], dumps(new)])
+
+        self._transaction(update)
+
+    def rebuild(self, news_stream):
+        """Replaces all the counters with the ones of the news stream.
+
+        Arguments:
+            news_stream (iterable of dict): The analysed news
+        Returns:
+            (int): The number of news counted
+        """
+
+        def clear(connection):
+            connection.execute('DELETE FROM counters')
+            connection.execute('DELETE FROM documents')
+
+        self._transaction(clear)
+        total = 0
+        batch = {}
+        for news in news_stream:
+            if not news.get('text_analysed'):
+                continue
+            batch[news['id']] = contribution(news)
+            if len(batch) >= _REBUILD_BATCH:
+                total += self._add_new(batch)
+                batch = {}
+        if batch:
+            total += self._add_new(batch)
+        return total
+
+    def _add_new(self, contributions):
+        changes = {}
+        for keys in contributions.values():
+            for dimension, key in keys:
+                changes[(dimension, key)] = changes.get(
+                    (dimension, key), 0) + 1
+
+        def insert(connection):
+            self._apply(connection, changes)
+            connection.executemany(
+                'INSERT OR REPLACE INTO documents (id, contribution) '
+                'VALUES (?, ?)', [(news_id, dumps(keys)) for news_id, keys
+                                  in contributions.items()])
+
+        self._transaction(insert)
+        return len(contributions)
+
+    def top(self, dimension, k=10):
+        """
+        Arguments:
+            dimension (str): For example `entity:PERSON`, `domain`,
+                `language`, `newsletter_date`, `sentiment_score`
+            k (int)
+        Returns:
+            (list of tuple): The (key, count) with the highest counts
+        """
+
+        return self._connect().execute(
+            'SELECT key, count FROM counters WHERE dimension = ? '
+            'ORDER BY count DESC LIMIT ?', [dimension, k]).fetchall()
+
+    def counts(self, dimension):
+        """Returns all the (key, count) of a dimension sorted by key."""
+
+        return self._connect().execute(
+            'SELECT key, count FROM counters WHERE dimension = ? '
+            'ORDER BY key', [dimension]).fetchall()
+
+    def dimensions(self):
+        return [row[0] for row in self._connect().execute(
+            'SELECT DISTINCT dimension FROM counters ORDER BY dimension')]
+
+
+if __name__ == '__main__':
+    store = AggregateStore()
+    if len(argv) > 1 and argv[1] == 'rebuild':
+        from dataset_dump import iter_news
+
+        dump = argv[2] if len(argv) > 2 else '../dataset/euvsdisinfo.tar.bz2'
+        from structured_log import get_logger
+
+        get_logger('aggregates').info(
+            'Aggregates rebuilt.', news=store.rebuild(iter_news(dump)))
+    elif len(argv) > 2 and argv[1] == 'top':
+        limit = int(argv[3]) if len(argv) > 3 else 10
+        for key, count in store.top(argv[2], limit):
+            print('%8d %s' % (count, key))
+    else:
+        print('Dimensions: [%s].' % ', '.join(store.dimensions()))
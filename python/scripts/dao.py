@@ -0,0 +1,519 @@
+"""Storage protocol shared by the Elasticsearch and Mongo backends.
+
+The writes are batch first: `save_new_links`, `save_text_analyses`,
+`save_errors` and `import_many` take lists and send them with bulk
+requests of at most `batch_size` documents. The single item methods are
+shortcuts for a batch of one. Inside `with dao.bulk():` the writes of all
+the threads are buffered together and sent when `batch_size` documents are
+waiting.
+
+The schema is not checked when a Dao is created, `init_schema` is run
+once per deployment:
+
+    python scripts/dao.py init
+
+`create_dao` builds the backend chosen by the environment, so the scripts
+switch backend or batch size without code changes:
+
+    DAO_BACKEND      elastic (default) or mongo
+    DAO_BATCH_SIZE   documents per bulk request, 500 by default
+    ELASTIC_URL      http://127.0.0.1:9200 by default
+    ELASTIC_LAYOUT   single (default) or partitioned, see index_layout.py
+    MONGO_URL        mongodb://localhost:27017 by default
+
+`AsyncDao` exposes the same methods as coroutines for asyncio code.
+"""
+
+from asyncio import get_running_loop
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataset_dump import HEAVY_FIELDS
+from functools import partial
+from os import environ
+from sys import argv
+from uuid import uuid4
+from zlib import crc32
+
+BACKENDS = ['elastic', 'mongo']
+_BATCH_SIZE = 500
+_ASYNC_THREADS = 4
+# Fields of the texts, by far the largest of a document.
+TEXT_FIELDS = ['text_original', 'text_en']
+# Fields not needed by the documents waiting for the text analysis.
+ANALYSIS_EXCLUDES = TEXT_FIELDS + ['entities']
+_END = object()
+
+
+# An entity found by an annotator.
+Entity = namedtuple('Entity', ['name', 'entity_type', 'salience',
+                               'wikipedia_url'])
+
+
+def slice_hash(news_id):
+    """The hash of a news id splitting the documents in slices.
+
+    Both backends store it in the `slice_hash` field of each document.
+    """
+
+    return crc32(str(news_id).encode('utf8'))
+
+
+def slice_range(slice_id, slices):
+    """
+    Arguments:
+        slice_id (int): The slice, in range [0, slices)
+        slices (int): Number of slices the documents are split into
+    Returns:
+        (tuple of int): The [start, end) range of the `slice_hash` of the
+            documents in the slice
+    """
+
+    assert 0 <= slice_id < slices
+    return (slice_id << 32) // slices, ((slice_id + 1) << 32) // slices
+
+
+def _entity_dict(entity):
+    return {'name': entity.name,
+            'type': entity.entity_type,
+            'salience': entity.salience,
+            'wikipedia_url': entity.wikipedia_url}
+
+
+class Dao(object):
+    """Base of the backends.
+
+    The backends implement `init_schema`, `_create_writer` and the
+    queries. The documents handled by the protocol always carry their
+    identifier as `id`.
+    """
+
+    def __init__(self, *, batch_size=_BATCH_SIZE, aggregates=None):
+        """
+        Arguments:
+            batch_size (int): Maximum number of documents per bulk request
+            aggregates (AggregateStore): When set, the counters are updated
+                with each text analysis once its write is confirmed
+        """
+
+        assert batch_size > 0
+        self.batch_size = batch_size
+        self._aggregates = aggregates
+        self._bulk_writer = None
+
+    def init_schema(self):
+        """Creates the indices, to be run once per deployment."""
+
+        raise NotImplementedError()
+
+    def _create_writer(self, **kwargs):
+        """
+        Returns:
+            (BulkWriter): A writer with `create`, `index`, `flush` and
+                `close` and the `sent`, `conflicts` and `errors` results.
+                `create` and `index` take an optional `on_written`
+                function, called without arguments once the write of the
+                document is confirmed
+        """
+
+        raise NotImplementedError()
+
+    @contextmanager
+    def bulk(self, **kwargs):
+        """Buffers the writes done inside the context.
+
+        The batch methods return None inside the context, the results are
+        collected by the writer and the aggregates are updated as the
+        flushes confirm the writes. The keyword arguments are passed to the
+        writer, `max_docs` defaults to the batch size.
+        """
+
+        assert self._bulk_writer is None, 'Bulk writer already open'
+        kwargs.setdefault('max_docs', self.batch_size)
+        writer = self._create_writer(**kwargs)
+        self._bulk_writer = writer
+        try:
+            yield writer
+        finally:
+            self._bulk_writer = None
+            writer.close()
+
+    def _write(self, action, documents, callbacks=None):
+        """
+        Arguments:
+            action (str): `create` skips the documents already present,
+                `index` replaces them
+            documents (list of dict)
+            callbacks (list of function): The `on_written` function of each
+                document, or None
+        Returns:
+            (dict): The number of documents `sent`, of documents already
+                present or changed since claimed (`conflicts`) and the
+                rejected items (`errors`), None inside a bulk context
+        """
+
+        writer = self._bulk_writer
+        if writer is not None:
+            self._add_all(writer, action, documents, callbacks)
+            return None
+        with self._create_writer(max_docs=self.batch_size) as writer:
+            self._add_all(writer, action, documents, callbacks)
+        return {'sent': writer.sent, 'conflicts': writer.conflicts,
+                'errors': writer.errors}
+
+    @staticmethod
+    def _add_all(writer, action, documents, callbacks=None):
+        for position, document in enumerate(documents):
+            kwargs = {}
+            # The version of a claimed news, see `claim_for_text_analysis`.
+            version = document.pop('_version', None)
+            if version is not None:
+                kwargs['version'] = version
+            if callbacks is not None and callbacks[position] is not None:
+                kwargs['on_written'] = callbacks[position]
+            getattr(writer, action)(document['id'], document, **kwargs)
+
+    @staticmethod
+    def _assert_written(result):
+        if result is not None and result['errors']:
+            error = result['errors'][0]
+            raise ValueError('Document [%s] rejected: [%d] [%r].' % (
+                error['id'], error['status'], error['error']))
+        return result
+
+    def save_new_links(self, links):
+        """
+        Arguments:
+            links (list of dict): The `short_url`, `full_url`, `domain`,
+                `skip` and `newsletter_date` (datetime) of each link
+        Returns:
+            (dict): See `_write`
+        """
+
+        documents = []
+        for link in links:
+            assert link['short_url'] is not None and len(link['short_url']) > 0
+            assert link['full_url'] is not None and len(link['full_url']) > 0
+            assert link['skip'] is not None
+            assert link['newsletter_date'] is not None
+            date_str = link['newsletter_date'].strftime('%Y-%m-%d')
+            documents.append({'id': str(uuid4()).replace('-', ''),
+                              'short_url': link['short_url'],
+                              'full_url': link['full_url'],
+                              'domain': link['domain'],
+                              'skip': link['skip'],
+                              'newsletter_date': date_str})
+        return self._write('create', documents)
+
+    def save_new_link(
+            self, *, short_url, full_url, domain, skip, newsletter_date):
+        self._assert_written(self.save_new_links([{
+            'short_url': short_url, 'full_url': full_url, 'domain': domain,
+            'skip': skip, 'newsletter_date': newsletter_date}]))
+
+    def save_text_analyses(self, analyses, *, allow_no_entities=False):
+        """
+        Arguments:
+            analyses (list of dict): The `news` dict as read from the
+                store, and the `text_original`, `authors` (comma separated),
+                `text_en`, `translator`, `language`, `sentiment_score`,
+                `sentiment_magnitude`, `entities` (list of Entity),
+                `extractor` and optional `duplicate_of` (the near-duplicate
+                cluster) and `on_saved` (function called with the news once
+                its write is confirmed) of each news
+            allow_no_entities (bool): Whether `entities` can be empty, for
+                the local annotator which finds no entity in some texts
+        Returns:
+            (dict): See `_write`
+        """
+
+        documents = []
+        callbacks = []
+        for analysis in analyses:
+            news = analysis['news']
+            assert news['short_url'] is not None and \
+                len(news['short_url']) > 0
+            assert news['id'] is not None and len(news['id']) > 0
+            assert analysis['text_original'] is not None and \
+                len(analysis['text_original']) > 0
+            assert analysis['text_en'] is not None and \
+                len(analysis['text_en']) > 0
+            assert analysis['language'] is not None and \
+                len(analysis['language']) > 0
+            assert analysis['entities'] or allow_no_entities and \
+                analysis['entities'] is not None, 'Missing entities'
+            for field in ['text_original', 'authors', 'text_en',
+                          'translator', 'language', 'sentiment_score',
+                          'sentiment_magnitude', 'extractor']:
+                news[field] = analysis[field]
+            news['entities'] = [_entity_dict(entity)
+                                for entity in analysis['entities']]
+            news['text_analysed'] = True
+            news.pop('claimed_by', None)
+            news.pop('lease_until', None)
+            if analysis.get('duplicate_of'):
+                news['duplicate_of'] = analysis['duplicate_of']
+            else:
+                news.pop('duplicate_of', None)
+            news.pop('error_message', None)
+            news.pop('error_class', None)
+            documents.append(news)
+            on_saved = analysis.get('on_saved')
+            callbacks.append(
+                partial(self._text_analysis_saved, news, on_saved)
+                if self._aggregates is not None or on_saved is not None
+                else None)
+        return self._write('index', documents, callbacks)
+
+    def _text_analysis_saved(self, news, on_saved):
+        # The counters only include the analyses actually stored, not the
+        # rejected ones nor the ones whose claim was lost.
+        if self._aggregates is not None:
+            self._aggregates.add(news)
+        if on_saved is not None:
+            on_saved(news)
+
+    def save_text_analysis(self, news, text_original, authors, text_en,
+                           translator, language, sentiment_score,
+                           sentiment_magnitude, entities, extractor,
+                           duplicate_of=None, on_saved=None):
+        self._assert_written(self.save_text_analyses([{
+            'news': news, 'text_original': text_original,
+            'authors': authors, 'text_en': text_en,
+            'translator': translator, 'language': language,
+            'sentiment_score': sentiment_score,
+            'sentiment_magnitude': sentiment_magnitude,
+            'entities': entities, 'extractor': extractor,
+            'duplicate_of': duplicate_of, 'on_saved': on_saved}]))
+
+    def save_errors(self, errors):
+        """
+        Arguments:
+            errors (list of dict): The `news` dict as read from the store,
+                and the `error_message` and `error_class` of each news
+        Returns:
+            (dict): See `_write`
+        """
+
+        documents = []
+        for error in errors:
+            news = error['news']
+            assert news['short_url'] is not None and \
+                len(news['short_url']) > 0
+            assert news['id'] is not None and len(news['id']) > 0
+            news.pop('text_analysed', None)
+            news.pop('claimed_by', None)
+            news.pop('lease_until', None)
+            news['error_message'] = error['error_message']
+            news['error_class'] = error['error_class']
+            documents.append(news)
+        return self._write('index', documents)
+
+    def save_error(self, *, news, error_message, error_class):
+        self._assert_written(self.save_errors([{
+            'news': news, 'error_message': error_message,
+            'error_class': error_class}]))
+
+    def import_many(self, news_list):
+        """Creates the documents not present yet.
+
+        Arguments:
+            news_list (list of dict): Documents with `_id` or `id`
+        Returns:
+            (dict): See `_write`
+        """
+
+        documents = []
+        for news in news_list:
+            news['id'] = str(news.pop('_id', None) or news['id'])
+            for field in HEAVY_FIELDS:
+                news.pop(field, None)
+            documents.append(news)
+        return self._write('create', documents)
+
+    def import_news(self, news):
+        self._assert_written(self.import_many([news]))
+
+    def find_existing_urls(self, *, short_urls=(), full_urls=()):
+        """Checks many urls with a single query.
+
+        Arguments:
+            short_urls (iterable of str)
+            full_urls (iterable of str)
+        Returns:
+            (tuple of set): The short urls and the full urls already stored
+        """
+
+        raise NotImplementedError()
+
+    def exists_short_url(self, *, short_url):
+        assert short_url is not None
+        return short_url in self.find_existing_urls(short_urls=[short_url])[0]
+
+    def exists_full_url(self, *, full_url):
+        assert full_url is not None
+        return full_url in self.find_existing_urls(full_urls=[full_url])[1]
+
+    def find_for_text_analysis(self, include_errors=False, *, page_size=None,
+                               slice_id=None, slices=None):
+        """Streams the documents waiting for the text analysis.
+
+        Arguments:
+            include_errors (boolean): Includes the documents in error
+            page_size (int): Documents per page
+            slice_id (int): The slice to read, in range [0, slices)
+            slices (int): Number of workers splitting the documents
+        Returns:
+            (generator of dict): The documents, without the text fields
+        """
+
+        raise NotImplementedError()
+
+    def claim_for_text_analysis(self, worker_id, *, count, lease_seconds,
+                                include_errors=False, slice_id=None,
+                                slices=None, exclude_ids=()):
+        """Claims news waiting for the text analysis, see leases.py.
+
+        The news not claimed or with an expired lease are claimed with
+        conditional updates, the ones claimed meanwhile by another worker
+        are skipped.
+
+        Arguments:
+            worker_id (str)
+            count (int): Maximum number of news claimed
+            lease_seconds (int)
+            include_errors (boolean): Includes the documents in error
+            slice_id (int): The slice to read, in range [0, slices)
+            slices (int): Number of workers splitting the documents
+            exclude_ids (iterable of str): News not claimed, for example
+                the ones the worker failed to process
+        Returns:
+            (list of dict): The claimed documents, without the text fields,
+                with the `_version` of the claim
+        """
+
+        raise NotImplementedError()
+
+    def renew_claims(self, news_list, worker_id, *, lease_seconds):
+        """Extends the leases of claimed news.
+
+        Arguments:
+            news_list (list of dict): Claimed news, their `_version` is
+                updated
+            worker_id (str)
+            lease_seconds (int)
+        Returns:
+            (list of dict): The news whose lease was lost
+        """
+
+        raise NotImplementedError()
+
+    def release_claims(self, news_list, *, retry_after=0):
+        """Gives back claimed news not processed.
+
+        Arguments:
+            news_list (list of dict): Claimed news
+            retry_after (float): Seconds before the news can be claimed
+                again, kept in their `lease_until`
+        """
+
+        raise NotImplementedError()
+
+    def find_text_analysed(self, *, page_size=None, source_excludes=None):
+        """Streams the documents with a completed text analysis.
+
+        Arguments:
+            page_size (int): Documents per page
+            source_excludes (list of str): Fields not returned
+        Returns:
+            (generator of dict): The documents
+        """
+
+        raise NotImplementedError()
+
+
+class AsyncDao(object):
+    """Runs the methods of a Dao in a thread pool, for asyncio code.
+
+    The methods are coroutines with the arguments of the Dao ones, the
+    `find_*` streams are async generators. `bulk` is not available, open
+    it on the wrapped Dao.
+    """
+
+    _STREAMS = ['find_for_text_analysis', 'find_text_analysed']
+
+    def __init__(self, dao, executor=None):
+        """
+        Arguments:
+            dao (Dao)
+            executor (Executor): Runs the calls, by default a pool of
+                threads owned by this AsyncDao
+        """
+
+        self.dao = dao
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(_ASYNC_THREADS)
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown()
+
+    def __getattr__(self, name):
+        if name == 'bulk' or name.startswith('_'):
+            raise AttributeError(name)
+        method = getattr(self.dao, name)
+        if not callable(method):
+            return method
+        if name in self._STREAMS:
+            return partial(self._stream, method)
+
+        async def call(*args, **kwargs):
+            return await get_running_loop().run_in_executor(
+                self._executor, partial(method, *args, **kwargs))
+
+        return call
+
+    async def _stream(self, method, *args, **kwargs):
+        loop = get_running_loop()
+        iterator = iter(method(*args, **kwargs))
+        while True:
+            item = await loop.run_in_executor(self._executor, next,
+                                              iterator, _END)
+            if item is _END:
+                return
+            yield item
+
+
+def create_dao(backend=None, *, batch_size=None, **kwargs):
+    """Builds the backend set by the environment, see the module doc.
+
+    Arguments:
+        backend (str): Overrides `DAO_BACKEND`
+        batch_size (int): Overrides `DAO_BATCH_SIZE`
+        kwargs (dict): Passed to the backend, for example `aggregates`
+    Returns:
+        (Dao)
+    """
+
+    backend = backend or environ.get('DAO_BACKEND', 'elastic')
+    if batch_size is None:
+        batch_size = int(environ.get('DAO_BATCH_SIZE', _BATCH_SIZE))
+    if backend == 'elastic':
+        from dao_elastic import DaoElastic
+
+        return DaoElastic(base_host=environ.get('ELASTIC_URL'),
+                          batch_size=batch_size, **kwargs)
+    if backend == 'mongo':
+        from dao_mongo import DaoMongo
+
+        return DaoMongo(url=environ.get('MONGO_URL'), batch_size=batch_size,
+                        **kwargs)
+    raise ValueError('Unknown backend [%s], expected one of [%s].' % (
+        backend, ', '.join(BACKENDS)))
+
+
+if __name__ == '__main__':
+    if len(argv) > 1 and argv[1] == 'init':
+        create_dao(argv[2] if len(argv) > 2 else None).init_schema()
+    else:
+        print('Usage: python scripts/dao.py init [elastic|mongo]')
@@ -1,16 +1,213 @@
-from datetime import datetime
-from json import load
-from requests import get, head, post, put
-from urllib.parse import quote_plus
-from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+from dao import ANALYSIS_EXCLUDES, Dao, slice_hash, slice_range
+from datetime import date
+from functools import partial
+from http_pool import delete, get, head, post, put
+from index_layout import create_layout
+from json import dumps, load
+from metrics import timed
+from os import environ
+from random import shuffle
+from structured_log import get_logger
+from threading import Lock, Timer
+from time import time
 
+_logger = get_logger('elastic')
 
-class DaoElastic(object):
+
+class BulkWriter(object):
+    """Buffers documents and sends them through the `_bulk` endpoint.
+
+    The buffer is flushed when it holds `max_docs` actions, when its payload
+    exceeds `max_bytes` or `max_seconds` after the first buffered action.
+    Items rejected by Elasticsearch are collected in `errors`, `create`
+    actions on already present documents and `index` actions on documents
+    changed since their version was read (409) are counted in `conflicts`.
+    The `on_written` function of a document is called, outside of the
+    writer lock, once a flush confirmed its write. Each document is stored
+    with the `slice_hash` of its id, see DaoElastic.
+
+    With a layout each document is written in the indices chosen by the
+    layout, the counts only consider its primary part, see index_layout.py.
+    The other parts of a versioned document are only sent once its primary
+    part is written, so a lost claim does not overwrite the texts saved by
+    the worker holding it.
+    """
+
+    def __init__(self, base_url, *, layout=None, max_docs=500,
+                 max_bytes=5 * 1024 * 1024, max_seconds=5.0):
+        """
+        Arguments:
+            base_url (str): The index/type url, for example
+                http://127.0.0.1:9200/unfact/news
+            layout (SingleLayout or PartitionedLayout): Splits the
+                documents, all of them are sent to the index of the url
+                by default
+            max_docs (int): Maximum number of buffered actions
+            max_bytes (int): Maximum size of the buffered payload
+            max_seconds (float): Maximum age of the buffered actions
+        """
+
+        assert max_docs > 0
+        assert max_bytes > 0
+        assert max_seconds > 0
+        self._url = base_url + '/_bulk'
+        self._layout = layout
+        self._max_docs = max_docs
+        self._max_bytes = max_bytes
+        self._max_seconds = max_seconds
+        self._lines = []
+        # Whether each buffered action is the primary part of a document.
+        self._primaries = []
+        # The `on_written` function of each buffered action, or None.
+        self._callbacks = []
+        # The functions of the confirmed writes, not called yet.
+        self._written = []
+        self._size = 0
+        self._timer = None
+        self._lock = Lock()
+        self.sent = 0
+        self.conflicts = 0
+        self.errors = []
+
+    def create(self, doc_id, document, on_written=None):
+        """Buffers a document which must not exist yet."""
+
+        self._add('create', doc_id, document, on_written=on_written)
+
+    def index(self, doc_id, document, version=None, on_written=None):
+        """Buffers a document which replaces any previous version.
+
+        With a `version` the document is only replaced when its current
+        version is still the same.
+        """
+
+        self._add('index', doc_id, document, version, on_written)
+
+    def _add(self, action, doc_id, document, version=None, on_written=None):
+        assert doc_id is not None and len(doc_id) > 0
+        document = dict(document, slice_hash=slice_hash(doc_id))
+        if self._layout is None:
+            parts = [(None, document, True)]
+        else:
+            parts = self._layout.split(document)
+        if version is not None and len(parts) > 1:
+            secondary = [part for part in parts if not part[2]]
+            parts = [part for part in parts if part[2]]
+            on_written = partial(self._primary_written, action, doc_id,
+                                 secondary, on_written)
+        self._add_parts(action, doc_id, parts, version, on_written)
+
+    def _primary_written(self, action, doc_id, secondary, on_written):
+        self._add_parts(action, doc_id, secondary)
+        if on_written is not None:
+            on_written()
+
+    def _add_parts(self, action, doc_id, parts, version=None,
+                   on_written=None):
+        lines = []
+        for index, source, primary in parts:
+            metadata = {'_id': doc_id}
+            if index is not None:
+                metadata['_index'] = index
+            if version is not None and primary:
+                metadata['_version'] = version
+            lines.append(dumps({action: metadata}))
+            lines.append(dumps(source))
+        with self._lock:
+            self._lines.extend(lines)
+            self._primaries.extend(primary for _, _, primary in parts)
+            self._callbacks.extend(on_written if primary else None
+                                   for _, _, primary in parts)
+            self._size += sum(len(line) + 1 for line in lines)
+            if len(self._lines) // 2 >= self._max_docs \
+                    or self._size >= self._max_bytes:
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = Timer(self._max_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        self._notify()
+
+    def flush(self):
+        """Sends the buffered actions.
+
+        Returns:
+            (list of dict): The items rejected in this flush
+        """
+
+        with self._lock:
+            errors = self._flush_locked()
+        self._notify()
+        return errors
+
+    def _notify(self):
+        """Calls the `on_written` functions of the confirmed writes."""
+
+        with self._lock:
+            written = self._written
+            self._written = []
+        for on_written in written:
+            on_written()
+
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._lines:
+            return []
+        body = '\n'.join(self._lines) + '\n'
+        primaries = self._primaries
+        callbacks = self._callbacks
+        self._lines = []
+        self._primaries = []
+        self._callbacks = []
+        self._size = 0
+        with timed('es_save', provider='elastic', method='bulk'):
+            response = post(self._url, data=body.encode('utf8'),
+                            headers={'Content-Type': 'application/x-ndjson'})
+            data = DaoElastic._assert_response(response).json()
+        errors = []
+        for item, primary, on_written in zip(data['items'], primaries,
+                                             callbacks):
+            action, result = next(iter(item.items()))
+            if result['status'] in [200, 201]:
+                self.sent += primary
+                if on_written is not None:
+                    self._written.append(on_written)
+            elif result['status'] == 409:
+                self.conflicts += primary
+            else:
+                errors.append({'id': result['_id'],
+                               'status': result['status'],
+                               'error': result.get('error')})
+        self.errors.extend(errors)
+        return errors
+
+    def close(self):
+        self.flush()
+        # The flushes buffer the parts sent after their primary part.
+        while True:
+            with self._lock:
+                if not self._lines:
+                    return
+            self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DaoElastic(Dao):
     _INDEX = 'unfact'
     _TYPE = 'news'
-    _MAX_FETCH_SIZE = 300
+    _PAGE_SIZE = 300
+    _SCROLL_TIMEOUT = '5m'
     _BASE_HOST = 'http://127.0.0.1:9200'
     _MAPPING_FILE = '../resources/mapping.json'
+    _LAYOUT_VARIABLE = 'ELASTIC_LAYOUT'
 
     @staticmethod
     def _assert_response(response):
@@ -19,156 +216,334 @@ class DaoElastic(object):
                 response.status_code, response.json())
         return response
 
-    def __init__(self, base_host=None):
-        self._base_host = self._BASE_HOST if base_host is None else base_host
-        self._base_index = self._base_host + '/' + self._INDEX
+    def __init__(self, base_host=None, *, layout=None, **kwargs):
+        """
+        Arguments:
+            base_host (str)
+            layout (str): `single` or `partitioned`, see index_layout.py,
+                by default the `ELASTIC_LAYOUT` environment variable
+            kwargs (dict): See Dao
+        """
+
+        super().__init__(**kwargs)
+        self.layout = create_layout(
+            layout or environ.get(self._LAYOUT_VARIABLE), self._INDEX)
+        self.index = self.layout.index
+        self.base_host = base_host or self._BASE_HOST
+        self._base_index = self.base_host + '/' + self.index
         self._base_url = self._base_index + '/' + self._TYPE
-        self._init_schema()
-
-    def _init_schema(self):
-        """Sets up the index schema."""
-
-        response = head('%s/_mapping/%s' % (self._base_index, self._TYPE))
-        if response.status_code == 404:
-            print('Index not found, creating mapping.')
-            with open(self._MAPPING_FILE) as file:
-                json = load(file)
-                response = put(self._base_index, json=json)
-                self._assert_response(response)
-        elif response.status_code != 200:
-            raise ValueError('Connection error to [%s]: [%r]' % (
-                self._base_url, response.text))
-
-    def save_new_link(
-            self, *, short_url, full_url, domain, skip, newsletter_date):
+
+    def init_schema(self):
+        """Creates the missing index, or the partition templates.
+
+        The documents stored without `slice_hash`, before the sliced
+        claims, get it.
         """
+
+        if self.layout.name == 'partitioned':
+            self.put_templates()
+        else:
+            response = head('%s/_mapping/%s' % (self._base_index,
+                                                 self._TYPE))
+            if response.status_code == 404:
+                _logger.info('Index not found, creating mapping.',
+                             index=self._base_index)
+                with open(self._MAPPING_FILE) as file:
+                    json = load(file)
+                    response = put(self._base_index, json=json)
+                    self._assert_response(response)
+            elif response.status_code != 200:
+                raise ValueError('Connection error to [%s]: [%r]' % (
+                    self._base_url, response.text))
+        self._add_slice_hashes()
+
+    def _add_slice_hashes(self):
+        query = {'constant_score': {'filter': {'bool': {'must_not': {
+            'exists': {'field': 'slice_hash'}}}}}}
+        lines = []
+        for news in self.scroll(query, source_excludes=ANALYSIS_EXCLUDES):
+            lines.append(dumps({'update': {
+                '_index': self.layout.index_of(news), '_id': news['id']}}))
+            lines.append(dumps({'doc': {'slice_hash': slice_hash(
+                news['id'])}}))
+            if len(lines) >= 2 * self.batch_size:
+                self._post_bulk(lines, 'slice_hash')
+                lines = []
+        if lines:
+            self._post_bulk(lines, 'slice_hash')
+
+    def is_single_index(self):
+        """Whether the index exists and is not the alias of partitions."""
+
+        if head(self._base_index).status_code != 200:
+            return False
+        return head('%s/_alias/%s' % (
+            self.base_host, self.index)).status_code == 404
+
+    def put_templates(self, aliases=True):
+        """Installs the index templates of the partitioned layout.
+
+        With the aliases, the partitions of the current month are created
+        so the aliases exist before the first write.
+
         Arguments:
-            short_url (str)
-            full_url (str)
-            domain (str)
-            skip (boolean)
-            newsletter_date (datetime)
+            aliases (boolean): See PartitionedLayout.templates
         """
 
-        assert short_url is not None and len(short_url) > 0
-        assert full_url is not None and len(full_url) > 0
-        assert skip is not None
-        assert newsletter_date is not None
-        date_str = newsletter_date.strftime('%Y-%m-%d')
-        news_id = str(uuid4()).replace('-', '')
-        url = '%s/%s/_create' % (self._base_url, news_id)
-        response = post(url, json={'id': news_id,
-                                   'short_url': short_url,
-                                   'full_url': full_url,
-                                   'domain': domain,
-                                   'skip': skip,
-                                   'newsletter_date': date_str})
-        self._assert_response(response)
-
-    def exists_short_url(self, *, short_url):
-        assert short_url is not None
-        url = '%s/_search' % self._base_url
-        query = {'query': {'constant_score': {'filter': {
-            'term': {'short_url': short_url}}}}}
-        response = get(url, json=query)
-        self._assert_response(response)
-        return response.json()['hits']['total'] > 0
-
-    def exists_full_url(self, *, full_url):
-        assert full_url is not None
-        url = '%s/_search' % self._base_url
-        query = {'query': {'constant_score': {'filter': {
-            'term': {'full_url': full_url}}}}}
-        response = get(url, json=query)
-        self._assert_response(response)
-        return response.json()['hits']['total'] > 0
-
-    def save_text_analysis(self, news, text_original, authors, text_en,
-                           translator, language, sentiment_score,
-                           sentiment_magnitude, entities, extractor):
+        assert self.layout.name == 'partitioned'
+        if aliases and self.is_single_index():
+            raise ValueError('The single index [%s] exists, migrate it with '
+                             'index_layout.py.' % self._base_index)
+        for name, template in self.layout.templates(aliases).items():
+            self._assert_response(put('%s/_template/%s' % (
+                self.base_host, name), json=template))
+        if not aliases:
+            return
+        current = {'newsletter_date': date.today().isoformat()}
+        for index in [self.layout.index_of(current),
+                      self.layout.text_index_of(current)]:
+            url = '%s/%s' % (self.base_host, index)
+            if head(url).status_code == 404:
+                _logger.info('Partition not found, creating it.', index=url)
+                self._assert_response(put(url))
+
+    def count(self, target=None):
         """
         Arguments:
-            news (dict): The complete news object
-            text_original (str)
-            authors (str): Comma separated list of authors
-            text_en (str)
-            translator (str)
-            language (str)
-            sentiment_score (str)
-            sentiment_magnitude (str)
-            entities (list of obj)
-            extractor (str)
+            target (str): An index, alias or pattern, the index read by
+                default
+        Returns:
+            (int): The number of documents
         """
 
-        assert news['short_url'] is not None and len(news['short_url']) > 0
-        assert news['id'] is not None and len(news['id']) > 0
-        assert text_original is not None and len(text_original) > 0
-        assert text_en is not None and len(text_en) > 0
-        assert language is not None and len(language) > 0
-        assert entities, 'Missing entities'
-        entities_dict = [{'name': entity.name,
-                          'type': entity.entity_type,
-                          'salience': entity.salience,
-                          'wikipedia_url': entity.wikipedia_url}
-                         for entity in entities]
-        news['text_original'] = text_original
-        news['authors'] = authors
-        news['text_en'] = text_en
-        news['translator'] = translator
-        news['language'] = language
-        news['sentiment_score'] = sentiment_score
-        news['sentiment_magnitude'] = sentiment_magnitude
-        news['entities'] = entities_dict
-        news['extractor'] = extractor
-        url = '%s/%s' % (self._base_url, news['id'])
-        response = put(url, json=news)
-        self._assert_response(response)
-
-    def save_error(self, *, news, error_message, error_class):
+        with timed('es_query', provider='elastic', method='search'):
+            response = post('%s/%s/_search' % (
+                self.base_host, target or self.index), json={'size': 0})
+            data = self._assert_response(response).json()
+        return data['hits']['total']
+
+    def _create_writer(self, **kwargs):
+        return BulkWriter(self._base_url, layout=self.layout, **kwargs)
+
+    def find_existing_urls(self, *, short_urls=(), full_urls=()):
+        short_urls = list(set(short_urls))
+        full_urls = list(set(full_urls))
+        if not short_urls and not full_urls:
+            return set(), set()
+        should = []
+        aggs = {}
+        for field, values in [('short_url', short_urls),
+                              ('full_url', full_urls)]:
+            if values:
+                should.append({'terms': {field: values}})
+                aggs[field] = {'terms': {'field': field,
+                                         'include': values,
+                                         'size': len(values)}}
+        query = {'size': 0,
+                 'query': {'constant_score': {'filter': {'bool': {
+                     'should': should}}}},
+                 'aggs': aggs}
+        with timed('es_query', provider='elastic', method='search'):
+            response = get('%s/_search' % self._base_url, json=query)
+            data = self._assert_response(response).json()
+        aggregations = data.get('aggregations', {})
+        return tuple({bucket['key'] for bucket in
+                      aggregations[field]['buckets']}
+                     if field in aggregations else set()
+                     for field in ['short_url', 'full_url'])
+
+    def _post_bulk(self, lines, method):
+        with timed('es_save', provider='elastic', method=method):
+            response = post('%s/_bulk' % self._base_url,
+                            data=('\n'.join(lines) + '\n').encode('utf8'),
+                            headers={'Content-Type': 'application/x-ndjson'})
+            return self._assert_response(response).json()
+
+    @staticmethod
+    def _slice_filter(slice_id, slices):
+        # The slices split the documents by ranges of the hash of their id,
+        # a plain search does not accept the `slice` of the scrolls.
+        if slices is None or slices <= 1:
+            return []
+        start, end = slice_range(slice_id, slices)
+        return [{'range': {'slice_hash': {'gte': start, 'lt': end}}}]
+
+    @staticmethod
+    def _lease_until(lease_seconds):
+        return int((time() + lease_seconds) * 1000)
+
+    def _update_versioned(self, news_list, document):
+        """Updates claimed news, each only if its version did not change.
+
+        Returns:
+            (list of dict): The news updated, with their new `_version`
         """
+
+        if not news_list:
+            return []
+        lines = []
+        for news in news_list:
+            lines.append(dumps({'update': {
+                '_index': self.layout.index_of(news), '_id': news['id'],
+                '_version': news['_version']}}))
+            lines.append(dumps({'doc': document}))
+        data = self._post_bulk(lines, 'claim')
+        updated = []
+        for news, item in zip(news_list, data['items']):
+            result = item['update']
+            if result['status'] in [200, 201]:
+                news['_version'] = result['_version']
+                updated.append(news)
+            elif result['status'] != 409:
+                _logger.error('Claim not updated.', id=news['id'],
+                              status=result['status'],
+                              error=result.get('error'))
+        return updated
+
+    def claim_for_text_analysis(self, worker_id, *, count, lease_seconds,
+                                include_errors=False, slice_id=None,
+                                slices=None, exclude_ids=()):
+        assert count > 0
+        must_not = [{'term': {'skip': 'true'}},
+                    {'term': {'text_analysed': 'true'}}]
+        if not include_errors:
+            must_not.append({'exists': {'field': 'error_class'}})
+        if exclude_ids:
+            must_not.append({'ids': {'values': list(exclude_ids)}})
+        claimable = [{'bool': {'must_not': {'exists': {
+                         'field': 'lease_until'}}}},
+                     {'range': {'lease_until': {
+                         'lt': self._lease_until(0)}}}]
+        # More candidates than needed are read and shuffled, so concurrent
+        # workers seldom try to claim the same news.
+        body = {'size': count * 4, 'version': True,
+                '_source': {'excludes': ANALYSIS_EXCLUDES + ['slice_hash']},
+                'query': {'constant_score': {'filter': {'bool': {
+                    'filter': self._slice_filter(slice_id, slices),
+                    'must_not': must_not, 'should': claimable}}}}}
+        with timed('es_query', provider='elastic', method='search'):
+            response = post('%s/_search' % self._base_url, json=body)
+            data = self._assert_response(response).json()
+        candidates = []
+        for hit in data['hits']['hits']:
+            news = hit['_source']
+            news['_version'] = hit['_version']
+            candidates.append(news)
+        shuffle(candidates)
+        claimed = []
+        while candidates and len(claimed) < count:
+            batch = candidates[:count - len(claimed)]
+            candidates = candidates[len(batch):]
+            claimed.extend(self._update_versioned(batch, {
+                'claimed_by': worker_id,
+                'lease_until': self._lease_until(lease_seconds)}))
+        for news in claimed:
+            news.pop('claimed_by', None)
+            news.pop('lease_until', None)
+        return claimed
+
+    def renew_claims(self, news_list, worker_id, *, lease_seconds):
+        renewed = self._update_versioned(news_list, {
+            'claimed_by': worker_id,
+            'lease_until': self._lease_until(lease_seconds)})
+        renewed_ids = {news['id'] for news in renewed}
+        return [news for news in news_list if news['id'] not in renewed_ids]
+
+    def release_claims(self, news_list, *, retry_after=0):
+        self._update_versioned(news_list, {
+            'claimed_by': None,
+            'lease_until': self._lease_until(retry_after)
+            if retry_after > 0 else None})
+
+    def _scroll_page(self, url, body):
+        with timed('es_query', provider='elastic', method='scroll'):
+            response = post(url, json=body)
+            data = self._assert_response(response).json()
+        return data['_scroll_id'], data['hits']['hits']
+
+    def scroll(self, query, *, page_size=None, source_excludes=None):
+        """Streams all the documents matching a query with the scroll api.
+
+        The next page is requested in background while the current one is
+        consumed, at most one page is prefetched.
+
         Arguments:
-            news (dict): The complete news object
-            error_message (str)
-            error_class (str)
+            query (dict): The query clause
+            page_size (int): Documents per page
+            source_excludes (list of str): Fields not returned
+        Returns:
+            (generator of dict): The documents source
         """
 
-        assert news['short_url'] is not None and len(news['short_url']) > 0
-        assert news['id'] is not None and len(news['id']) > 0
-        if 'text_analysed' in news:
-            del news['text_analysed']
-        news['error_message'] = error_message
-        news['error_class'] = error_class
-        url = '%s/%s' % (self._base_url, news['id'])
-        response = put(url, json=news)
-        self._assert_response(response)
-
-    def import_news(self, news):
-        news['id'] = str(news.pop('_id'))
-        if 'tokens' in news:
-            del news['tokens']
-        if 'sentences' in news:
-            del news['sentences']
-        url = '%s/%s/_create' % (self._base_url, news['id'])
-        response = put(url, json=news)
-        if response.status_code == 409:
-            print('Document [%s] was already present.', news['id'])
-            return
-        else:
-            self._assert_response(response)
+        page_size = self._PAGE_SIZE if page_size is None else page_size
+        assert page_size > 0
+        body = {'size': page_size, 'sort': ['_doc'], 'query': query}
+        if source_excludes:
+            body['_source'] = {'excludes': source_excludes}
+        scroll_url = '%s/_search/scroll' % self.base_host
+        scroll_id = None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                scroll_id, hits = self._scroll_page(
+                    '%s/_search?scroll=%s' % (
+                        self._base_url, self._SCROLL_TIMEOUT), body)
+                while hits:
+                    next_page = executor.submit(
+                        self._scroll_page, scroll_url,
+                        {'scroll': self._SCROLL_TIMEOUT,
+                         'scroll_id': scroll_id})
+                    for hit in hits:
+                        hit['_source'].pop('slice_hash', None)
+                        yield hit['_source']
+                    scroll_id, hits = next_page.result()
+            finally:
+                if scroll_id is not None:
+                    delete(scroll_url, json={'scroll_id': [scroll_id]})
 
-    def find_for_text_analysis(self, include_errors=False):
+    def find_for_text_analysis(self, include_errors=False, *, page_size=None,
+                               slice_id=None, slices=None):
         must_not = [{'term': {'skip': 'true'}},
                     {'term': {'text_analysed': 'true'}}]
         if not include_errors:
             must_not.append({'exists': {'field': 'error_class'}})
-        query = {'size': self._MAX_FETCH_SIZE,
-                 'query':
-                     {'constant_score': {'filter': {'bool': {
-                         'must_not': must_not}}}}}
-        response = get('%s/_search' % self._base_url, json=query)
-        data = self._assert_response(response).json()
-        if data['hits']['total'] > 0:
-            for hit in data['hits']['hits']:
-                yield hit['_source']
-        else:
-            return []
+        query = {'constant_score': {'filter': {'bool': {
+            'filter': self._slice_filter(slice_id, slices),
+            'must_not': must_not}}}}
+        return self.scroll(query, page_size=page_size,
+                           source_excludes=ANALYSIS_EXCLUDES)
+
+    def find_text_analysed(self, *, page_size=None, source_excludes=None):
+        page_size = self._PAGE_SIZE if page_size is None else page_size
+        query = {'constant_score': {'filter': {
+            'term': {'text_analysed': 'true'}}}}
+        news_stream = self.scroll(query, page_size=page_size,
+                                  source_excludes=source_excludes)
+        fields = [field for field in self.layout.joined_fields
+                  if field not in (source_excludes or [])]
+        if not fields:
+            return news_stream
+        return self._join_texts(news_stream, fields, page_size)
+
+    def _join_texts(self, news_stream, fields, page_size):
+        """Adds the fields stored in the text partitions, page by page."""
+
+        page = []
+        for news in news_stream:
+            page.append(news)
+            if len(page) >= page_size:
+                yield from self._with_texts(page, fields)
+                page = []
+        if page:
+            yield from self._with_texts(page, fields)
+
+    def _with_texts(self, page, fields):
+        body = {'size': len(page), '_source': fields,
+                'query': {'ids': {'values': [news['id'] for news in page]}}}
+        with timed('es_query', provider='elastic', method='search'):
+            response = post('%s/%s/_search' % (
+                self.base_host, self.layout.text_alias), json=body)
+            data = self._assert_response(response).json()
+        texts = {hit['_id']: hit['_source'] for hit in data['hits']['hits']}
+        for news in page:
+            news.update(texts.get(news['id'], {}))
+        return page
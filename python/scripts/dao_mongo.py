@@ -1,104 +1,320 @@
-from datetime import datetime
-from pymongo import MongoClient
+from bson import ObjectId
+from bson.errors import InvalidId
+from dao import ANALYSIS_EXCLUDES, Dao, slice_hash, slice_range
+from datetime import datetime, timedelta
+from metrics import timed
+from pymongo import InsertOne, MongoClient, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from random import shuffle
+from threading import Lock, Timer
 
+_DUPLICATE_KEY = 11000
+_URL = 'mongodb://localhost:27017'
+_PAGE_SIZE = 300
 
-class DaoMongo(object):
-    def __init__(self):
-        client = MongoClient('localhost', 27017)
-        db = client.fakeko
-        self._collection = db['news']
-        self._collection.create_index('short_url', unique=True)
-        self._collection.create_index('full_url', unique=True)
 
-    def save_new_link(
-            self, *, short_url, full_url, domain, skip, newsletter_date):
-        """
-        Arguments:
-            short_url (str)
-            full_url (str)
-            domain (str)
-            skip (boolean)
-            newsletter_date (datetime)
+def _object_id(news_id):
+    try:
+        return ObjectId(news_id)
+    except InvalidId:
+        return news_id
+
+
+def _news(document):
+    document['id'] = str(document.pop('_id'))
+    document.pop('slice_hash', None)
+    return document
+
+
+def _stored(doc_id, document):
+    """The document as stored, with its `_id` and `slice_hash`."""
+
+    stored = {key: value for key, value in document.items() if key != 'id'}
+    stored['_id'] = _object_id(doc_id)
+    stored['slice_hash'] = slice_hash(stored['_id'])
+    return stored
+
+
+class _MongoBulkWriter(object):
+    """Buffers documents and sends them with `bulk_write`.
+
+    Same interface as the Elasticsearch BulkWriter: the buffer is flushed
+    when it holds `max_docs` operations or `max_seconds` after the first
+    buffered one, `create` actions on already present documents are counted
+    in `conflicts` and the other rejected items are collected in `errors`.
+    `max_bytes` is accepted and ignored, the driver splits the batches.
+
+    The version of a claimed news is the worker holding it, see
+    `DaoMongo.claim_for_text_analysis`: its document is only replaced while
+    still claimed by the worker. The replacement is an upsert filtered on
+    the claim, so a lost claim fails with a duplicate `_id` and is counted
+    in `conflicts`.
+    """
+
+    def __init__(self, collection, *, max_docs=500, max_seconds=5.0,
+                 **kwargs):
+        assert max_docs > 0
+        assert max_seconds > 0
+        self._collection = collection
+        self._max_docs = max_docs
+        self._max_seconds = max_seconds
+        # The (operation, id, whether a duplicate key is a conflict,
+        # on_written function) of each buffered document.
+        self._buffer = []
+        # The functions of the confirmed writes, not called yet.
+        self._written = []
+        self._timer = None
+        self._lock = Lock()
+        self.sent = 0
+        self.conflicts = 0
+        self.errors = []
+
+    def create(self, doc_id, document, on_written=None):
+        """Buffers a document which must not exist yet."""
+
+        self._add(InsertOne(_stored(doc_id, document)), doc_id, True,
+                  on_written)
+
+    def index(self, doc_id, document, version=None, on_written=None):
+        """Buffers a document which replaces any previous version."""
+
+        query = {'_id': _object_id(doc_id)}
+        if version is not None:
+            query['claimed_by'] = version
+        self._add(ReplaceOne(query, _stored(doc_id, document), upsert=True),
+                  doc_id, version is not None, on_written)
+
+    def _add(self, operation, doc_id, conflicting, on_written):
+        with self._lock:
+            self._buffer.append((operation, doc_id, conflicting, on_written))
+            if len(self._buffer) >= self._max_docs:
+                self._flush_locked()
+            elif self._timer is None:
+                self._timer = Timer(self._max_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        self._notify()
+
+    def flush(self):
+        """Sends the buffered operations.
+
+        Returns:
+            (list of dict): The items rejected in this flush
         """
-        assert short_url is not None and len(short_url) > 0
-        assert full_url is not None and len(full_url) > 0
-        assert skip is not None
-        assert newsletter_date is not None
-        date_str = newsletter_date.strftime('%Y-%m-%d')
-        self._collection.insert_one({'short_url': short_url,
-                                     'full_url': full_url,
-                                     'domain': domain,
-                                     'skip': skip,
-                                     'newsletter_date': date_str})
-
-    def exists(self, *, short_url):
-        assert short_url is not None and len(short_url) > 0
-        return bool(self._collection.find_one({'short_url': short_url}))
-
-    def save_error(self, *, short_url, error_message, error_class):
+
+        with self._lock:
+            errors = self._flush_locked()
+        self._notify()
+        return errors
+
+    def _notify(self):
+        """Calls the `on_written` functions of the confirmed writes."""
+
+        with self._lock:
+            written = self._written
+            self._written = []
+        for on_written in written:
+            on_written()
+
+    def _flush_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return []
+        buffer = self._buffer
+        self._buffer = []
+        failed = set()
+        errors = []
+        with timed('mongo_save', provider='mongo', method='bulk_write'):
+            try:
+                self._collection.bulk_write(
+                    [operation for operation, _, _, _ in buffer],
+                    ordered=False)
+            except BulkWriteError as e:
+                for error in e.details['writeErrors']:
+                    failed.add(error['index'])
+                    _, doc_id, conflicting, _ = buffer[error['index']]
+                    if error['code'] == _DUPLICATE_KEY and conflicting:
+                        # Already present, or claimed by another worker.
+                        self.conflicts += 1
+                    else:
+                        errors.append({'id': doc_id,
+                                       'status': error['code'],
+                                       'error': error['errmsg']})
+        for position, (_, _, _, on_written) in enumerate(buffer):
+            if position in failed:
+                continue
+            self.sent += 1
+            if on_written is not None:
+                self._written.append(on_written)
+        self.errors.extend(errors)
+        return errors
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DaoMongo(Dao):
+    def __init__(self, url=None, **kwargs):
         """
         Arguments:
-            short_url (str)
-            error_message (str)
-            error_class (str)
+            url (str): The connection string
+            kwargs (dict): See Dao
         """
-        assert short_url is not None and len(short_url) > 0
-        assert error_message is not None and len(error_message) > 0
-        assert error_class is not None and len(error_class) > 0
-        self._collection.update_one({'short_url': short_url},
-                                    {'$set': {
-                                        'error_message': error_message,
-                                        'error_class': error_class},
-                                    '$unset': {'text_analysed': ''}})
-
-    def save_text_analysis(self, *, short_url, text_original, text_en, authors,
-                           language, sentiment_score, sentiment_magnitude,
-                           entities, extractor, translator):
-        """
-        Arguments:
-            short_url (str)
-            text_original (str)
-            text_en (str)
-            authors (str) Comma separated list of authors.
-            language (str)
-            sentiment_score (double)
-            sentiment_magnitude (double)
-            entities (list of object)
-            extractor (str) The article extraction service used.
-            translator (str) The translation service used.
+
+        super().__init__(**kwargs)
+        client = MongoClient(url or _URL)
+        db = client.fakeko
+        self._collection = db['news']
+
+    def init_schema(self):
+        """Creates the unique indices on the urls.
+
+        The documents stored without `slice_hash`, before the sliced
+        queries, get it.
         """
-        assert short_url is not None and len(short_url) > 0
-        assert text_original is not None and len(text_original) > 0
-        assert text_en is not None and len(text_en) > 0
-        assert language is not None and len(language) > 0
-        assert entities, 'Missing entities'
-        entities_dict = [{'name': entity.name,
-                          'type': entity.entity_type,
-                          'salience': entity.salience,
-                          'wikipedia_url': entity.wikipedia_url}
-                         for entity in entities]
-        self._collection.update_one({'short_url': short_url},
-                                    {'$set': {
-                                        'text_original': text_original,
-                                        'text_en': text_en,
-                                        'translator': translator,
-                                        'authors': authors,
-                                        'language': language,
-                                        'sentiment_score': sentiment_score,
-                                        'sentiment_magnitude':
-                                            sentiment_magnitude,
-                                        'entities': entities_dict,
-                                        'extractor': extractor,
-                                        'text_analysed': True},
-                                    '$unset': {'error_message': '',
-                                               'error_class': ''}})
+
+        self._collection.create_index('short_url', unique=True)
+        self._collection.create_index('full_url', unique=True)
+        operations = []
+        for document in self._collection.find(
+                {'slice_hash': {'$exists': False}}, {'_id': True}):
+            operations.append(UpdateOne({'_id': document['_id']}, {
+                '$set': {'slice_hash': slice_hash(document['_id'])}}))
+            if len(operations) >= self.batch_size:
+                self._collection.bulk_write(operations, ordered=False)
+                operations = []
+        if operations:
+            self._collection.bulk_write(operations, ordered=False)
+
+    def _create_writer(self, **kwargs):
+        return _MongoBulkWriter(self._collection, **kwargs)
+
+    def find_existing_urls(self, *, short_urls=(), full_urls=()):
+        short_urls = list(set(short_urls))
+        full_urls = list(set(full_urls))
+        if not short_urls and not full_urls:
+            return set(), set()
+        should = []
+        for field, values in [('short_url', short_urls),
+                              ('full_url', full_urls)]:
+            if values:
+                should.append({field: {'$in': values}})
+        known_short_urls = set()
+        known_full_urls = set()
+        with timed('mongo_query', provider='mongo', method='find'):
+            for document in self._collection.find(
+                    {'$or': should}, {'short_url': True, 'full_url': True}):
+                known_short_urls.add(document.get('short_url'))
+                known_full_urls.add(document.get('full_url'))
+        return (known_short_urls.intersection(short_urls),
+                known_full_urls.intersection(full_urls))
 
     def find_all(self):
         return self._collection.find()
 
-    def find_for_text_analysis(self):
-        return self._collection.find({'skip': {'$ne': True},
-                                      'text_analysed': {'$ne': True}})
+    def find_text_analysed(self, *, page_size=None, source_excludes=None):
+        projection = {field: False for field in source_excludes or []}
+        cursor = self._collection.find({'text_analysed': True},
+                                       projection or None)
+        for document in cursor.batch_size(page_size or _PAGE_SIZE):
+            yield _news(document)
+
+    @staticmethod
+    def _slice(query, slice_id, slices):
+        # The slices split the documents by ranges of the hash of their id,
+        # as DaoElastic does.
+        if slices is not None and slices > 1:
+            start, end = slice_range(slice_id, slices)
+            query['slice_hash'] = {'$gte': start, '$lt': end}
+        return query
+
+    def find_for_text_analysis(self, include_errors=False, *, page_size=None,
+                               slice_id=None, slices=None):
+        query = {'skip': {'$ne': True}, 'text_analysed': {'$ne': True}}
+        if not include_errors:
+            query['error_class'] = {'$exists': False}
+        cursor = self._collection.find(
+            self._slice(query, slice_id, slices),
+            {field: False for field in ANALYSIS_EXCLUDES})
+        for document in cursor.batch_size(page_size or _PAGE_SIZE):
+            yield _news(document)
+
+    @staticmethod
+    def _claimable(include_errors, now):
+        query = {'skip': {'$ne': True}, 'text_analysed': {'$ne': True},
+                 '$or': [{'lease_until': None},
+                         {'lease_until': {'$lt': now}}]}
+        if not include_errors:
+            query['error_class'] = {'$exists': False}
+        return query
+
+    def claim_for_text_analysis(self, worker_id, *, count, lease_seconds,
+                                include_errors=False, slice_id=None,
+                                slices=None, exclude_ids=()):
+        # More candidates than needed are read and shuffled, so the workers
+        # starting together do not compete for the same documents.
+        now = datetime.utcnow()
+        lease_until = now + timedelta(seconds=lease_seconds)
+        query = self._slice(self._claimable(include_errors, now), slice_id,
+                            slices)
+        if exclude_ids:
+            query['_id'] = {'$nin': [_object_id(news_id)
+                                     for news_id in exclude_ids]}
+        with timed('mongo_query', provider='mongo', method='find'):
+            candidates = list(self._collection.find(
+                query,
+                {field: False for field in ANALYSIS_EXCLUDES}).limit(count * 4))
+        shuffle(candidates)
+        claimed = []
+        with timed('mongo_save', provider='mongo', method='update_one'):
+            for document in candidates:
+                if len(claimed) >= count:
+                    break
+                query = self._claimable(include_errors, now)
+                query['_id'] = document['_id']
+                result = self._collection.update_one(query, {'$set': {
+                    'claimed_by': worker_id, 'lease_until': lease_until}})
+                if result.modified_count == 1:
+                    document.pop('claimed_by', None)
+                    document.pop('lease_until', None)
+                    document['_version'] = worker_id
+                    claimed.append(_news(document))
+        return claimed
+
+    def renew_claims(self, news_list, worker_id, *, lease_seconds):
+        lease_until = datetime.utcnow() + timedelta(seconds=lease_seconds)
+        lost = []
+        with timed('mongo_save', provider='mongo', method='update_one'):
+            for news in news_list:
+                result = self._collection.update_one(
+                    {'_id': _object_id(news['id']), 'claimed_by': worker_id},
+                    {'$set': {'lease_until': lease_until}})
+                if result.matched_count == 0:
+                    lost.append(news)
+        return lost
+
+    def release_claims(self, news_list, *, retry_after=0):
+        if not news_list:
+            return
+        if retry_after > 0:
+            update = {'$unset': {'claimed_by': ''}, '$set': {
+                'lease_until': datetime.utcnow() +
+                timedelta(seconds=retry_after)}}
+        else:
+            update = {'$unset': {'claimed_by': '', 'lease_until': ''}}
+        with timed('mongo_save', provider='mongo', method='bulk_write'):
+            self._collection.bulk_write([
+                UpdateOne({'_id': _object_id(news['id']),
+                           'claimed_by': news['_version']}, update)
+                for news in news_list], ordered=False)
 
     def update_newsletter_date(self, short_url, date):
         date_str = date.strftime('%Y-%m-%d')
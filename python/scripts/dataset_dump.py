@@ -0,0 +1,135 @@
+"""Reader of the news dump shipped in `dataset/euvsdisinfo.tar.bz2`.
+
+The archive holds `part-*` files, each line is the repr of an
+Elasticsearch hit. The archive is decompressed as a stream, nothing is
+extracted to disk and the parts are read line by line.
+
+The lines are Python literals rather than JSON. They are rewritten to JSON
+with a regular expression and parsed with `json.loads`, which is a few
+times faster than `ast.literal_eval`. The few lines the rewrite does not
+handle are parsed with `literal_eval`.
+"""
+
+from ast import literal_eval
+from collections import deque
+from json import dumps, loads
+from multiprocessing import Pool
+from re import compile
+from tarfile import open as open_tar
+
+_DEFAULT_PATH = '../dataset/euvsdisinfo.tar.bz2'
+# Fields of the former Mongo documents not used anymore.
+HEAVY_FIELDS = ['tokens', 'sentences']
+_BATCH_SIZE = 200
+_PROCESSES = 4
+_LITERAL_TOKEN = compile(r"'((?:[^'\\]|\\.)*)'|\"((?:[^\"\\]|\\.)*)\"|"
+                         r"\b(True|False|None)\b")
+_JSON_CONSTANTS = {'True': 'true', 'False': 'false', 'None': 'null'}
+
+
+def _json_token(match):
+    text = match.group(1)
+    if text is None:
+        text = match.group(2)
+        if text is None:
+            return _JSON_CONSTANTS[match.group(3)]
+    if '\\' not in text and '"' not in text:
+        return '"%s"' % text
+    # Non latin-1 characters are kept as \u escapes by the encoding, then
+    # decoded with the Python escapes of the literal.
+    return dumps(text.encode('latin-1', 'backslashreplace').decode(
+        'unicode_escape'), ensure_ascii=False)
+
+
+def _parse_literal(line):
+    try:
+        return loads(_LITERAL_TOKEN.sub(_json_token, line))
+    except ValueError:
+        return literal_eval(line)
+
+
+def parse_line(line, strip=HEAVY_FIELDS):
+    """
+    Args:
+        line (bytes or str) A line of a dump part
+        strip (list of str) Fields left out of the news
+    Returns:
+        (dict) The news, with the hit `_id` as `id`
+    """
+
+    if isinstance(line, bytes):
+        line = line.decode('utf8')
+    hit = _parse_literal(line)
+    news = hit['_source']
+    news.setdefault('id', hit['_id'])
+    for field in strip or []:
+        news.pop(field, None)
+    return news
+
+
+def iter_lines(path=_DEFAULT_PATH):
+    """Yields the (part name, line) of every part in the archive."""
+
+    with open_tar(path, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            with archive.extractfile(member) as file:
+                for line in file:
+                    if line.strip():
+                        yield member.name, line
+
+
+def iter_news(path=_DEFAULT_PATH, strip=HEAVY_FIELDS):
+    """Yields the news of the dump one at a time."""
+
+    for _, line in iter_lines(path):
+        yield parse_line(line, strip)
+
+
+def _iter_line_batches(path, batch_size):
+    batch = []
+    for _, line in iter_lines(path):
+        batch.append(line)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _parse_batch(lines, strip):
+    return [parse_line(line, strip) for line in lines]
+
+
+def iter_news_batches(path=_DEFAULT_PATH, *, batch_size=_BATCH_SIZE,
+                      processes=_PROCESSES, strip=HEAVY_FIELDS):
+    """Yields the news of the dump in batches, parsed by a process pool.
+
+    The archive is read by this process, the lines are parsed by the pool.
+    At most two batches per process are read ahead, so the memory used does
+    not depend on the size of the dump.
+
+    Args:
+        path (str)
+        batch_size (int) Lines per batch
+        processes (int) Parsing processes, 1 to parse in this process
+        strip (list of str) Fields left out of the news
+    Returns:
+        (generator of list) The news batches, in the order of the dump
+    """
+
+    assert batch_size > 0
+    assert processes > 0
+    if processes == 1:
+        for lines in _iter_line_batches(path, batch_size):
+            yield _parse_batch(lines, strip)
+        return
+    with Pool(processes) as pool:
+        pending = deque()
+        for lines in _iter_line_batches(path, batch_size):
+            if len(pending) >= processes * 2:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(_parse_batch, [lines, strip]))
+        while pending:
+            yield pending.popleft().get()
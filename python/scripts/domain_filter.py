@@ -0,0 +1,132 @@
+"""Domain filter for the scraped links.
+
+The filtered domains are kept in a trie of their labels in reverse order
+(`org` -> `un`), so a host is checked in as many steps as it has labels,
+whatever the size of the list, and `un.org` matches `www.un.org` but not
+`fun.org`.
+"""
+
+from os.path import getmtime
+from structured_log import get_logger
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlsplit
+
+_DEFAULT_PATH = '../resources/filter_domains.txt'
+_RELOAD_INTERVAL = 10
+_END = ''
+
+_logger = get_logger('domain_filter')
+
+
+def get_domain(full_url):
+    """
+    Args:
+        full_url (str)
+    Returns:
+        (str) The lower case host name, without port and credentials
+    Raises:
+        ValueError: When the url has no host
+    """
+
+    host = urlsplit(full_url.strip()).hostname
+    if not host:
+        raise ValueError('Url [%s] has no host.' % full_url)
+    return host.rstrip('.')
+
+
+def _labels(domain):
+    return reversed(domain.strip().lower().rstrip('.').split('.'))
+
+
+def _build_trie(domains):
+    trie = {}
+    for domain in domains:
+        node = trie
+        for label in _labels(domain):
+            node = node.setdefault(label, {})
+        node[_END] = domain
+    return trie
+
+
+def _read_domains(path):
+    with open(path, encoding='utf8') as file:
+        for line in file:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                yield line
+
+
+class DomainFilter(object):
+    def __init__(self, domains=None, path=_DEFAULT_PATH,
+                 reload_interval=_RELOAD_INTERVAL):
+        """
+        Arguments:
+            domains (list of str): The filtered domains, when given the
+                file is not read
+            path (str): File with one domain per line, `#` starts a comment
+            reload_interval (float): Seconds between the checks of the file
+                modification time
+        """
+
+        self._path = None if domains is not None else path
+        self._reload_interval = reload_interval
+        self._lock = Lock()
+        self._mtime = None
+        self._checked_at = monotonic()
+        if domains is not None:
+            self._trie = _build_trie(domains)
+        else:
+            self._mtime = getmtime(path)
+            self._trie = _build_trie(_read_domains(path))
+
+    def _reload_if_changed(self):
+        if self._path is None or \
+                monotonic() - self._checked_at < self._reload_interval:
+            return
+        with self._lock:
+            self._checked_at = monotonic()
+            mtime = getmtime(self._path)
+            if mtime != self._mtime:
+                self._trie = _build_trie(_read_domains(self._path))
+                self._mtime = mtime
+                _logger.info('Filtered domains reloaded.', path=self._path)
+
+    def match(self, host):
+        """Returns the filtered domain matching the host, None otherwise."""
+
+        self._reload_if_changed()
+        node = self._trie
+        for label in _labels(host):
+            node = node.get(label)
+            if node is None:
+                return None
+            if _END in node:
+                return node[_END]
+        return None
+
+    def is_filtered(self, host):
+        return self.match(host) is not None
+
+    def classify(self, full_urls):
+        """Finds the domain of many urls and whether they are filtered.
+
+        Arguments:
+            full_urls (iterable of str)
+        Returns:
+            (list of tuple): The (domain, skip) of each url, the domain is
+                None for the urls without a host
+        """
+
+        hosts = {}
+        result = []
+        for full_url in full_urls:
+            try:
+                domain = get_domain(full_url)
+            except ValueError:
+                result.append((None, True))
+                continue
+            if domain not in hosts:
+                hosts[domain] = self.is_filtered(domain)
+            result.append((domain, hosts[domain]))
+        return result
@@ -0,0 +1,174 @@
+"""Shared keep-alive HTTP sessions.
+
+The module functions mirror `requests.delete/get/head/post/put` but send
+every request through one `requests.Session` per process, so connections
+to Elasticsearch and to the external APIs are pooled and reused. Forked
+workers build their own session on first use.
+
+Failed connections are retried for every method. Read errors and 502,
+503, 504 answers are only retried for the idempotent methods, not for
+POST: the Elasticsearch `_search` and `_bulk` calls are not retried, as a
+bulk request may have been partly applied.
+"""
+
+from os import getpid
+from requests import Session
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from urllib3.util.retry import Retry
+
+_DEFAULT_POOL_SIZE = 10
+# Url prefix -> maximum number of kept alive connections.
+_POOL_SIZES = {'http://127.0.0.1:9200': 20}
+_CONNECT_TIMEOUT = 5
+_READ_TIMEOUT = 60
+_RETRIES = 3
+_BACKOFF_FACTOR = 0.5
+_RETRY_STATUSES = [502, 503, 504]
+
+_config = {'default_pool_size': _DEFAULT_POOL_SIZE,
+           'pool_sizes': dict(_POOL_SIZES),
+           'connect_timeout': _CONNECT_TIMEOUT,
+           'read_timeout': _READ_TIMEOUT,
+           'retries': _RETRIES,
+           'backoff_factor': _BACKOFF_FACTOR}
+_lock = Lock()
+_session = None
+_session_pid = None
+_adapters = []
+# Counters of the connection pools closed by the adapters of this process.
+_evicted = {'pid': None, 'opened': 0, 'requests': 0}
+_evicted_lock = Lock()
+
+
+def configure(**kwargs):
+    """Changes the pool settings, the session is rebuilt on next use.
+
+    Arguments:
+        default_pool_size (int): Connections kept alive per host, for the
+            hosts without `pool_sizes` prefix
+        pool_sizes (dict): Url prefix -> connections kept alive
+        connect_timeout (float): Seconds
+        read_timeout (float): Seconds
+        retries (int): Retries on connection errors and, except for POST,
+            on read errors and 502, 503, 504
+        backoff_factor (float): Sleep factor between retries
+    """
+
+    global _session
+    for key, value in kwargs.items():
+        assert key in _config, 'Unknown option [%s]' % key
+        _config[key] = value
+    with _lock:
+        _close_session()
+        _session = None
+
+
+def _build_adapter(pool_size):
+    retry = Retry(total=_config['retries'],
+                  backoff_factor=_config['backoff_factor'],
+                  status_forcelist=_RETRY_STATUSES,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+    pools = adapter.poolmanager.pools
+    close_pool = pools.dispose_func
+
+    def dispose(pool):
+        _count_evicted(pool)
+        if close_pool is not None:
+            close_pool(pool)
+
+    pools.dispose_func = dispose
+    return adapter
+
+
+def _count_evicted(pool):
+    """Keeps the counters of a pool evicted or closed by its adapter."""
+
+    with _evicted_lock:
+        if _evicted['pid'] != getpid():
+            _evicted.update(pid=getpid(), opened=0, requests=0)
+        _evicted['opened'] += pool.num_connections
+        _evicted['requests'] += pool.num_requests
+
+
+def _close_session():
+    global _adapters
+    if _session is not None and _session_pid == getpid():
+        _session.close()
+    _adapters = []
+
+
+def session():
+    """Returns the session of the current process."""
+
+    global _session, _session_pid, _adapters
+    if _session is not None and _session_pid == getpid():
+        return _session
+    with _lock:
+        if _session is None or _session_pid != getpid():
+            new_session = Session()
+            adapters = []
+            default = _build_adapter(_config['default_pool_size'])
+            new_session.mount('http://', default)
+            new_session.mount('https://', default)
+            adapters.append(default)
+            for prefix, pool_size in _config['pool_sizes'].items():
+                adapter = _build_adapter(pool_size)
+                new_session.mount(prefix, adapter)
+                adapters.append(adapter)
+            _adapters = adapters
+            _session_pid = getpid()
+            _session = new_session
+    return _session
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault('timeout', (_config['connect_timeout'],
+                                  _config['read_timeout']))
+    return session().request(method, url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def head(url, **kwargs):
+    kwargs.setdefault('allow_redirects', False)
+    return request('HEAD', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def stats():
+    """Connection counters of the current process, evicted pools included.
+
+    Returns:
+        (dict): `requests` sent, connections `opened` and `reused`
+    """
+
+    opened = 0
+    requests = 0
+    if _evicted['pid'] == getpid():
+        opened = _evicted['opened']
+        requests = _evicted['requests']
+    if _session_pid == getpid():
+        for adapter in _adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                opened += pool.num_connections
+                requests += pool.num_requests
+    return {'requests': requests,
+            'opened': opened,
+            'reused': max(requests - opened, 0)}
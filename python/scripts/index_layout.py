@@ -0,0 +1,234 @@
+"""Layouts of the news in Elasticsearch.
+
+The `single` layout, the default, keeps each news in the `unfact` index
+described by `resources/mapping.json`: the existence checks, the backlog
+queries and the dashboards read an ever-growing index holding the large
+texts.
+
+The `partitioned` layout splits each news in two documents with the same
+id, in indices partitioned by month of `newsletter_date`:
+
+    unfact-2017.03        metadata and entities, behind the `unfact` alias
+    text-unfact-2017.03   `text_original` and `text_en`, behind the
+                          `text-unfact` alias, stored with best_compression
+
+The partitions are created from the templates of `resources/` on the first
+write of their month. The `unfact*` index pattern of the Kibana dashboard
+only matches the metadata, full text searches use a `text-unfact*` pattern.
+The scripts use the layout set by the `ELASTIC_LAYOUT` environment
+variable.
+
+Usage, from the `python` folder:
+
+    python scripts/index_layout.py init
+    python scripts/index_layout.py migrate
+    python scripts/index_layout.py switch
+
+`init` installs the templates of the partitioned layout. `migrate` copies
+the single index in the partitions, it can be run again while the scripts
+are stopped. `switch` checks the copy, deletes the single index and points
+the `unfact` alias to the partitions; then set `ELASTIC_LAYOUT=partitioned`.
+"""
+
+from dao import TEXT_FIELDS
+from json import load
+from os import environ
+from sys import argv
+
+LAYOUTS = ['single', 'partitioned']
+_TEMPLATE_FILES = {'meta': '../resources/template_meta.json',
+                   'text': '../resources/template_text.json'}
+_UNDATED = 'undated'
+_MIGRATE_BATCH = 500
+
+
+class SingleLayout(object):
+    """Every news in one index, texts included."""
+
+    name = 'single'
+    # Fields read from other indices.
+    joined_fields = []
+
+    def __init__(self, index):
+        self.index = index
+        self.text_alias = None
+
+    def index_of(self, news):
+        """The index holding the metadata of a news."""
+
+        return self.index
+
+    def split(self, document):
+        """
+        Returns:
+            (list of tuple): The `(index, source, primary)` of each document
+                written for the news, only the primary one is versioned
+        """
+
+        return [(self.index, document, True)]
+
+
+class PartitionedLayout(object):
+    """Metadata and texts in monthly partitions, see the module doc."""
+
+    name = 'partitioned'
+    joined_fields = TEXT_FIELDS
+
+    def __init__(self, index):
+        self.index = index
+        self.text_alias = 'text-' + index
+        self.pattern = index + '-*'
+        self.text_pattern = self.text_alias + '-*'
+
+    @staticmethod
+    def month(news):
+        date = news.get('newsletter_date')
+        if not date:
+            return _UNDATED
+        return date[:7].replace('-', '.')
+
+    def index_of(self, news):
+        return '%s-%s' % (self.index, self.month(news))
+
+    def text_index_of(self, news):
+        return '%s-%s' % (self.text_alias, self.month(news))
+
+    def split(self, document):
+        metadata = {key: value for key, value in document.items()
+                    if key not in TEXT_FIELDS}
+        writes = [(self.index_of(document), metadata, True)]
+        texts = {field: document[field] for field in TEXT_FIELDS
+                 if field in document}
+        if texts:
+            texts['id'] = document['id']
+            writes.append((self.text_index_of(document), texts, False))
+        return writes
+
+    def templates(self, aliases=True):
+        """
+        Arguments:
+            aliases (boolean): Adds the `unfact` alias to the metadata
+                partitions, not possible while the single index exists
+        Returns:
+            (dict): The index templates by name
+        """
+
+        result = {}
+        for kind, pattern, alias in [
+                ('meta', self.pattern, self.index if aliases else None),
+                ('text', self.text_pattern, self.text_alias)]:
+            with open(_TEMPLATE_FILES[kind]) as file:
+                template = load(file)
+            template['template'] = pattern
+            if alias is not None:
+                template['aliases'] = {alias: {}}
+            result['%s_%s' % (self.index, kind)] = template
+        return result
+
+
+def create_layout(name, index):
+    """
+    Arguments:
+        name (str): One of LAYOUTS, `single` when None
+        index (str): The name of the single index, alias of the partitions
+    """
+
+    if name is None or name == 'single':
+        return SingleLayout(index)
+    if name == 'partitioned':
+        return PartitionedLayout(index)
+    raise ValueError('Unknown layout [%s], expected one of [%s].' % (
+        name, ', '.join(LAYOUTS)))
+
+
+def migrate(base_host=None, *, batch_size=_MIGRATE_BATCH):
+    """Copies the news of the single index in the partitions.
+
+    The news already copied are left unchanged, so an interrupted migration
+    is completed by running it again.
+
+    Returns:
+        (dict): The number of news `read`, `created`, already present
+            (`conflicts`) and the rejected ones (`errors`)
+    """
+
+    from dao_elastic import DaoElastic
+
+    single = DaoElastic(base_host, layout='single', batch_size=batch_size)
+    partitioned = DaoElastic(base_host, layout='partitioned',
+                             batch_size=batch_size)
+    if not single.is_single_index():
+        raise ValueError('No single index [%s] to migrate.' % single.index)
+    partitioned.put_templates(aliases=False)
+    totals = {'read': 0, 'created': 0, 'conflicts': 0, 'errors': []}
+
+    def add(batch):
+        result = partitioned.import_many(batch)
+        totals['read'] += len(batch)
+        totals['created'] += result['sent']
+        totals['conflicts'] += result['conflicts']
+        totals['errors'].extend(result['errors'])
+
+    batch = []
+    for news in single.scroll({'match_all': {}}, page_size=batch_size):
+        batch.append(news)
+        if len(batch) >= batch_size:
+            add(batch)
+            batch = []
+    if batch:
+        add(batch)
+    return totals
+
+
+def switch(base_host=None):
+    """Replaces the single index by the `unfact` alias of the partitions.
+
+    Raises:
+        ValueError: When the partitions do not hold all the news of the
+            single index
+    """
+
+    from dao_elastic import DaoElastic
+    from http_pool import delete, post
+
+    single = DaoElastic(base_host, layout='single')
+    partitioned = DaoElastic(base_host, layout='partitioned')
+    layout = partitioned.layout
+    if not single.is_single_index():
+        raise ValueError('No single index [%s] to switch.' % single.index)
+    DaoElastic._assert_response(post('%s/%s,%s/_refresh' % (
+        partitioned.base_host, single.index, layout.pattern)))
+    expected = single.count()
+    copied = partitioned.count(layout.pattern)
+    if copied < expected:
+        raise ValueError('Only [%d] of the [%d] news copied, run migrate '
+                         'again.' % (copied, expected))
+    DaoElastic._assert_response(delete('%s/%s' % (
+        partitioned.base_host, single.index)))
+    partitioned.put_templates()
+    DaoElastic._assert_response(post(
+        '%s/_aliases' % partitioned.base_host, json={'actions': [
+            {'add': {'index': layout.pattern, 'alias': layout.index}}]}))
+    return {'news': copied}
+
+
+if __name__ == '__main__':
+    from structured_log import get_logger
+
+    _logger = get_logger('index_layout')
+    base_host = environ.get('ELASTIC_URL')
+    command = argv[1] if len(argv) > 1 else None
+    if command == 'init':
+        from dao_elastic import DaoElastic
+
+        DaoElastic(base_host, layout='partitioned').init_schema()
+    elif command == 'migrate':
+        totals = migrate(base_host)
+        errors = totals.pop('errors')
+        for error in errors:
+            _logger.error('News not copied.', **error)
+        _logger.info('Single index copied.', errors=len(errors), **totals)
+    elif command == 'switch':
+        _logger.info('Partitions switched.', **switch(base_host))
+    else:
+        print('Usage: python scripts/index_layout.py init|migrate|switch')
@@ -0,0 +1,191 @@
+"""Leases on the news waiting for the text analysis.
+
+Many processes, on one or many hosts, can run the text analysis at the same
+time: each news is claimed before being processed. A claim sets
+`claimed_by` and `lease_until` on the document with an update conditioned
+on the version read, so when two workers claim the same news only one of
+them succeeds. The leases of the news in progress are renewed in
+background, the news of a crashed worker are claimed again by the others
+once its leases are expired.
+
+The result of a claimed news is saved with the version of its last renewal,
+it is rejected as a conflict when the lease was lost in the meantime.
+
+A news given back unprocessed keeps a `lease_until` without `claimed_by`,
+so no worker claims it again before it can be retried.
+"""
+
+from collections import OrderedDict
+from os import getpid
+from socket import gethostname
+from structured_log import get_logger
+from threading import Event, Lock, Thread
+from uuid import uuid4
+
+_LEASE_SECONDS = 300
+_CLAIM_BATCH = 20
+# News in error excluded from the claims of a run, the oldest are forgotten.
+_MAX_FAILED = 10000
+
+_logger = get_logger('leases')
+
+
+class ClaimLost(Exception):
+    """The lease of a news was taken by another worker."""
+
+    outcome = 'claim_lost'
+
+
+def worker_name():
+    return '%s:%d:%s' % (gethostname(), getpid(), uuid4().hex[:8])
+
+
+class LeaseKeeper(object):
+    """Claims news for a worker and renews their leases in background.
+
+    Must be used as context manager, the claims still held at the exit are
+    released.
+    """
+
+    def __init__(self, dao, worker_id=None, *, lease_seconds=_LEASE_SECONDS,
+                 claim_batch=_CLAIM_BATCH):
+        """
+        Arguments:
+            dao (Dao): A backend supporting the claims
+            worker_id (str): Unique name of the worker, generated by default
+            lease_seconds (int): Duration of a lease, renewed every third
+            claim_batch (int): News claimed with a single request
+        """
+
+        assert lease_seconds > 0
+        assert claim_batch > 0
+        self.worker_id = worker_id or worker_name()
+        self._dao = dao
+        self._lease_seconds = lease_seconds
+        self._claim_batch = claim_batch
+        self._claims = {}
+        self._failed = OrderedDict()
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+        self.stats = {'claimed': 0, 'renewed': 0, 'lost': 0, 'released': 0}
+
+    def __enter__(self):
+        self._thread = Thread(target=self._renew_loop, daemon=True,
+                              name='lease-keeper')
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._thread.join()
+        with self._lock:
+            remaining = list(self._claims.values())
+            self._claims.clear()
+        if remaining:
+            self._dao.release_claims(remaining)
+            self.stats['released'] += len(remaining)
+        _logger.info('Leases closed.', worker_id=self.worker_id,
+                     **self.stats)
+
+    def claimed(self, include_errors=False, *, slice_id=None, slices=None):
+        """Claims the news waiting for the text analysis, batch by batch.
+
+        The next batch is claimed once the previous one is consumed, so a
+        worker does not hold more news than it is processing. The run ends
+        when no news is claimable. The news released are not claimable
+        before their retry time. With `include_errors` the news saved in
+        error during the run are claimable again, the last `_MAX_FAILED`
+        of them are excluded from the next claims.
+
+        Returns:
+            (generator of dict): The claimed news
+        """
+
+        while not self._stopped.is_set():
+            with self._lock:
+                failed = list(self._failed) if include_errors else []
+            news_list = self._dao.claim_for_text_analysis(
+                self.worker_id, count=self._claim_batch,
+                lease_seconds=self._lease_seconds,
+                include_errors=include_errors, slice_id=slice_id,
+                slices=slices, exclude_ids=failed)
+            if not news_list:
+                return
+            with self._lock:
+                for news in news_list:
+                    self._claims[news['id']] = news
+            self.stats['claimed'] += len(news_list)
+            yield from news_list
+
+    def check(self, news):
+        """
+        Raises:
+            ClaimLost: When the lease of the news is not held anymore
+        """
+
+        with self._lock:
+            if news['id'] not in self._claims:
+                raise ClaimLost('Lease of news [%s] lost.' % news['id'])
+
+    def done(self, news, failed=False):
+        """Stops renewing the lease of a news before saving it.
+
+        The version of the news does not change anymore, its save is
+        accepted while the last lease lasts.
+
+        Arguments:
+            news (dict)
+            failed (boolean): Whether the news is saved in error
+        Raises:
+            ClaimLost: When the lease of the news is not held anymore
+        """
+
+        with self._lock:
+            if self._claims.pop(news['id'], None) is None:
+                raise ClaimLost('Lease of news [%s] lost.' % news['id'])
+            if failed:
+                self._failed[news['id']] = True
+                if len(self._failed) > _MAX_FAILED:
+                    self._failed.popitem(last=False)
+
+    def release(self, news, retry_after=None):
+        """Gives back a news which was not processed.
+
+        Arguments:
+            news (dict)
+            retry_after (float): Seconds before the news can be claimed
+                again, the lease duration by default
+        """
+
+        with self._lock:
+            if self._claims.pop(news['id'], None) is None:
+                return
+        self._dao.release_claims([news], retry_after=self._lease_seconds
+                                 if retry_after is None else retry_after)
+        self.stats['released'] += 1
+
+    def _renew_loop(self):
+        while not self._stopped.wait(self._lease_seconds / 3):
+            try:
+                self._renew()
+            except Exception as e:
+                _logger.error('Leases not renewed.', error=str(e),
+                              error_class=e.__class__.__name__)
+
+    def _renew(self):
+        # The lock is held during the renewal, so `done` waits for the
+        # versions to be updated.
+        with self._lock:
+            news_list = list(self._claims.values())
+            if not news_list:
+                return
+            lost = self._dao.renew_claims(news_list, self.worker_id,
+                                          lease_seconds=self._lease_seconds)
+            for news in lost:
+                self._claims.pop(news['id'], None)
+        self.stats['renewed'] += len(news_list) - len(lost)
+        self.stats['lost'] += len(lost)
+        for news in lost:
+            _logger.warning('Lease lost.', id=news['id'],
+                            worker_id=self.worker_id)
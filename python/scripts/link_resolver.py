@@ -0,0 +1,158 @@
+"""Asynchronous resolution of short urls.
+
+The short urls are resolved with HEAD requests, the full url is read from
+the `Location` header of the redirect. Requests run concurrently with a
+bounded number of connections per host and a global requests per second
+limit. An optional ResolutionCache is checked before the network and
+updated with the results.
+"""
+
+import asyncio
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from metrics import timed
+from time import monotonic
+from urllib.parse import urljoin, urlsplit
+
+_CONCURRENCY_PER_HOST = 8
+_REQUESTS_PER_SECOND = 20
+_TIMEOUT = 30
+_REDIRECT_STATUSES = [301, 302, 303, 307, 308]
+# Statuses telling that the short url will never redirect, cached as errors.
+_FINAL_STATUSES = [200, 201, 202, 203, 204, 404]
+
+
+class StatusError(ValueError):
+    """A short url answered without redirecting."""
+
+    def __init__(self, short_url, status):
+        super().__init__('Error: link [%s] returned [%d]' % (
+            short_url, status))
+        self.status = status
+
+    @property
+    def final(self):
+        """False when the status may change on retry, as 429 or 5xx."""
+
+        return self.status in _FINAL_STATUSES
+
+
+class _RateLimiter(object):
+    """Spaces the requests to at most `rate` per second."""
+
+    def __init__(self, rate):
+        assert rate > 0
+        self._interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class LinkResolver(object):
+    """Resolves short urls, must be used as async context manager.
+
+    The short urls not resolved for a reason which may change on retry
+    (connection errors, timeouts, 429 or 5xx) are added to `retryable`.
+    """
+
+    def __init__(self, *, concurrency_per_host=_CONCURRENCY_PER_HOST,
+                 requests_per_second=_REQUESTS_PER_SECOND, timeout=_TIMEOUT,
+                 cache=None):
+        self.retryable = set()
+        self._cache = cache
+        self._concurrency_per_host = concurrency_per_host
+        self._requests_per_second = requests_per_second
+        self._timeout = timeout
+        self._session = None
+        self._limiter = None
+
+    async def __aenter__(self):
+        connector = TCPConnector(limit_per_host=self._concurrency_per_host)
+        self._session = ClientSession(
+            connector=connector, timeout=ClientTimeout(total=self._timeout))
+        self._limiter = _RateLimiter(self._requests_per_second)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self._session.close()
+        self._session = None
+
+    async def _request(self, method, short_url):
+        await self._limiter.wait()
+        with timed('resolve', provider=urlsplit(short_url).hostname,
+                   method=method) as call:
+            async with self._session.request(
+                    method, short_url, allow_redirects=False) as response:
+                if response.status not in _REDIRECT_STATUSES:
+                    call['outcome'] = 'status_%d' % response.status
+                return response.status, response.headers.get('Location')
+
+    async def resolve_one(self, short_url):
+        """
+        Args:
+            short_url (str)
+        Returns:
+            (str) The full url
+        Raises:
+            StatusError: When the short url does not redirect
+        """
+
+        status, location = await self._request('HEAD', short_url)
+        if status == 405:
+            status, location = await self._request('GET', short_url)
+        if status not in _REDIRECT_STATUSES or not location:
+            raise StatusError(short_url, status)
+        return urljoin(short_url, location)
+
+    async def resolve(self, short_urls):
+        """
+        Args:
+            short_urls (list of str)
+        Returns:
+            (tuple of dict) The full url of each resolved short url and
+                the error message of each short url not resolved. Only the
+                resolved urls and the final errors (404, 2xx) are cached.
+        """
+
+        resolved = {}
+        errors = {}
+        short_urls = list(dict.fromkeys(short_urls))
+        if self._cache is not None:
+            cached = self._cache.get_many(short_urls)
+            for short_url, (full_url, error) in cached.items():
+                if full_url is None:
+                    errors[short_url] = error
+                else:
+                    resolved[short_url] = full_url
+            short_urls = [short_url for short_url in short_urls
+                          if short_url not in cached]
+        results = await asyncio.gather(
+            *[self.resolve_one(short_url) for short_url in short_urls],
+            return_exceptions=True)
+        new_resolved = {}
+        new_errors = {}
+        for short_url, result in zip(short_urls, results):
+            if isinstance(result, StatusError) and result.final:
+                new_errors[short_url] = str(result)
+            elif isinstance(result, ValueError):
+                errors[short_url] = str(result)
+                self.retryable.add(short_url)
+            elif isinstance(result, (ClientError, asyncio.TimeoutError)):
+                errors[short_url] = str(result) or result.__class__.__name__
+                self.retryable.add(short_url)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                new_resolved[short_url] = result
+        if self._cache is not None:
+            self._cache.put_many(new_resolved, new_errors)
+        resolved.update(new_resolved)
+        errors.update(new_errors)
+        return resolved, errors
+
@@ -0,0 +1,459 @@
+"""Offline entity and sentiment annotator, an alternative to Google Language.
+
+The model is fitted on the news already annotated by Google Language:
+
+* the gazetteer holds the entities found in at least two news, and in at
+  least half the news mentioning them, with their most frequent spelling,
+  type and wikipedia url. The names are matched on the words of the text
+  with a trie, the longest name wins. The salience of an entity is the
+  share of its mentions, the early ones weighing more.
+* the lexicon holds the valence of the words found in at least three news:
+  the mean sentiment score of these news, shrunk towards zero. A sentence
+  scores the mean valence of its words, the score of a text is the mean
+  of its sentences and its magnitude the sum of their absolute scores,
+  both calibrated on the Google ones.
+
+The annotations have the shape of the Google ones, so the annotator is a
+provider (`ANNOTATOR=local`, see providers.py) and needs neither network
+nor quota. The texts are annotated in batches: with NumPy the sentiment of
+a batch is computed with array operations, without it in pure Python.
+
+Usage, from the `python` folder:
+
+    python scripts/local_annotator.py build
+    python scripts/local_annotator.py reannotate 4
+
+`build` fits the model on the dump, `reannotate` annotates again all the
+analysed news of the storage with 4 processes.
+"""
+
+from collections import Counter, defaultdict, deque
+from itertools import repeat
+from json import dump, load
+from metrics import timed
+from multiprocessing import Pool
+from os import makedirs
+from os.path import dirname
+from re import UNICODE, compile
+from sys import argv
+from threading import BoundedSemaphore
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_DEFAULT_PATH = '../cache/local_annotator.json'
+_WORD = compile(r'\w+', UNICODE)
+_SENTENCE_END = compile(r'[.!?]+(?:\s+|$)')
+_MIN_ENTITY_NEWS = 2
+# Minimum share of the news mentioning a name where Google found it as an
+# entity, the other names are mostly common words.
+_MIN_ENTITY_PRECISION = 0.5
+_MIN_WORD_NEWS = 3
+# News added to each word when averaging their scores, so the words of few
+# news keep a valence close to zero.
+_SHRINKAGE = 5
+# Weight of the last mention of an entity, the first one weighs 1.
+_LAST_MENTION_WEIGHT = 0.5
+_BATCH_SIZE = 200
+_PROCESSES = 4
+_END = ''
+
+_annotator = None
+_annotator_path = None
+
+
+def _words(text):
+    return _WORD.findall(text.lower())
+
+
+def _sentences(text):
+    """
+    Returns:
+        (list of list of str) The words of each sentence with words
+    """
+
+    sentences = [_words(sentence) for sentence in _SENTENCE_END.split(text)]
+    return [words for words in sentences if words]
+
+
+class LocalAnnotator(object):
+    def __init__(self, model):
+        """
+        Arguments:
+            model (dict): See `build`
+        """
+
+        self._bias = model['bias']
+        self._scale = model['scale']
+        self._magnitude_scale = model['magnitude_scale']
+        # The position 0 is the valence of the words out of the lexicon.
+        self._vocabulary = {word: position + 1 for position, word
+                            in enumerate(model['words'])}
+        valences = [0.0] + model['valences']
+        self._valences = valences if numpy is None else \
+            numpy.array(valences, dtype=numpy.float64)
+        self._entities = model['entities']
+        self._trie = {}
+        for position, (name, _, _) in enumerate(self._entities):
+            node = self._trie
+            for word in _words(name):
+                node = node.setdefault(word, {})
+            node[_END] = position
+
+    @classmethod
+    def load(cls, path=_DEFAULT_PATH):
+        with open(path) as file:
+            return cls(load(file))
+
+    def _match(self, words):
+        """
+        Returns:
+            (list of tuple) The (entity position, word position) of the
+                longest names found in the words
+        """
+
+        trie = self._trie
+        mentions = []
+        matched_end = 0
+        for start in [position for position, word in enumerate(words)
+                      if word in trie]:
+            if start < matched_end:
+                continue
+            node = trie[words[start]]
+            found = None
+            end = start
+            while node is not None:
+                end += 1
+                if _END in node:
+                    found = (node[_END], end)
+                node = node.get(words[end]) if end < len(words) else None
+            if found is not None:
+                mentions.append((found[0], start))
+                matched_end = found[1]
+        return mentions
+
+    def _word_ids(self, words):
+        return map(self._vocabulary.get, words, repeat(0))
+
+    def _entities_of(self, words):
+        weights = defaultdict(float)
+        for entity, position in self._match(words):
+            weights[entity] += 1 - (1 - _LAST_MENTION_WEIGHT) * \
+                position / len(words)
+        total = sum(weights.values())
+        entities = [[self._entities[entity][0], self._entities[entity][1],
+                     weight / total, self._entities[entity][2]]
+                    for entity, weight in weights.items()]
+        return sorted(entities, key=lambda entity: -entity[2])
+
+    def _sentiments_python(self, documents):
+        results = []
+        for sentences in documents:
+            scores = []
+            lengths = []
+            for words in sentences:
+                valence = sum(map(self._valences.__getitem__,
+                                  self._word_ids(words)))
+                scores.append(max(-1.0, min(1.0, self._bias + self._scale *
+                                            valence / len(words))))
+                lengths.append(len(words))
+            if not scores:
+                results.append((0.0, 0.0))
+                continue
+            results.append((
+                sum(score * length for score, length
+                    in zip(scores, lengths)) / sum(lengths),
+                self._magnitude_scale * sum(abs(score) for score in scores)))
+        return results
+
+    def _sentiments_numpy(self, documents):
+        """Scores all the sentences of the batch with array operations."""
+
+        word_ids = []
+        sentence_lengths = []
+        sentence_documents = []
+        for document, sentences in enumerate(documents):
+            for words in sentences:
+                word_ids.extend(self._word_ids(words))
+                sentence_lengths.append(len(words))
+                sentence_documents.append(document)
+        if not sentence_lengths:
+            return [(0.0, 0.0)] * len(documents)
+        lengths = numpy.array(sentence_lengths, dtype=numpy.float64)
+        sentence_of_word = numpy.repeat(numpy.arange(len(lengths)),
+                                        sentence_lengths)
+        valences = numpy.bincount(
+            sentence_of_word,
+            weights=self._valences[numpy.array(word_ids)],
+            minlength=len(lengths))
+        scores = numpy.clip(self._bias + self._scale * valences / lengths,
+                            -1.0, 1.0)
+        document_of_sentence = numpy.array(sentence_documents)
+        weighted = numpy.bincount(document_of_sentence,
+                                  weights=scores * lengths,
+                                  minlength=len(documents))
+        words = numpy.bincount(document_of_sentence, weights=lengths,
+                               minlength=len(documents))
+        magnitudes = numpy.bincount(document_of_sentence,
+                                    weights=numpy.abs(scores),
+                                    minlength=len(documents))
+        document_scores = numpy.divide(weighted, words,
+                                       out=numpy.zeros(len(documents)),
+                                       where=words > 0)
+        return list(zip(document_scores.tolist(),
+                        (magnitudes * self._magnitude_scale).tolist()))
+
+    def annotate_batch(self, texts):
+        """
+        Arguments:
+            texts (list of str): English texts
+        Returns:
+            (list of dict): The `sentiment_score`, `sentiment_magnitude`
+                and `entities` of each text, as the Google Language
+                provider returns them
+        """
+
+        documents = [_sentences(text) for text in texts]
+        if numpy is None:
+            sentiments = self._sentiments_python(documents)
+        else:
+            sentiments = self._sentiments_numpy(documents)
+        annotations = []
+        for sentences, (score, magnitude) in zip(documents, sentiments):
+            words = [word for sentence in sentences for word in sentence]
+            annotations.append({'sentiment_score': round(score, 1),
+                                'sentiment_magnitude': round(magnitude, 1),
+                                'entities': self._entities_of(words)})
+        return annotations
+
+
+def _get_annotator(path=_DEFAULT_PATH):
+    global _annotator, _annotator_path
+    if _annotator is None or _annotator_path != path:
+        _annotator = LocalAnnotator.load(path)
+        _annotator_path = path
+    return _annotator
+
+
+def annotate(text_en):
+    """The annotator provider, see providers.py."""
+
+    with timed('annotate', provider='local'):
+        return _get_annotator().annotate_batch([text_en])[0]
+
+
+def _fit(news_list, bias):
+    """The lexicon and the candidate entities, by their words."""
+
+    entity_news = Counter()
+    spellings = defaultdict(Counter)
+    entity_types = defaultdict(Counter)
+    entity_urls = {}
+    word_news = Counter()
+    word_scores = defaultdict(float)
+    for news in news_list:
+        keys = set()
+        for entity in news['entities']:
+            key = ' '.join(_words(entity['name']))
+            if not key:
+                continue
+            keys.add(key)
+            spellings[key][entity['name']] += 1
+            entity_types[key][entity['type']] += 1
+            if entity.get('wikipedia_url'):
+                entity_urls.setdefault(key, entity['wikipedia_url'])
+        entity_news.update(keys)
+        for word in set(_words(news['text_en'])):
+            word_news[word] += 1
+            word_scores[word] += news['sentiment_score'] - bias
+    entities = [[spellings[key].most_common(1)[0][0],
+                 entity_types[key].most_common(1)[0][0],
+                 entity_urls.get(key), count]
+                for key, count in sorted(entity_news.items())
+                if count >= _MIN_ENTITY_NEWS]
+    words = sorted(word for word, count in word_news.items()
+                   if count >= _MIN_WORD_NEWS)
+    return {'bias': bias, 'scale': 1.0, 'magnitude_scale': 1.0,
+            'words': words,
+            'valences': [word_scores[word] / (word_news[word] + _SHRINKAGE)
+                         for word in words],
+            'entities': entities}
+
+
+def _least_squares_scale(predicted, expected):
+    denominator = sum(value * value for value in predicted)
+    if denominator == 0:
+        return 1.0
+    return sum(value * target for value, target
+               in zip(predicted, expected)) / denominator
+
+
+def build(news_stream, path=_DEFAULT_PATH):
+    """Fits the model on the news annotated by Google Language.
+
+    Arguments:
+        news_stream (iterable of dict): The news, the ones without english
+            text or entities are skipped
+        path (str): The model file written
+    Returns:
+        (dict): The number of `news`, `entities` and `words` of the model
+    """
+
+    news_list = [news for news in news_stream
+                 if news.get('text_analysed') and news.get('text_en')
+                 and news.get('entities')
+                 and news.get('sentiment_score') is not None]
+    assert news_list, 'No annotated news to fit the model on'
+    model = _fit(news_list, sum(news['sentiment_score']
+                                for news in news_list) / len(news_list))
+    candidates = model['entities']
+    model['entities'] = [entity[:3] for entity in candidates]
+    annotator = LocalAnnotator(model)
+
+    # The names found by the trie in more news than Google are dropped.
+    text_news = Counter()
+    for news in news_list:
+        text_news.update({entity for entity, _ in
+                          annotator._match(_words(news['text_en']))})
+    model['entities'] = [
+        entity[:3] for position, entity in enumerate(candidates)
+        if entity[3] >= _MIN_ENTITY_PRECISION * text_news[position]]
+
+    # The valences are means over whole news, the sentence scores are
+    # scaled to the spread of the Google scores.
+    raw = []
+    for news in news_list:
+        words = _words(news['text_en'])
+        raw.append(sum(map(annotator._valences.__getitem__,
+                           annotator._word_ids(words))) / max(len(words), 1))
+    model['scale'] = _least_squares_scale(
+        raw, [news['sentiment_score'] - model['bias'] for news in news_list])
+    annotator = LocalAnnotator(model)
+    magnitudes = [annotation['sentiment_magnitude'] for annotation
+                  in annotator.annotate_batch([news['text_en']
+                                               for news in news_list])]
+    model['magnitude_scale'] = _least_squares_scale(
+        magnitudes, [news['sentiment_magnitude'] for news in news_list])
+
+    if dirname(path):
+        makedirs(dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        dump(model, file)
+    return {'news': len(news_list), 'entities': len(model['entities']),
+            'words': len(model['words'])}
+
+
+def _init_worker(path):
+    _get_annotator(path)
+
+
+def _annotate_texts(texts):
+    return _get_annotator(_annotator_path).annotate_batch(texts)
+
+
+def _batches(news_stream, batch_size):
+    batch = []
+    for news in news_stream:
+        batch.append(news)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def annotate_stream(texts_stream, *, processes=_PROCESSES,
+                    path=_DEFAULT_PATH):
+    """Annotates batches of texts in a pool of processes.
+
+    Arguments:
+        texts_stream (iterable of list of str): The batches of texts
+        processes (int): Worker processes, each loads the model once
+        path (str): The model file
+    Returns:
+        (generator of list of dict): The annotations of each batch, in
+            order
+    """
+
+    with Pool(processes, initializer=_init_worker,
+              initargs=(path,)) as pool:
+        yield from pool.imap(_annotate_texts, texts_stream)
+
+
+def reannotate(dao, *, processes=_PROCESSES, batch_size=_BATCH_SIZE,
+               path=_DEFAULT_PATH):
+    """Annotates again all the analysed news and saves them.
+
+    Every news gets the local sentiment, with an empty entity list when the
+    gazetteer matches none, so no Google annotation is left in the corpus.
+    The aggregates are not updated, rebuild them afterwards.
+
+    Arguments:
+        dao (Dao)
+        processes (int): Worker processes
+        batch_size (int): Texts annotated by a worker at once
+        path (str): The model file
+    Returns:
+        (dict): The number of news `saved` and the rejected ones
+            (`errors`)
+    """
+
+    from dao import Entity
+
+    pending = deque()
+    # The pool reads the batches in a thread without limit, the semaphore
+    # bounds the news held in memory.
+    slots = BoundedSemaphore(processes * 2)
+
+    def texts():
+        for batch in _batches(dao.find_text_analysed(page_size=batch_size),
+                              batch_size):
+            slots.acquire()
+            pending.append(batch)
+            yield [news['text_en'] for news in batch]
+
+    with dao.bulk() as writer:
+        for annotations in annotate_stream(texts(), processes=processes,
+                                           path=path):
+            batch = pending.popleft()
+            slots.release()
+            analyses = []
+            for news, annotation in zip(batch, annotations):
+                analysis = {field: news.get(field) for field in [
+                    'text_original', 'authors', 'text_en', 'translator',
+                    'language', 'extractor', 'duplicate_of']}
+                analysis.update(news=news,
+                                sentiment_score=annotation['sentiment_score'],
+                                sentiment_magnitude=annotation[
+                                    'sentiment_magnitude'],
+                                entities=[Entity(*entity) for entity
+                                          in annotation['entities']])
+                analyses.append(analysis)
+            dao.save_text_analyses(analyses, allow_no_entities=True)
+    return {'saved': writer.sent, 'errors': writer.errors}
+
+
+if __name__ == '__main__':
+    from structured_log import get_logger
+
+    _logger = get_logger('local_annotator')
+    if len(argv) > 1 and argv[1] == 'build':
+        from dataset_dump import iter_news
+
+        dump_path = argv[2] if len(argv) > 2 \
+            else '../dataset/euvsdisinfo.tar.bz2'
+        _logger.info('Local annotator built.', **build(iter_news(dump_path)))
+    elif len(argv) > 1 and argv[1] == 'reannotate':
+        from dao import create_dao
+
+        totals = reannotate(create_dao(), processes=int(argv[2])
+                            if len(argv) > 2 else _PROCESSES)
+        for error in totals['errors']:
+            _logger.error('News not saved.', **error)
+        _logger.info('News annotated again.', saved=totals['saved'],
+                     errors=len(totals['errors']), numpy=numpy is not None)
+    else:
+        print('Usage: python scripts/local_annotator.py '
+              'build [dump]|reannotate [processes]')
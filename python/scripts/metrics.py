@@ -0,0 +1,285 @@
+"""Counters and latency histograms of the external calls.
+
+Each call to Elasticsearch, bit.ly, the PDF parser and the extraction,
+translation and annotation providers is measured with `timed`:
+
+    with timed('translate', provider='microsoft'):
+        ...
+
+which counts the call in `calls_total` and its duration in
+`call_seconds`, both tagged by operation, provider and outcome. The outcome
+is `ok`, `error` or the `outcome` attribute of the exception raised, for
+example `deferred` for a QuotaDeferred.
+
+Each process keeps its own values and writes them as a JSON snapshot in
+`../cache/metrics/<pid>.json` every few seconds, on `flush` and at exit,
+so the values of the Pool workers are summed by `collect`. `serve` exposes the
+sum in the Prometheus text format on http://127.0.0.1:9108/metrics, and as
+JSON on /metrics.json. From the `python` folder
+`python scripts/metrics.py` prints the current sum.
+"""
+
+from atexit import register
+from bisect import bisect_left
+from contextlib import contextmanager
+from glob import glob
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dump, dumps, load
+from os import getpid, makedirs, register_at_fork, remove, rename
+from os.path import join
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+_DEFAULT_PATH = '../cache/metrics'
+_DEFAULT_PORT = 9108
+_FLUSH_SECONDS = 10
+_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+            30.0, 60.0]
+
+CALLS = 'calls_total'
+CALL_SECONDS = 'call_seconds'
+
+_lock = Lock()
+_path = _DEFAULT_PATH
+_pid = None
+_counters = {}
+_histograms = {}
+_flusher = None
+
+
+def _reset_lock():
+    # The lock may have been held by another thread at the time of the fork.
+    global _lock
+    _lock = Lock()
+
+
+register_at_fork(after_in_child=_reset_lock)
+
+
+def _flush_at_exit():
+    if _pid == getpid() and (_counters or _histograms):
+        flush()
+
+
+register(_flush_at_exit)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value))
+                              for key, value in labels.items()))
+
+
+def _check_process():
+    """Forgets the values inherited from the parent process."""
+
+    global _pid, _flusher
+    if _pid != getpid():
+        _pid = getpid()
+        _counters.clear()
+        _histograms.clear()
+        _flusher = Event()
+        Thread(target=_flush_periodically, args=[_flusher],
+               daemon=True).start()
+
+
+def _flush_periodically(stopped):
+    while not stopped.wait(_FLUSH_SECONDS):
+        flush()
+
+
+def increment(name, amount=1, **labels):
+    with _lock:
+        _check_process()
+        key = _key(name, labels)
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name, seconds, **labels):
+    with _lock:
+        _check_process()
+        key = _key(name, labels)
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = {'buckets': [0] * (len(_BUCKETS) + 1),
+                         'sum': 0.0, 'count': 0}
+            _histograms[key] = histogram
+        histogram['buckets'][bisect_left(_BUCKETS, seconds)] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+
+@contextmanager
+def timed(operation, *, provider, **labels):
+    """Measures the call made inside the context.
+
+    Arguments:
+        operation (str): For example `es_query`, `resolve`, `translate`
+        provider (str): The service called
+        labels (dict): Other labels of the call
+    Returns:
+        (dict): The labels, the `outcome` can be changed inside the context
+    """
+
+    call = dict(labels, operation=operation, provider=provider, outcome='ok')
+    start = perf_counter()
+    try:
+        yield call
+    except BaseException as e:
+        call['outcome'] = getattr(e, 'outcome', 'error')
+        raise
+    finally:
+        increment(CALLS, **call)
+        observe(CALL_SECONDS, perf_counter() - start, **call)
+
+
+def configure(path=_DEFAULT_PATH):
+    """Changes the folder of the snapshots."""
+
+    global _path
+    _path = path
+
+
+def snapshot():
+    """Returns the values of this process."""
+
+    with _lock:
+        _check_process()
+        return {'counters': [[name, dict(labels), value] for
+                             (name, labels), value in _counters.items()],
+                'histograms': [[name, dict(labels), dict(
+                    histogram, buckets=list(histogram['buckets']))]
+                    for (name, labels), histogram in _histograms.items()]}
+
+
+def flush():
+    """Writes the snapshot of this process."""
+
+    values = snapshot()
+    makedirs(_path, exist_ok=True)
+    file_name = join(_path, '%d.json' % getpid())
+    with open(file_name + '.part', 'w') as file:
+        dump(values, file)
+    rename(file_name + '.part', file_name)
+
+
+def clear():
+    """Removes the snapshots, to be called when a new run starts."""
+
+    for file_name in glob(join(_path, '*.json')):
+        remove(file_name)
+
+
+def collect():
+    """Returns the values summed over the snapshots of all the processes.
+
+    The values of this process are read in memory rather than from its
+    snapshot, which may be late.
+    """
+
+    current = join(_path, '%d.json' % getpid())
+    snapshots = [snapshot()]
+    for file_name in glob(join(_path, '*.json')):
+        if file_name == current:
+            continue
+        try:
+            with open(file_name) as file:
+                snapshots.append(load(file))
+        except (OSError, ValueError):
+            continue
+    counters = {}
+    histograms = {}
+    for values in snapshots:
+        for name, labels, value in values['counters']:
+            key = _key(name, labels)
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram in values['histograms']:
+            key = _key(name, labels)
+            total = histograms.setdefault(key, {
+                'buckets': [0] * (len(_BUCKETS) + 1), 'sum': 0.0,
+                'count': 0})
+            total['buckets'] = [a + b for a, b in
+                                zip(total['buckets'], histogram['buckets'])]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+    return {'counters': [[name, dict(labels), value] for
+                         (name, labels), value in sorted(counters.items())],
+            'histograms': [[name, dict(labels), histogram] for
+                           (name, labels), histogram in
+                           sorted(histograms.items())]}
+
+
+def _labels_text(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"')) for key, value in
+        sorted(labels.items()))
+
+
+def render_prometheus(values):
+    """Formats collected values in the Prometheus text format."""
+
+    lines = []
+    typed = set()
+    for name, labels, value in values['counters']:
+        if name not in typed:
+            lines.append('# TYPE %s counter' % name)
+            typed.add(name)
+        lines.append('%s%s %s' % (name, _labels_text(labels), value))
+    for name, labels, histogram in values['histograms']:
+        if name not in typed:
+            lines.append('# TYPE %s histogram' % name)
+            typed.add(name)
+        cumulated = 0
+        for bound, count in zip(_BUCKETS + ['+Inf'],
+                                histogram['buckets']):
+            cumulated += count
+            lines.append('%s_bucket%s %d' % (
+                name, _labels_text(labels, le=bound), cumulated))
+        lines.append('%s_sum%s %f' % (name, _labels_text(labels),
+                                      histogram['sum']))
+        lines.append('%s_count%s %d' % (name, _labels_text(labels),
+                                        histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            payload = render_prometheus(collect()).encode('utf8')
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            payload = dumps(collect()).encode('utf8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def serve(port=_DEFAULT_PORT):
+    """Serves the collected values on a background thread.
+
+    Returns:
+        (ThreadingHTTPServer) The server, None when the port is in use
+    """
+
+    try:
+        server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    except OSError:
+        return None
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    print(render_prometheus(collect()), end='')
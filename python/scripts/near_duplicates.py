@@ -0,0 +1,320 @@
+"""Near-duplicate detection of the extracted articles with MinHash and LSH.
+
+The same story is often republished by mirror domains with small changes,
+so the full url does not identify it. Each text is reduced to a MinHash
+signature of 128 values computed on its word 5-grams. The fraction of equal
+values of two signatures estimates the Jaccard similarity of their texts.
+
+The signatures are split in 32 bands of 4 values, each band is hashed to a
+bucket. Texts sharing a bucket are candidates, the candidates with an
+estimated similarity over the threshold are near-duplicates. The buckets
+and signatures are kept in a SQLite file, a lookup is a single indexed
+query whatever the size of the corpus and the memory used does not grow
+with it.
+
+Each indexed news belongs to a cluster, identified by the id of its first
+news, and references the result cache entries of its translation and
+annotation, which the near-duplicates reuse.
+
+Usage, from the `python` folder:
+
+    python scripts/near_duplicates.py rebuild
+    python scripts/near_duplicates.py clusters 20
+"""
+
+from array import array
+from hashlib import blake2b
+from re import UNICODE, compile
+from result_cache import ResultCache
+from sqlite_store import SqliteStore
+from sys import argv
+from threading import Lock
+
+_DEFAULT_PATH = '../cache/near_duplicates.sqlite'
+PERMUTATIONS = 128
+BANDS = 32
+_SHINGLE_SIZE = 5
+_THRESHOLD = 0.8
+_BIN_BITS = 7
+_BIN_MASK = (1 << _BIN_BITS) - 1
+_MAX_HASH = (1 << 64) - 1
+# Added per bin of distance to the values borrowed by the empty bins.
+_DENSIFY_OFFSET = 0x9E3779B97F4A7C15
+_WORD = compile(r'\w+', UNICODE)
+_REBUILD_BATCH = 1000
+
+
+def shingles(text):
+    """
+    Args:
+        text (str)
+    Returns:
+        (set of int) The 64 bits hashes of the word 5-grams of the text
+    """
+
+    words = _WORD.findall(text.lower())
+    grams = [' '.join(words[start:start + _SHINGLE_SIZE])
+             for start in range(max(len(words) - _SHINGLE_SIZE + 1, 1))]
+    return {int.from_bytes(blake2b(gram.encode('utf8'),
+                                   digest_size=8).digest(), 'big')
+            for gram in grams if gram}
+
+
+def minhash(text):
+    """Computes the signature with one permutation hashing.
+
+    A single hash of each shingle is computed: its lowest bits choose one
+    of the 128 bins, the minimum of the other bits is kept in each bin. The
+    empty bins take the value of the next filled bin, shifted by the
+    distance, so two texts fill them the same way. The signature estimates
+    the similarity as 128 permutations do, with one pass on the shingles.
+
+    Args:
+        text (str)
+    Returns:
+        (array) The MinHash signature of the text, None for a text without
+            words
+    """
+
+    hashes = shingles(text)
+    if not hashes:
+        return None
+    bins = [None] * PERMUTATIONS
+    for value in hashes:
+        index = value & _BIN_MASK
+        value >>= _BIN_BITS
+        current = bins[index]
+        if current is None or value < current:
+            bins[index] = value
+    if None not in bins:
+        return array('Q', bins)
+    signature = array('Q')
+    for index in range(PERMUTATIONS):
+        distance = 0
+        while bins[(index + distance) % PERMUTATIONS] is None:
+            distance += 1
+        signature.append((bins[(index + distance) % PERMUTATIONS] +
+                          distance * _DENSIFY_OFFSET) & _MAX_HASH)
+    return signature
+
+
+def similarity(signature, other):
+    """Estimated Jaccard similarity of the texts of two signatures."""
+
+    return sum(1 for a, b in zip(signature, other) if a == b) / len(signature)
+
+
+def _buckets(signature):
+    rows = len(signature) // BANDS
+    buckets = []
+    for band in range(BANDS):
+        digest = blake2b(signature[band * rows:(band + 1) * rows].tobytes(),
+                         digest_size=8, salt=band.to_bytes(2, 'big'))
+        buckets.append(int.from_bytes(digest.digest(), 'big', signed=True))
+    return buckets
+
+
+class NearDuplicateIndex(SqliteStore):
+    _SCHEMA = ['CREATE TABLE IF NOT EXISTS documents ('
+               'id TEXT PRIMARY KEY, '
+               'cluster TEXT NOT NULL, '
+               'signature BLOB NOT NULL, '
+               'translation_key TEXT, '
+               'annotation_key TEXT)',
+               'CREATE TABLE IF NOT EXISTS buckets ('
+               'bucket INTEGER NOT NULL, '
+               'id TEXT NOT NULL, '
+               'PRIMARY KEY (bucket, id)) WITHOUT ROWID',
+               'CREATE INDEX IF NOT EXISTS documents_cluster '
+               'ON documents (cluster)']
+
+    def __init__(self, path=_DEFAULT_PATH, threshold=_THRESHOLD):
+        """
+        Arguments:
+            path (str): The SQLite file
+            threshold (float): Minimum estimated similarity of two
+                near-duplicates
+        """
+
+        assert 0 < threshold <= 1
+        super().__init__(path)
+        self._threshold = threshold
+        self._lock = Lock()
+
+    def _transaction(self, function):
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = function(connection)
+                connection.execute('COMMIT')
+                return result
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+
+    def _find(self, connection, signature):
+        buckets = _buckets(signature)
+        rows = connection.execute(
+            'SELECT id, cluster, signature, translation_key, annotation_key '
+            'FROM documents WHERE id IN ('
+            'SELECT id FROM buckets WHERE bucket IN (%s))' %
+            ', '.join('?' * len(buckets)), buckets).fetchall()
+        best = None
+        for news_id, cluster, blob, translation_key, annotation_key in rows:
+            candidate = array('Q')
+            candidate.frombytes(blob)
+            value = similarity(signature, candidate)
+            if value >= self._threshold and (
+                    best is None or value > best['similarity']):
+                best = {'id': news_id, 'cluster': cluster,
+                        'similarity': value,
+                        'translation_key': translation_key,
+                        'annotation_key': annotation_key}
+        return best
+
+    def find(self, signature):
+        """
+        Arguments:
+            signature (array): See `minhash`
+        Returns:
+            (dict): The `id`, `cluster`, `similarity`, `translation_key` and
+                `annotation_key` of the most similar near-duplicate, None
+                when there is none
+        """
+
+        with self._lock:
+            return self._find(self._connect(), signature)
+
+    @staticmethod
+    def _insert(connection, entries):
+        documents = []
+        buckets = []
+        for news_id, signature, cluster, translation_key, annotation_key \
+                in entries:
+            assert news_id is not None and len(news_id) > 0
+            documents.append((news_id, cluster or news_id,
+                              signature.tobytes(), translation_key,
+                              annotation_key))
+            buckets.extend((bucket, news_id)
+                           for bucket in _buckets(signature))
+        connection.executemany('DELETE FROM buckets WHERE id = ?',
+                               [(entry[0],) for entry in entries])
+        connection.executemany(
+            'INSERT OR REPLACE INTO documents (id, cluster, signature, '
+            'translation_key, annotation_key) VALUES (?, ?, ?, ?, ?)',
+            documents)
+        connection.executemany(
+            'INSERT OR IGNORE INTO buckets (bucket, id) VALUES (?, ?)',
+            buckets)
+
+    def add(self, news_id, signature, *, cluster=None, translation_key=None,
+            annotation_key=None):
+        """Indexes a news, replacing its previous entry.
+
+        Arguments:
+            news_id (str)
+            signature (array): See `minhash`
+            cluster (str): The cluster of the news, its id by default
+            translation_key (str): The result cache key of its translation,
+                None when it was not translated
+            annotation_key (str): The result cache key of its annotation
+        """
+
+        entry = (news_id, signature, cluster, translation_key,
+                 annotation_key)
+        self._transaction(lambda connection: self._insert(connection,
+                                                          [entry]))
+
+    def clear(self):
+        def delete(connection):
+            connection.execute('DELETE FROM buckets')
+            connection.execute('DELETE FROM documents')
+
+        self._transaction(delete)
+
+    def clusters(self, k=10):
+        """Returns the (cluster, size) of the k largest clusters."""
+
+        with self._lock:
+            return self._connect().execute(
+                'SELECT cluster, COUNT(*) AS size FROM documents '
+                'GROUP BY cluster HAVING size > 1 '
+                'ORDER BY size DESC LIMIT ?', [k]).fetchall()
+
+    def _index_batch(self, news_batch, result_cache, totals):
+        def index(connection):
+            for news in news_batch:
+                signature = minhash(news['text_original'])
+                if signature is None:
+                    continue
+                duplicate = self._find(connection, signature)
+                if duplicate is not None:
+                    totals['duplicates'] += 1
+                translation_key = None
+                if news.get('translator') not in [None, 'none']:
+                    translation_key = ResultCache.translation_key(
+                        news['text_original'], 'en')
+                annotation_key = ResultCache.annotation_key(news['text_en'])
+                self._insert(connection, [(
+                    news['id'], signature,
+                    duplicate['cluster'] if duplicate else None,
+                    translation_key, annotation_key)])
+                totals['indexed'] += 1
+                if result_cache is None:
+                    continue
+                if translation_key is not None:
+                    result_cache.put(translation_key, {
+                        'translator': news['translator'],
+                        'text_en': news['text_en']})
+                result_cache.put(annotation_key, {
+                    'sentiment_score': news.get('sentiment_score'),
+                    'sentiment_magnitude': news.get('sentiment_magnitude'),
+                    'entities': [[entity.get('name'), entity.get('type'),
+                                  entity.get('salience'),
+                                  entity.get('wikipedia_url')]
+                                 for entity in news.get('entities') or []]})
+
+        self._transaction(index)
+
+    def rebuild(self, news_stream, result_cache=None):
+        """Indexes the analysed news, clustering them in stream order.
+
+        Arguments:
+            news_stream (iterable of dict): The news
+            result_cache (ResultCache): When set, the translation and
+                annotation of each indexed news are stored in it, so its
+                near-duplicates reuse them
+        Returns:
+            (dict): The number of news `indexed` and of `duplicates`
+        """
+
+        self.clear()
+        totals = {'indexed': 0, 'duplicates': 0}
+        batch = []
+        for news in news_stream:
+            if news.get('text_analysed') and news.get('text_original') \
+                    and news.get('text_en'):
+                batch.append(news)
+            if len(batch) >= _REBUILD_BATCH:
+                self._index_batch(batch, result_cache, totals)
+                batch = []
+        if batch:
+            self._index_batch(batch, result_cache, totals)
+        return totals
+
+
+if __name__ == '__main__':
+    index = NearDuplicateIndex()
+    if len(argv) > 1 and argv[1] == 'rebuild':
+        from dataset_dump import iter_news
+        from structured_log import get_logger
+
+        dump = argv[2] if len(argv) > 2 else '../dataset/euvsdisinfo.tar.bz2'
+        get_logger('near_duplicates').info(
+            'Near-duplicate index rebuilt.',
+            **index.rebuild(iter_news(dump), ResultCache()))
+    else:
+        limit = int(argv[2]) if len(argv) > 2 else 10
+        for cluster, size in index.clusters(limit):
+            print('%8d %s' % (size, cluster))
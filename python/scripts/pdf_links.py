@@ -0,0 +1,83 @@
+"""Extraction of the links contained in the newsletter PDFs.
+
+The PDF is read in process, page by page. Links are taken both from the
+page text and from the URI link annotations, which hold the hyperlinks not
+printed in the text.
+"""
+
+from metrics import timed
+from multiprocessing import Pool
+from pypdf import PdfReader
+from re import compile, escape
+
+_LINK_PREFIX = 'http://bit.ly/'
+_PROCESSES = 4
+
+
+def _link_pattern(prefix):
+    # Short link codes are made of letters, digits, '-' and '_', this leaves
+    # out the punctuation following the links in the text.
+    return compile(escape(prefix) + r'[\w\-]+')
+
+
+def iter_page_links(file_name, prefix=_LINK_PREFIX):
+    """Yields the links of each page, text links first.
+
+    Args:
+        file_name (str)
+        prefix (str) Only the links starting with the prefix are returned
+    Returns:
+        (generator of list) The links of each page
+    """
+
+    pattern = _link_pattern(prefix)
+    reader = PdfReader(file_name)
+    for page in reader.pages:
+        links = pattern.findall(page.extract_text() or '')
+        for annotation in page.get('/Annots') or []:
+            action = annotation.get_object().get('/A')
+            if action is None:
+                continue
+            uri = action.get_object().get('/URI')
+            if uri:
+                links.extend(pattern.findall(str(uri)))
+        yield links
+
+
+def extract_links(file_name, prefix=_LINK_PREFIX):
+    """
+    Args:
+        file_name (str)
+        prefix (str) Only the links starting with the prefix are returned
+    Returns:
+        (list of str) The links in order of appearance, without duplicates
+    """
+
+    links = {}
+    with timed('pdf_parse', provider='pypdf'):
+        for page_links in iter_page_links(file_name, prefix):
+            for link in page_links:
+                links[link] = True
+    return list(links)
+
+
+def _extract_links_task(args):
+    return extract_links(*args)
+
+
+def extract_links_from_files(file_names, prefix=_LINK_PREFIX,
+                             processes=_PROCESSES):
+    """Extracts the links of many files in a process pool.
+
+    Args:
+        file_names (list of str)
+        prefix (str)
+        processes (int)
+    Returns:
+        (dict) file name -> list of links
+    """
+
+    with Pool(processes) as pool:
+        results = pool.map(_extract_links_task,
+                           [(file_name, prefix) for file_name in file_names])
+    return dict(zip(file_names, results))
@@ -0,0 +1,152 @@
+"""Thread based processing pipeline.
+
+Items flow through a chain of stages connected by bounded queues. Each stage
+has its own number of worker threads, a full queue blocks the previous
+stage, so a slow service slows down the producer instead of piling up
+items in memory.
+"""
+
+from queue import Queue
+from structured_log import get_logger
+from threading import Lock, Thread
+from time import monotonic
+
+_QUEUE_SIZE = 100
+_STOP = object()
+
+_logger = get_logger('pipeline')
+
+
+class Stage(object):
+    def __init__(self, name, function, *, workers=1, queue_size=_QUEUE_SIZE):
+        """
+        Arguments:
+            name (str)
+            function (function): Called with each item, returns the item
+                for the next stage or None to drop it
+            workers (int): Number of threads running the function
+            queue_size (int): Maximum number of items waiting for the stage
+        """
+
+        assert workers > 0
+        assert queue_size > 0
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue = Queue(maxsize=queue_size)
+        self._lock = Lock()
+        self._running = workers
+        self._stats = {'processed': 0, 'dropped': 0, 'errors': 0,
+                       'busy_seconds': 0.0, 'max_seconds': 0.0}
+
+    def _record(self, outcome, seconds):
+        with self._lock:
+            self._stats[outcome] += 1
+            self._stats['busy_seconds'] += seconds
+            self._stats['max_seconds'] = max(self._stats['max_seconds'],
+                                             seconds)
+
+    def _worker_done(self):
+        """Returns True when the last worker of the stage is done."""
+
+        with self._lock:
+            self._running -= 1
+            return self._running == 0
+
+    def stats(self, elapsed):
+        with self._lock:
+            stats = dict(self._stats)
+        done = stats['processed'] + stats['dropped'] + stats['errors']
+        stats['mean_seconds'] = stats['busy_seconds'] / done if done else 0.0
+        stats['items_per_second'] = done / elapsed if elapsed > 0 else 0.0
+        stats['queued'] = self.queue.qsize()
+        return stats
+
+
+class Pipeline(object):
+    """Runs the stages, must be used as context manager.
+
+    Leaving the context waits until every item put in the pipeline went
+    through all the stages.
+    """
+
+    def __init__(self, stages, *, on_error=None):
+        """
+        Arguments:
+            stages (list of Stage)
+            on_error (function): Called with the stage name, the item and
+                the exception when a stage raises
+        """
+
+        assert stages, 'Missing stages'
+        self._stages = stages
+        self._on_error = on_error
+        self._threads = []
+        self._aborted = False
+        self._started = None
+
+    def __enter__(self):
+        self._started = monotonic()
+        for position, stage in enumerate(self._stages):
+            for number in range(stage.workers):
+                thread = Thread(target=self._work, args=[position],
+                                name='%s-%d' % (stage.name, number),
+                                daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._aborted = True
+        self._stop_stage(self._stages[0])
+        for thread in self._threads:
+            thread.join()
+
+    @staticmethod
+    def _stop_stage(stage):
+        for _ in range(stage.workers):
+            stage.queue.put(_STOP)
+
+    def put(self, item):
+        """Adds an item, blocks while the first stage queue is full."""
+
+        self._stages[0].queue.put(item)
+
+    def _work(self, position):
+        stage = self._stages[position]
+        next_stage = self._stages[position + 1] \
+            if position + 1 < len(self._stages) else None
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                break
+            if self._aborted:
+                continue
+            start = monotonic()
+            try:
+                result = stage.function(item)
+            except Exception as e:
+                stage._record('errors', monotonic() - start)
+                if self._on_error is not None:
+                    try:
+                        self._on_error(stage.name, item, e)
+                    except Exception as handler_error:
+                        _logger.error('Error handler failed.',
+                                      stage=stage.name,
+                                      error=str(handler_error))
+                continue
+            if result is None:
+                stage._record('dropped', monotonic() - start)
+                continue
+            stage._record('processed', monotonic() - start)
+            if next_stage is not None:
+                next_stage.queue.put(result)
+        if stage._worker_done() and next_stage is not None:
+            self._stop_stage(next_stage)
+
+    def stats(self):
+        """Counters, latency and throughput of each stage."""
+
+        elapsed = monotonic() - self._started if self._started else 0.0
+        return {stage.name: stage.stats(elapsed) for stage in self._stages}
@@ -0,0 +1,167 @@
+"""Registry of the external providers of the text analysis.
+
+The extractors, translators and annotators are registered by name and the
+one used is chosen by the `EXTRACTOR`, `TRANSLATOR` and `ANNOTATOR`
+environment variables, or the first registered. A provider only imports
+its SDK when it is used for the first time, so importing the scripts stays
+cheap and a process does not load the SDKs of the providers it does not
+use.
+
+The SDK clients are long lived: `client` builds one per provider and per
+process, shared by its threads, and a forked worker builds its own ones
+instead of using the inherited ones.
+
+The first import, client construction and call of each provider are timed
+once per process, see `startup_report`. To profile the startup of the
+extraction script, from the `python` folder:
+
+    python scripts/providers.py profile
+"""
+
+from contextlib import contextmanager
+from importlib import import_module
+from os import environ, getpid
+from sys import argv, path
+from threading import Lock
+from time import perf_counter
+
+KINDS = ['extractor', 'translator', 'annotator']
+
+_registry = {kind: {} for kind in KINDS}
+_clients = {'pid': None, 'values': {}}
+_clients_lock = Lock()
+_startup = {'imports': {}, 'clients': {}, 'first_calls': {}}
+_startup_pid = getpid()
+_lock = Lock()
+
+
+def _record(step, name, seconds):
+    """Keeps the first duration of a startup step in this process."""
+
+    global _startup, _startup_pid
+    with _lock:
+        if _startup_pid != getpid():
+            _startup = {step: {} for step in _startup}
+            _startup_pid = getpid()
+        _startup[step].setdefault(name, round(seconds, 6))
+
+
+@contextmanager
+def startup_step(step, name):
+    """Times a step of the startup, see `startup_report`.
+
+    Arguments:
+        step (str): `imports`, `clients` or `first_calls`
+        name (str): The module or provider
+    """
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        _record(step, name, perf_counter() - start)
+
+
+def lazy_import(module_name):
+    """Imports a module, timing its first import in this process."""
+
+    with startup_step('imports', module_name):
+        return import_module(module_name)
+
+
+def register(kind, name, function):
+    """
+    Arguments:
+        kind (str): One of KINDS
+        name (str): The provider name, the value of the environment variable
+            selecting it
+        function (function): Called with the url for an extractor, the text
+            for a translator or an annotator
+    """
+
+    assert kind in KINDS, 'Unknown provider kind [%s].' % kind
+    _registry[kind][name] = function
+
+
+def names(kind):
+    return list(_registry[kind])
+
+
+def selected(kind):
+    """
+    Returns:
+        (function): The provider selected for the kind, its first call in
+            the process is timed
+    """
+
+    providers = _registry[kind]
+    assert providers, 'No [%s] registered.' % kind
+    name = environ.get(kind.upper()) or next(iter(providers))
+    if name not in providers:
+        raise ValueError('Unknown %s [%s], expected one of [%s].' % (
+            kind, name, ', '.join(providers)))
+    function = providers[name]
+
+    def call(*args, **kwargs):
+        with startup_step('first_calls', '%s:%s' % (kind, name)):
+            return function(*args, **kwargs)
+
+    return call
+
+
+def client(name, factory):
+    """Returns the client of a provider for the current process.
+
+    The client is shared by the threads of the process, the SDK clients
+    are thread safe.
+
+    Arguments:
+        name (str): The provider
+        factory (function): Builds the client, called once per process
+    """
+
+    with _clients_lock:
+        if _clients['pid'] != getpid():
+            _clients['pid'] = getpid()
+            _clients['values'] = {}
+        values = _clients['values']
+        if name not in values:
+            with startup_step('clients', name):
+                values[name] = factory()
+        return values[name]
+
+
+def startup_report():
+    """
+    Returns:
+        (dict): The seconds of the first `imports`, `clients`
+            construction and `first_calls` of each provider in this process
+    """
+
+    with _lock:
+        if _startup_pid != getpid():
+            return {step: {} for step in _startup}
+        return {step: dict(values) for step, values in _startup.items()}
+
+
+if __name__ == '__main__':
+    if len(argv) > 1 and argv[1] == 'profile':
+        from importlib.util import module_from_spec, spec_from_file_location
+        from json import dumps
+        from os.path import abspath, dirname, join
+
+        scripts = dirname(abspath(__file__))
+        path.insert(0, scripts)
+        # The script registers its providers in the imported module, not in
+        # this __main__ one.
+        registry = import_module('providers')
+        spec = spec_from_file_location(
+            'extract_article_content',
+            join(scripts, '02_extract_article_content.py'))
+        with registry.startup_step('imports', '02_extract_article_content'):
+            spec.loader.exec_module(module_from_spec(spec))
+        report = registry.startup_report()
+        report['providers'] = {kind: registry.names(kind) for kind in KINDS}
+        print(dumps(report, indent=2, sort_keys=True))
+    else:
+        print('Usage: python scripts/providers.py profile')
@@ -0,0 +1,174 @@
+"""Rate limits shared by all the processes calling the paid APIs.
+
+Each provider has a token bucket for the requests per second and a counter
+of the characters sent in the current UTC day. The state is kept in a
+SQLite file, so the limits hold across threads, worker processes and runs.
+When a provider answers 429 or 403 it is blocked with an exponential
+backoff, documents hitting a blocked or exhausted provider are deferred
+instead of being marked as errors.
+"""
+
+from datetime import datetime, timedelta
+from sqlite_store import SqliteStore
+from threading import Lock
+from time import sleep, time
+
+_DEFAULT_PATH = '../cache/rate_limit.sqlite'
+_MAX_WAIT = 60
+_INITIAL_BACKOFF = 1
+_MAX_BACKOFF = 15 * 60
+
+
+class QuotaDeferred(Exception):
+    """The provider can not be called before `retry_at`."""
+
+    # Outcome of the call in the metrics.
+    outcome = 'deferred'
+
+    def __init__(self, provider, retry_at):
+        super().__init__('Provider [%s] quota exceeded, retry after [%s].' % (
+            provider, datetime.utcfromtimestamp(retry_at).isoformat()))
+        self.provider = provider
+        self.retry_at = retry_at
+
+
+def _next_day(now):
+    day = datetime.utcfromtimestamp(now).date() + timedelta(days=1)
+    return (datetime(day.year, day.month, day.day) -
+            datetime(1970, 1, 1)).total_seconds()
+
+
+class RateLimiter(SqliteStore):
+    _SCHEMA = ['CREATE TABLE IF NOT EXISTS providers ('
+               'name TEXT PRIMARY KEY, '
+               'tokens REAL NOT NULL, '
+               'updated_at REAL NOT NULL, '
+               'day TEXT NOT NULL, '
+               'characters INTEGER NOT NULL, '
+               'blocked_until REAL NOT NULL, '
+               'backoff REAL NOT NULL)']
+
+    def __init__(self, limits, path=_DEFAULT_PATH, *, max_wait=_MAX_WAIT):
+        """
+        Arguments:
+            limits (dict): Provider name -> dict with the optional keys
+                `requests_per_second` and `characters_per_day`, providers
+                not listed are not limited
+            path (str): The SQLite file shared by the processes
+            max_wait (float): Seconds `acquire` waits before deferring
+        """
+
+        self._limits = limits
+        super().__init__(path)
+        self._max_wait = max_wait
+        self._lock = Lock()
+
+    def _update(self, provider, change):
+        """Runs `change(row, now)` in a write transaction.
+
+        The row is a dict with the current provider state, `change` modifies
+        it and returns the value returned by this method.
+        """
+
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                now = time()
+                row = connection.execute(
+                    'SELECT tokens, updated_at, day, characters, '
+                    'blocked_until, backoff FROM providers WHERE name = ?',
+                    [provider]).fetchone()
+                if row is None:
+                    row = (self._capacity(provider), now, '', 0, 0.0, 0.0)
+                state = dict(zip(['tokens', 'updated_at', 'day', 'characters',
+                                  'blocked_until', 'backoff'], row))
+                result = change(state, now)
+                connection.execute(
+                    'INSERT OR REPLACE INTO providers (name, tokens, '
+                    'updated_at, day, characters, blocked_until, backoff) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [provider, state['tokens'], state['updated_at'],
+                     state['day'], state['characters'],
+                     state['blocked_until'], state['backoff']])
+                connection.execute('COMMIT')
+                return result
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+
+    def _capacity(self, provider):
+        rate = self._limits.get(provider, {}).get('requests_per_second')
+        return max(1.0, rate) if rate else 0.0
+
+    def acquire(self, provider, characters=0):
+        """Waits until the provider can be called.
+
+        Arguments:
+            provider (str)
+            characters (int): The characters sent with the request
+        Raises:
+            QuotaDeferred: When the provider is blocked or its daily
+                characters are exhausted for longer than `max_wait`
+        """
+
+        limits = self._limits.get(provider)
+        if not limits:
+            return
+        rate = limits.get('requests_per_second')
+        daily = limits.get('characters_per_day')
+
+        def take(state, now):
+            day = datetime.utcfromtimestamp(now).strftime('%Y-%m-%d')
+            if state['day'] != day:
+                state['day'] = day
+                state['characters'] = 0
+            if rate:
+                state['tokens'] = min(
+                    self._capacity(provider),
+                    state['tokens'] + (now - state['updated_at']) * rate)
+            state['updated_at'] = now
+            if state['blocked_until'] > now:
+                return state['blocked_until']
+            if daily and state['characters'] + characters > daily:
+                raise QuotaDeferred(provider, _next_day(now))
+            if rate and state['tokens'] < 1:
+                return now + (1 - state['tokens']) / rate
+            if rate:
+                state['tokens'] -= 1
+            state['characters'] += characters
+            if now > state['blocked_until'] + state['backoff']:
+                state['backoff'] = 0.0
+            return None
+
+        deadline = time() + self._max_wait
+        while True:
+            retry_at = self._update(provider, take)
+            if retry_at is None:
+                return
+            if retry_at > deadline:
+                raise QuotaDeferred(provider, retry_at)
+            sleep(max(retry_at - time(), 0))
+
+    def penalize(self, provider, retry_after=None):
+        """Blocks the provider after a 429 or 403 response.
+
+        The backoff doubles at each penalty and is cleared by the first
+        call allowed after a quiet period as long as the backoff.
+
+        Arguments:
+            provider (str)
+            retry_after (float): Seconds requested by the provider, if any
+        Returns:
+            (float): The timestamp until the provider is blocked
+        """
+
+        def block(state, now):
+            state['backoff'] = min(_MAX_BACKOFF,
+                                   max(_INITIAL_BACKOFF,
+                                       state['backoff'] * 2))
+            delay = retry_after if retry_after else state['backoff']
+            state['blocked_until'] = max(state['blocked_until'], now + delay)
+            return state['blocked_until']
+
+        return self._update(provider, block)
@@ -0,0 +1,205 @@
+"""Content addressed cache of the paid API results.
+
+Each processing stage has its own key: the full url for the article
+extraction, a hash of the text and target language for the translation and
+a hash of the English text for the annotation. Values are stored as json in
+a pluggable store which evicts the least recently used entries once its
+size limit is reached.
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps, loads
+from sqlite_store import SqliteStore
+from threading import Lock
+from time import time
+
+_DEFAULT_PATH = '../cache/results.sqlite'
+_MAX_BYTES = 1024 * 1024 * 1024
+# Access times kept in memory before being written with the next put.
+_ACCESS_BATCH = 100
+
+
+def _digest(*parts):
+    digest = sha256()
+    for part in parts:
+        digest.update(part.encode('utf8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class MemoryResultStore(object):
+    """Store kept in the process memory."""
+
+    def __init__(self, max_bytes=_MAX_BYTES):
+        assert max_bytes > 0
+        self._max_bytes = max_bytes
+        self._size = 0
+        self._values = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                self._values.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._values:
+                self._size -= len(self._values.pop(key))
+            self._values[key] = value
+            self._size += len(value)
+            while self._size > self._max_bytes and len(self._values) > 1:
+                self._size -= len(self._values.popitem(last=False)[1])
+
+
+class SqliteResultStore(SqliteStore):
+    """Store kept in a SQLite file, it can be shared between processes.
+
+    The total size of the values is kept in the one-row `stats` table. The
+    access times read by the eviction are written in batches, so the
+    latest reads of a process may be lost when it stops.
+    """
+
+    _SCHEMA = ['CREATE TABLE IF NOT EXISTS results ('
+               'key TEXT PRIMARY KEY, '
+               'value TEXT NOT NULL, '
+               'size INTEGER NOT NULL, '
+               'accessed_at REAL NOT NULL)',
+               'CREATE INDEX IF NOT EXISTS results_accessed_at '
+               'ON results (accessed_at)',
+               'CREATE TABLE IF NOT EXISTS stats ('
+               'id INTEGER PRIMARY KEY CHECK (id = 0), '
+               'size INTEGER NOT NULL)',
+               'INSERT OR IGNORE INTO stats (id, size) '
+               'SELECT 0, COALESCE(SUM(size), 0) FROM results']
+
+    def __init__(self, path=_DEFAULT_PATH, max_bytes=_MAX_BYTES,
+                 access_batch=_ACCESS_BATCH):
+        assert max_bytes > 0
+        assert access_batch > 0
+        super().__init__(path)
+        self._max_bytes = max_bytes
+        self._access_batch = access_batch
+        self._accessed = {}
+        self._lock = Lock()
+
+    def _connected(self, connection):
+        self._accessed = {}
+
+    def get(self, key):
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute('SELECT value FROM results WHERE key = ?',
+                                     [key]).fetchone()
+            if row is None:
+                return None
+            self._accessed[key] = time()
+            if len(self._accessed) >= self._access_batch:
+                self._flush_accessed(connection)
+            return row[0]
+
+    def _flush_accessed(self, connection):
+        connection.executemany(
+            'UPDATE results SET accessed_at = ? WHERE key = ?',
+            [(accessed_at, key)
+             for key, accessed_at in self._accessed.items()])
+        self._accessed = {}
+
+    def put(self, key, value):
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._flush_accessed(connection)
+                row = connection.execute(
+                    'SELECT size FROM results WHERE key = ?',
+                    [key]).fetchone()
+                connection.execute(
+                    'INSERT OR REPLACE INTO results '
+                    '(key, value, size, accessed_at) VALUES (?, ?, ?, ?)',
+                    [key, value, len(value), time()])
+                connection.execute(
+                    'UPDATE stats SET size = size + ? WHERE id = 0',
+                    [len(value) - (row[0] if row is not None else 0)])
+                self._evict(connection)
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+
+    def _evict(self, connection):
+        size = connection.execute(
+            'SELECT size FROM stats WHERE id = 0').fetchone()[0]
+        if size <= self._max_bytes:
+            return
+        rows = connection.execute(
+            'SELECT key, size FROM results ORDER BY accessed_at')
+        evicted = []
+        evicted_size = 0
+        for key, entry_size in rows:
+            if size - evicted_size <= self._max_bytes:
+                break
+            evicted.append((key,))
+            evicted_size += entry_size
+        connection.executemany('DELETE FROM results WHERE key = ?', evicted)
+        connection.execute('UPDATE stats SET size = size - ? WHERE id = 0',
+                           [evicted_size])
+
+
+class ResultCache(object):
+    def __init__(self, store=None):
+        """
+        Arguments:
+            store (object): Any object with `get(key)` and `put(key, value)`
+                methods working on strings, SqliteResultStore by default
+        """
+
+        self._store = SqliteResultStore() if store is None else store
+        self._stats = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def extraction_key(full_url):
+        return 'extraction:' + full_url.strip()
+
+    @staticmethod
+    def translation_key(text, target_language):
+        return 'translation:' + _digest(target_language, text)
+
+    @staticmethod
+    def annotation_key(text_en):
+        return 'annotation:' + _digest(text_en)
+
+    def get(self, key):
+        value = self._store.get(key)
+        if value is None:
+            self._stats['misses'] += 1
+            return None
+        self._stats['hits'] += 1
+        return loads(value)
+
+    def put(self, key, value):
+        assert value is not None
+        self._store.put(key, dumps(value))
+
+    def fetch(self, key, compute):
+        """Returns the cached value or computes and stores it.
+
+        Arguments:
+            key (str)
+            compute (function): Called without arguments on cache miss,
+                must return a json serializable value
+        """
+
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        """Hit and miss counters of the current process."""
+
+        return dict(self._stats)
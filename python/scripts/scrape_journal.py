@@ -0,0 +1,122 @@
+"""Journal of the newsletters already scraped.
+
+For each newsletter url the journal records whether it was not found,
+downloaded, parsed or merged, and for each downloaded file its content hash
+and the links extracted from it. The journal is a SQLite file shared by
+the worker processes, each step is committed as soon as it is done, so a
+run stopped halfway resumes from the last completed step.
+"""
+
+from hashlib import sha256
+from json import dumps, loads
+from os import stat
+from sqlite_store import SqliteStore
+from time import time
+
+_DEFAULT_PATH = '../cache/scrape_journal.sqlite'
+
+MISSING = 'missing'
+DOWNLOADED = 'downloaded'
+PARSED = 'parsed'
+MERGED = 'merged'
+
+
+def _file_digest(file_name):
+    digest = sha256()
+    with open(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ScrapeJournal(SqliteStore):
+    _SCHEMA = ['CREATE TABLE IF NOT EXISTS urls ('
+               'url TEXT PRIMARY KEY, '
+               'newsletter_date TEXT, '
+               'status TEXT NOT NULL, '
+               'file_name TEXT, '
+               'sha256 TEXT, '
+               'updated_at REAL NOT NULL)',
+               'CREATE TABLE IF NOT EXISTS files ('
+               'file_name TEXT PRIMARY KEY, '
+               'size INTEGER NOT NULL, '
+               'mtime REAL NOT NULL, '
+               'sha256 TEXT NOT NULL, '
+               'links TEXT)']
+
+    def __init__(self, path=_DEFAULT_PATH):
+        super().__init__(path)
+
+    def get_url(self, url):
+        """
+        Arguments:
+            url (str)
+        Returns:
+            (dict): The `status`, `file_name`, `sha256` and `updated_at` of
+                the url, None when the url was never seen
+        """
+
+        row = self._connect().execute(
+            'SELECT status, file_name, sha256, updated_at FROM urls '
+            'WHERE url = ?', [url]).fetchone()
+        if row is None:
+            return None
+        return dict(zip(['status', 'file_name', 'sha256', 'updated_at'], row))
+
+    def set_url(self, url, status, *, newsletter_date=None, file_name=None,
+                digest=None):
+        """
+        Arguments:
+            url (str)
+            status (str): One of MISSING, DOWNLOADED, PARSED or MERGED
+            newsletter_date (datetime)
+            file_name (str)
+            digest (str): The file content hash
+        """
+
+        assert status in [MISSING, DOWNLOADED, PARSED, MERGED]
+        date_str = newsletter_date.strftime('%Y-%m-%d') \
+            if newsletter_date is not None else None
+        self._connect().execute(
+            'INSERT OR REPLACE INTO urls (url, newsletter_date, status, '
+            'file_name, sha256, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            [url, date_str, status, file_name, digest, time()])
+
+    def file_digest(self, file_name):
+        """Returns the content hash, only read again when the file changed."""
+
+        connection = self._connect()
+        info = stat(file_name)
+        row = connection.execute(
+            'SELECT size, mtime, sha256 FROM files WHERE file_name = ?',
+            [file_name]).fetchone()
+        if row is not None and row[0] == info.st_size \
+                and row[1] == info.st_mtime:
+            return row[2]
+        digest = _file_digest(file_name)
+        if row is None or row[2] != digest:
+            connection.execute(
+                'INSERT OR REPLACE INTO files '
+                '(file_name, size, mtime, sha256, links) '
+                'VALUES (?, ?, ?, ?, NULL)',
+                [file_name, info.st_size, info.st_mtime, digest])
+        else:
+            connection.execute(
+                'UPDATE files SET size = ?, mtime = ? WHERE file_name = ?',
+                [info.st_size, info.st_mtime, file_name])
+        return digest
+
+    def get_links(self, file_name, digest):
+        """Returns the links extracted from the file with the given hash."""
+
+        row = self._connect().execute(
+            'SELECT links FROM files WHERE file_name = ? AND sha256 = ?',
+            [file_name, digest]).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return loads(row[0])
+
+    def set_links(self, file_name, digest, links):
+        self._connect().execute(
+            'UPDATE files SET links = ? WHERE file_name = ? AND sha256 = ?',
+            [dumps(links), file_name, digest])
@@ -0,0 +1,39 @@
+"""Base of the stores kept in a SQLite file shared by several processes.
+
+Each process opens its own connection on first use, a connection inherited
+through a fork is never used. Connections are in autocommit mode, the
+stores open their transactions explicitly, and use the WAL journal so the
+readers do not wait for the writer.
+"""
+
+from os import getpid, makedirs
+from os.path import dirname
+from sqlite3 import connect
+
+
+class SqliteStore(object):
+    # Statements creating the tables and indexes, run on each connection.
+    _SCHEMA = []
+
+    def __init__(self, path):
+        self._path = path
+        self._connection = None
+        self._connection_pid = None
+
+    def _connected(self, connection):
+        """Called when the process opens its connection."""
+
+    def _connect(self):
+        if self._connection is not None and self._connection_pid == getpid():
+            return self._connection
+        if dirname(self._path):
+            makedirs(dirname(self._path), exist_ok=True)
+        connection = connect(self._path, timeout=30, isolation_level=None,
+                             check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        for statement in self._SCHEMA:
+            connection.execute(statement)
+        self._connected(connection)
+        self._connection = connection
+        self._connection_pid = getpid()
+        return connection
@@ -0,0 +1,76 @@
+"""JSON lines logging.
+
+Each record is printed on stdout as one JSON object with the time, level,
+logger name, process id and message, plus the fields passed as keyword
+arguments:
+
+    _logger = get_logger('scrape')
+    _logger.info('Link not resolved.', short_url=short_url, error=error)
+
+The level is read from the `LOG_LEVEL` environment variable, INFO by
+default.
+"""
+
+from datetime import datetime, timezone
+from json import dumps
+from logging import Formatter, LoggerAdapter, StreamHandler, getLogger
+from os import environ, getpid
+from sys import stdout
+from threading import Lock
+
+_ROOT = 'fakenews'
+_LOGGING_KWARGS = {'exc_info', 'stack_info', 'stacklevel', 'extra'}
+
+_lock = Lock()
+_configured = False
+
+
+class _JsonFormatter(Formatter):
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(
+                     record.created, timezone.utc).isoformat(),
+                 'level': record.levelname,
+                 'logger': record.name[len(_ROOT) + 1:] or record.name,
+                 'pid': getpid(),
+                 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return dumps(entry, default=str, ensure_ascii=False)
+
+
+class _FieldsAdapter(LoggerAdapter):
+    """Moves the keyword arguments of the log calls to the record fields."""
+
+    def process(self, msg, kwargs):
+        fields = {key: kwargs.pop(key) for key in list(kwargs)
+                  if key not in _LOGGING_KWARGS}
+        kwargs.setdefault('extra', {})['fields'] = fields
+        return msg, kwargs
+
+
+def _configure():
+    global _configured
+    with _lock:
+        if _configured:
+            return
+        handler = StreamHandler(stdout)
+        handler.setFormatter(_JsonFormatter())
+        root = getLogger(_ROOT)
+        root.addHandler(handler)
+        root.setLevel(environ.get('LOG_LEVEL', 'INFO').upper())
+        root.propagate = False
+        _configured = True
+
+
+def get_logger(name):
+    """
+    Args:
+        name (str) The component name, written in each record
+    Returns:
+        (LoggerAdapter) A logger taking the record fields as keyword
+            arguments
+    """
+
+    _configure()
+    return _FieldsAdapter(getLogger('%s.%s' % (_ROOT, name)), {})
@@ -0,0 +1,104 @@
+"""Splits long texts in chunks accepted by the translation services.
+
+Chunks are packed from whole paragraphs when possible, then from
+sentences and, for very long sentences, from words. Each chunk carries the
+separator which follows it, so the translated chunks can be joined back
+in the original layout.
+"""
+
+from re import compile
+
+# The captured whitespace is kept as separator of the sentence.
+_SENTENCE_BREAK = compile(r'(?<=[.!?;:])(\s+)')
+
+
+def _split_long(text, max_size):
+    """Splits a text without sentence breaks at the last space."""
+
+    result = []
+    while len(text) > max_size:
+        end = text.rfind(' ', 0, max_size + 1)
+        if end <= 0:
+            result.append((text[:max_size], ''))
+            text = text[max_size:]
+        else:
+            result.append((text[:end], ' '))
+            text = text[end + 1:]
+    result.append((text, ''))
+    return result
+
+
+def _units(text, max_size):
+    """Yields (text, separator) units no longer than max_size."""
+
+    paragraphs = text.split('\n')
+    for position, paragraph in enumerate(paragraphs):
+        separator = '\n' if position < len(paragraphs) - 1 else ''
+        if len(paragraph) <= max_size:
+            yield paragraph, separator
+            continue
+        pieces = _SENTENCE_BREAK.split(paragraph)
+        for position in range(0, len(pieces), 2):
+            sentence_separator = pieces[position + 1] \
+                if position + 1 < len(pieces) else separator
+            parts = _split_long(pieces[position], max_size)
+            for part_position, (part, part_separator) in enumerate(parts):
+                if part_position == len(parts) - 1:
+                    part_separator = sentence_separator
+                yield part, part_separator
+
+
+def chunk_text(text, max_size):
+    """
+    Args:
+        text (str)
+        max_size (int) Maximum number of characters of a chunk
+    Returns:
+        (list of tuple) The (chunk, separator) pairs, joining every chunk
+            followed by its separator gives back the text
+    """
+
+    assert max_size > 0
+    chunks = []
+    parts = []
+    size = 0
+    previous_separator = ''
+    for unit, separator in _units(text, max_size):
+        if parts and size + len(previous_separator) + len(unit) > max_size:
+            chunks.append((''.join(parts), previous_separator))
+            parts = []
+            size = 0
+        elif parts:
+            parts.append(previous_separator)
+            size += len(previous_separator)
+        parts.append(unit)
+        size += len(unit)
+        previous_separator = separator
+    chunks.append((''.join(parts), previous_separator))
+    return chunks
+
+
+def batch_texts(texts, max_size, max_count):
+    """Groups consecutive texts in batches for the array endpoints.
+
+    Args:
+        texts (list of str)
+        max_size (int) Maximum number of characters of a batch
+        max_count (int) Maximum number of texts of a batch
+    Returns:
+        (list of list) The positions of the texts in each batch
+    """
+
+    batches = []
+    batch = []
+    size = 0
+    for position, text in enumerate(texts):
+        if batch and (size + len(text) > max_size or len(batch) >= max_count):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(position)
+        size += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
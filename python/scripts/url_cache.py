@@ -0,0 +1,137 @@
+"""Persistent cache of the short url resolutions.
+
+Resolutions are stored in a SQLite database, which can be shared by
+several processes, with an in-memory LRU tier in front of it. Failed
+resolutions (404, no redirect) are cached too, with a shorter time to live.
+"""
+
+from collections import OrderedDict
+from sqlite_store import SqliteStore
+from time import time
+
+_DEFAULT_PATH = '../cache/url_cache.sqlite'
+_MEMORY_SIZE = 10000
+_TTL = 90 * 24 * 3600
+_NEGATIVE_TTL = 24 * 3600
+_MAX_QUERY_PARAMS = 500
+
+
+class ResolutionCache(SqliteStore):
+    _SCHEMA = ['CREATE TABLE IF NOT EXISTS resolutions ('
+               'short_url TEXT PRIMARY KEY, '
+               'full_url TEXT, '
+               'error TEXT, '
+               'expires_at REAL NOT NULL)']
+
+    def __init__(self, path=_DEFAULT_PATH, *, memory_size=_MEMORY_SIZE,
+                 ttl=_TTL, negative_ttl=_NEGATIVE_TTL):
+        """
+        Arguments:
+            path (str): The SQLite file
+            memory_size (int): Entries kept in the in-memory tier
+            ttl (int): Seconds a resolved url is valid
+            negative_ttl (int): Seconds a failed resolution is valid
+        """
+
+        assert memory_size > 0
+        super().__init__(path)
+        self._memory_size = memory_size
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._memory = OrderedDict()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0,
+                       'negative_hits': 0, 'misses': 0}
+
+    def _connected(self, connection):
+        self._memory.clear()
+
+    def _remember(self, short_url, entry):
+        self._memory[short_url] = entry
+        self._memory.move_to_end(short_url)
+        while len(self._memory) > self._memory_size:
+            self._memory.popitem(last=False)
+
+    def _count_hit(self, tier, entry):
+        self._stats[tier] += 1
+        if entry[0] is None:
+            self._stats['negative_hits'] += 1
+
+    def get_many(self, short_urls):
+        """
+        Arguments:
+            short_urls (iterable of str)
+        Returns:
+            (dict): short url -> (full url, error) of the cached entries,
+                full url is None for the failed resolutions
+        """
+
+        connection = self._connect()
+        now = time()
+        result = {}
+        missing = []
+        for short_url in dict.fromkeys(short_urls):
+            entry = self._memory.get(short_url)
+            if entry is not None and entry[2] > now:
+                self._memory.move_to_end(short_url)
+                self._count_hit('memory_hits', entry)
+                result[short_url] = entry[:2]
+            else:
+                missing.append(short_url)
+        disk_hits = 0
+        for start in range(0, len(missing), _MAX_QUERY_PARAMS):
+            part = missing[start:start + _MAX_QUERY_PARAMS]
+            rows = connection.execute(
+                'SELECT short_url, full_url, error, expires_at '
+                'FROM resolutions WHERE expires_at > ? AND short_url IN (%s)'
+                % ','.join('?' * len(part)), [now] + part)
+            for short_url, full_url, error, expires_at in rows:
+                entry = (full_url, error, expires_at)
+                self._remember(short_url, entry)
+                self._count_hit('disk_hits', entry)
+                result[short_url] = entry[:2]
+                disk_hits += 1
+        self._stats['misses'] += len(missing) - disk_hits
+        return result
+
+    def put_many(self, resolved=None, errors=None):
+        """
+        Arguments:
+            resolved (dict): short url -> full url
+            errors (dict): short url -> error message, only for definitive
+                failures
+        """
+
+        now = time()
+        entries = []
+        for short_url, full_url in (resolved or {}).items():
+            entries.append((short_url, full_url, None, now + self._ttl))
+        for short_url, error in (errors or {}).items():
+            entries.append(
+                (short_url, None, error, now + self._negative_ttl))
+        if not entries:
+            return
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany(
+                'INSERT OR REPLACE INTO resolutions '
+                '(short_url, full_url, error, expires_at) '
+                'VALUES (?, ?, ?, ?)', entries)
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        for short_url, full_url, error, expires_at in entries:
+            self._remember(short_url, (full_url, error, expires_at))
+
+    def purge_expired(self):
+        """Deletes the expired entries from the database."""
+
+        connection = self._connect()
+        connection.execute('DELETE FROM resolutions WHERE expires_at <= ?',
+                           [time()])
+
+    def stats(self):
+        """Hit and miss counters of the current process."""
+
+        return dict(self._stats)
@@ -0,0 +1,20 @@
+"""Run from the `python` folder: python -m pytest tests"""
+
+from os.path import abspath, dirname, join
+from sys import path
+
+from pytest import fixture
+
+_TESTS = dirname(abspath(__file__))
+
+path.insert(0, join(_TESTS, '..', 'benchmarks'))
+path.insert(0, join(_TESTS, '..', 'scripts'))
+
+
+@fixture(autouse=True, scope='session')
+def _metrics_folder(tmp_path_factory):
+    """Keeps the metrics snapshots of the tests out of `cache/`."""
+
+    import metrics
+
+    metrics.configure(str(tmp_path_factory.mktemp('metrics')))
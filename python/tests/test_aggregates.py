@@ -0,0 +1,57 @@
+from pytest import fixture
+
+from aggregates import AggregateStore, contribution
+
+
+def _news(news_id, domain, *names, score=None):
+    return {'id': news_id, 'domain': domain, 'language': 'en',
+            'text_analysed': True, 'sentiment_score': score,
+            'entities': [{'name': name, 'type': 'PERSON'} for name in names]}
+
+
+@fixture
+def store(tmp_path):
+    return AggregateStore(str(tmp_path / 'aggregates.sqlite'))
+
+
+def test_each_value_counts_once_per_news():
+    assert contribution(_news('1', 'a.com', 'X', 'X', score=0.25)) == [
+        ['domain', 'a.com'], ['entity:PERSON', 'X'], ['language', 'en'],
+        ['sentiment_score', '0.2']]
+
+
+def test_reanalysed_news_replaces_its_counts(store):
+    store.add(_news('1', 'a.com', 'X', 'Y'))
+    store.add(_news('2', 'a.com', 'X'))
+    store.add(_news('1', 'b.com', 'X'))
+    assert store.counts('domain') == [('a.com', 1), ('b.com', 1)]
+    assert store.counts('entity:PERSON') == [('X', 2)]
+    assert store.counts('language') == [('en', 2)]
+
+
+def test_same_analysis_is_not_counted_twice(store):
+    store.add(_news('1', 'a.com', 'X'))
+    store.add(_news('1', 'a.com', 'X'))
+    assert store.top('entity:PERSON') == [('X', 1)]
+
+
+def test_news_without_entities_removes_its_entity_counts(store):
+    store.add(_news('1', 'a.com', 'X'))
+    store.add(_news('1', 'a.com'))
+    assert store.counts('entity:PERSON') == []
+    assert 'entity:PERSON' not in store.dimensions()
+
+
+def test_rebuild_matches_the_incremental_counts(store):
+    news_list = [_news('1', 'a.com', 'X'), _news('2', 'b.com', 'X', 'Y'),
+                 dict(_news('3', 'c.com', 'Z'), text_analysed=False)]
+    for news in news_list[:2]:
+        store.add(news)
+    incremental = {dimension: store.counts(dimension)
+                   for dimension in store.dimensions()}
+    store.add(_news('4', 'd.com', 'W'))
+    assert store.rebuild(news_list) == 2
+    assert {dimension: store.counts(dimension)
+            for dimension in store.dimensions()} == incremental
+    store.add(_news('2', 'b.com', 'X'))
+    assert store.top('entity:PERSON') == [('X', 2)]
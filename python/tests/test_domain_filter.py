@@ -0,0 +1,53 @@
+from os import utime
+
+from domain_filter import DomainFilter, get_domain
+
+
+def test_host_matches_the_domain_and_its_subdomains():
+    domain_filter = DomainFilter(['un.org', 'Example.COM.', 'a.b.c'])
+    assert domain_filter.match('un.org') == 'un.org'
+    assert domain_filter.match('www.UN.org') == 'un.org'
+    assert domain_filter.match('fun.org') is None
+    assert domain_filter.match('org') is None
+    assert domain_filter.match('news.example.com') == 'Example.COM.'
+    assert domain_filter.match('b.c') is None
+    assert domain_filter.match('x.a.b.c') == 'a.b.c'
+
+
+def test_shortest_domain_matches_first():
+    domain_filter = DomainFilter(['news.example.com', 'example.com'])
+    assert domain_filter.match('www.news.example.com') == 'example.com'
+
+
+def test_classify_urls():
+    domain_filter = DomainFilter(['un.org'])
+    assert domain_filter.classify([
+        'https://www.un.org/page', 'http://user@Example.com:8080/',
+        'not a url', 'https://un.org./']) == [
+        ('www.un.org', True), ('example.com', False), (None, True),
+        ('un.org', True)]
+    assert get_domain(' http://UN.org.:80/x ') == 'un.org'
+
+
+def test_file_is_reloaded_when_changed(tmp_path):
+    path = tmp_path / 'filter_domains.txt'
+    path.write_text('# Comment\nun.org  # inline\n\n', encoding='utf8')
+    utime(path, (1000, 1000))
+    domain_filter = DomainFilter(path=str(path), reload_interval=0)
+    assert domain_filter.is_filtered('www.un.org')
+    assert not domain_filter.is_filtered('example.com')
+    path.write_text('example.com\n', encoding='utf8')
+    utime(path, (2000, 2000))
+    assert domain_filter.is_filtered('example.com')
+    assert not domain_filter.is_filtered('www.un.org')
+
+
+def test_file_is_not_checked_before_the_interval(tmp_path):
+    path = tmp_path / 'filter_domains.txt'
+    path.write_text('un.org\n', encoding='utf8')
+    utime(path, (1000, 1000))
+    domain_filter = DomainFilter(path=str(path), reload_interval=3600)
+    path.write_text('example.com\n', encoding='utf8')
+    utime(path, (2000, 2000))
+    assert domain_filter.is_filtered('un.org')
+    assert not domain_filter.is_filtered('example.com')
@@ -0,0 +1,32 @@
+from importlib.util import module_from_spec, spec_from_file_location
+from os import listdir
+from os.path import abspath, dirname, join
+
+from pyarrow import dataset
+
+_SCRIPT = join(dirname(abspath(__file__)), '..', 'scripts',
+               '03_export_columnar.py')
+_spec = spec_from_file_location('export_columnar', _SCRIPT)
+export_columnar = module_from_spec(_spec)
+_spec.loader.exec_module(export_columnar)
+
+
+def _news(news_id, newsletter_date):
+    return {'id': news_id, 'domain': 'a.com', 'language': 'en',
+            'newsletter_date': newsletter_date,
+            'entities': [{'name': 'X', 'type': 'PERSON', 'salience': 0.5}]}
+
+
+def test_export_replaces_the_previous_files(tmp_path):
+    output = str(tmp_path)
+    assert export_columnar.export(
+        [_news(str(number), '2017-01-%02d' % (number + 1))
+         for number in range(3)] + [_news('3', '2017-02-01')],
+        output, batch_size=1) == (4, 4)
+    assert export_columnar.export([_news('4', '2017-01-01')], output,
+                                  batch_size=1) == (1, 1)
+    assert sorted(listdir(output)) == ['entities', 'news']
+    assert listdir(join(output, 'news')) == ['newsletter_month=2017-01']
+    table = dataset.dataset(join(output, 'news'), format='parquet',
+                            partitioning='hive').to_table()
+    assert table.column('id').to_pylist() == ['4']
@@ -0,0 +1,188 @@
+from os.path import abspath, dirname
+from sys import modules
+
+from pytest import fixture, importorskip, raises
+
+from dao import Entity
+from dao_elastic import DaoElastic
+from fake_elastic import FakeElastic
+from http_pool import post, put
+from leases import ClaimLost, LeaseKeeper
+
+_NEWS = 8
+
+
+def _news(number):
+    return {'id': '%024x' % number,
+            'short_url': 'http://bit.ly/%d' % number,
+            'full_url': 'http://example.org/%d' % number,
+            'domain': 'example.org', 'newsletter_date': '2017-01-05'}
+
+
+@fixture
+def elastic(monkeypatch):
+    # The mapping file is read relatively to the `python` folder.
+    monkeypatch.chdir(dirname(dirname(abspath(__file__))))
+    server = FakeElastic()
+    dao = DaoElastic(server.start())
+    dao.init_schema()
+    yield dao
+    server.stop()
+
+
+@fixture
+def mongo(monkeypatch):
+    mongomock = importorskip('mongomock')
+    import dao_mongo
+
+    monkeypatch.setattr(dao_mongo, 'MongoClient', mongomock.MongoClient)
+    dao = dao_mongo.DaoMongo()
+    dao.init_schema()
+    return dao
+
+
+@fixture(params=['elastic', 'mongo'])
+def dao(request):
+    dao = request.getfixturevalue(request.param)
+    dao.import_many([_news(number) for number in range(_NEWS)])
+    return dao
+
+
+def _expire(dao, news_list, worker_id):
+    """Ends the leases of the news now."""
+
+    dao.renew_claims(news_list, worker_id, lease_seconds=-1)
+
+
+def _ids(news_list):
+    return sorted(news['id'] for news in news_list)
+
+
+def test_workers_claim_distinct_news(dao):
+    first = dao.claim_for_text_analysis('a', count=5, lease_seconds=60)
+    second = dao.claim_for_text_analysis('b', count=5, lease_seconds=60)
+    assert len(first) == 5 and len(second) == _NEWS - 5
+    assert not set(_ids(first)) & set(_ids(second))
+
+
+def test_same_candidates_are_claimed_once(dao, monkeypatch):
+    # The first worker claims every news between the query of the second
+    # one and its conditional updates.
+    module = modules[type(dao).__module__]
+    first = []
+
+    def claim_first(candidates):
+        monkeypatch.setattr(module, 'shuffle', lambda items: None)
+        first.extend(dao.claim_for_text_analysis('a', count=_NEWS,
+                                                 lease_seconds=60))
+
+    monkeypatch.setattr(module, 'shuffle', claim_first)
+    second = dao.claim_for_text_analysis('b', count=_NEWS, lease_seconds=60)
+    assert len(first) == _NEWS
+    assert second == []
+
+
+def test_expired_lease_is_claimed_again(dao):
+    first = dao.claim_for_text_analysis('a', count=3, lease_seconds=60)
+    _expire(dao, first, 'a')
+    second = dao.claim_for_text_analysis('b', count=_NEWS, lease_seconds=60)
+    assert set(_ids(first)) <= set(_ids(second))
+    assert len(second) == _NEWS
+
+
+def test_renew_after_losing_the_claim(dao):
+    keeper = LeaseKeeper(dao, 'a', lease_seconds=60, claim_batch=2)
+    news = next(keeper.claimed())
+    held = list(keeper._claims.values())
+    _expire(dao, held, 'a')
+    assert len(dao.claim_for_text_analysis(
+        'b', count=_NEWS, lease_seconds=60)) == _NEWS
+    keeper._renew()
+    assert keeper.stats['lost'] == 2
+    with raises(ClaimLost):
+        keeper.check(news)
+    with raises(ClaimLost):
+        keeper.done(news)
+
+
+def test_save_after_losing_the_claim(dao):
+    keeper = LeaseKeeper(dao, 'a', lease_seconds=60, claim_batch=1)
+    news = next(keeper.claimed())
+    _expire(dao, [news], 'a')
+    assert news['id'] in _ids(dao.claim_for_text_analysis(
+        'b', count=_NEWS, lease_seconds=60))
+    keeper.done(news)
+    saved = []
+    result = dao.save_text_analyses([{
+        'news': news, 'text_original': 'Texte', 'authors': '',
+        'text_en': 'Text', 'translator': 'none', 'language': 'fr',
+        'sentiment_score': 0.1, 'sentiment_magnitude': 0.2,
+        'entities': [Entity('X', 'PERSON', 0.5, None)], 'extractor': 'x',
+        'on_saved': saved.append}])
+    assert result['conflicts'] == 1 and result['sent'] == 0
+    assert saved == []
+    assert not list(dao.find_text_analysed())
+
+
+def test_saved_news_are_not_claimed_again(dao):
+    keeper = LeaseKeeper(dao, 'a', lease_seconds=60, claim_batch=3)
+    saved = []
+    for news in keeper.claimed():
+        keeper.done(news)
+        dao.save_text_analysis(
+            news=news, text_original='Texte', authors='', text_en='Text',
+            translator='none', language='fr', sentiment_score=0.1,
+            sentiment_magnitude=0.2,
+            entities=[Entity('X', 'PERSON', 0.5, None)], extractor='x',
+            on_saved=saved.append)
+    assert keeper.stats['claimed'] == _NEWS
+    assert len(saved) == _NEWS
+
+
+def test_released_news_wait_for_their_retry(dao):
+    keeper = LeaseKeeper(dao, 'a', lease_seconds=60, claim_batch=_NEWS)
+    claimed = list(keeper.claimed())
+    keeper.release(claimed[0])
+    keeper.release(claimed[1], retry_after=0)
+    assert _ids(dao.claim_for_text_analysis(
+        'b', count=_NEWS, lease_seconds=60)) == [claimed[1]['id']]
+
+
+def test_failed_news_are_excluded_from_the_run(dao):
+    keeper = LeaseKeeper(dao, 'a', lease_seconds=60, claim_batch=2)
+    handled = []
+    for news in keeper.claimed(include_errors=True):
+        handled.append(news['id'])
+        keeper.done(news, failed=True)
+        dao.save_error(news=news, error_message='Failed.',
+                       error_class='ValueError')
+    assert sorted(handled) == _ids([_news(number)
+                                    for number in range(_NEWS)])
+
+
+def test_slices_split_the_news(dao):
+    claimed = [dao.claim_for_text_analysis(
+        'w%d' % slice_id, count=_NEWS, lease_seconds=60,
+        slice_id=slice_id, slices=3) for slice_id in range(3)]
+    assert sorted(sum([_ids(news_list) for news_list in claimed], [])) == \
+        _ids([_news(number) for number in range(_NEWS)])
+
+
+def test_slice_is_only_accepted_in_a_scroll(elastic):
+    url = '%s/_search' % elastic._base_url
+    body = {'slice': {'id': 0, 'max': 2}, 'query': {'match_all': {}}}
+    assert post(url, json=body).status_code == 400
+    assert post(url + '?scroll=1m', json=body).status_code == 200
+
+
+def test_slice_hash_is_added_to_the_former_documents(elastic):
+    put('%s/%s' % (elastic._base_url, _news(0)['id']), json=_news(0))
+
+    def claimed():
+        return sum([elastic.claim_for_text_analysis(
+            'a', count=1, lease_seconds=60, slice_id=slice_id, slices=2)
+            for slice_id in range(2)], [])
+
+    assert claimed() == []
+    elastic.init_schema()
+    assert _ids(claimed()) == [_news(0)['id']]
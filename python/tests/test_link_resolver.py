@@ -0,0 +1,126 @@
+from asyncio import run
+
+from aiohttp import web
+
+from link_resolver import LinkResolver
+
+
+class _Cache(object):
+    """ResolutionCache stand-in keeping what was stored."""
+
+    def __init__(self, cached=None):
+        self.cached = dict(cached or {})
+        self.stored = {}
+
+    def get_many(self, short_urls):
+        return {short_url: self.cached[short_url] for short_url in short_urls
+                if short_url in self.cached}
+
+    def put_many(self, resolved, errors):
+        self.stored.update({url: (full_url, None)
+                            for url, full_url in resolved.items()})
+        self.stored.update({url: (None, error)
+                            for url, error in errors.items()})
+
+
+def _answer(status, location=None):
+    async def handler(request):
+        headers = {'Location': location} if location else {}
+        return web.Response(status=status, headers=headers)
+
+    return handler
+
+
+async def _no_head(request):
+    if request.method == 'HEAD':
+        return web.Response(status=405)
+    return web.Response(status=302, headers={'Location': '/article'})
+
+
+def _app():
+    app = web.Application()
+    app.router.add_route('*', '/moved',
+                         _answer(301, 'http://example.org/article'))
+    app.router.add_route('*', '/no-head', _no_head)
+    app.router.add_route('*', '/chain', _answer(301, '/moved'))
+    app.router.add_route('*', '/missing', _answer(404))
+    app.router.add_route('*', '/busy', _answer(503))
+    return app
+
+
+def _resolve(paths, cache=None):
+    """Resolves the paths on a local redirect server.
+
+    Returns:
+        (tuple): The resolved urls and errors by path, and the retryable
+            paths
+    """
+
+    async def resolve():
+        runner = web.AppRunner(_app())
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        base = 'http://127.0.0.1:%d' % port
+        try:
+            async with LinkResolver(cache=cache,
+                                    requests_per_second=1000) as resolver:
+                resolved, errors = await resolver.resolve(
+                    [base + path for path in paths])
+        finally:
+            await runner.cleanup()
+
+        def by_path(urls):
+            return {url[len(base):]: value.replace(base, '')
+                    if isinstance(value, str) else value
+                    for url, value in urls.items()}
+
+        return by_path(resolved), by_path(errors), \
+            {url[len(base):] for url in resolver.retryable}
+
+    return run(resolve())
+
+
+def test_location_of_the_redirect():
+    resolved, errors, _ = _resolve(['/moved'])
+    assert resolved == {'/moved': 'http://example.org/article'}
+    assert errors == {}
+
+
+def test_get_when_head_not_allowed():
+    resolved, _, _ = _resolve(['/no-head'])
+    assert resolved == {'/no-head': '/article'}
+
+
+def test_only_the_first_redirect_is_followed():
+    resolved, _, _ = _resolve(['/chain'])
+    assert resolved == {'/chain': '/moved'}
+
+
+def test_not_found_is_cached():
+    cache = _Cache()
+    _, errors, retryable = _resolve(['/missing'], cache)
+    assert list(errors) == ['/missing']
+    assert retryable == set()
+    assert len(cache.stored) == 1
+
+
+def test_server_errors_are_retryable():
+    cache = _Cache()
+    resolved, errors, retryable = _resolve(['/busy', '/moved'], cache)
+    assert list(errors) == ['/busy']
+    assert retryable == {'/busy'}
+    assert [full_url for full_url, _ in cache.stored.values()] == \
+        ['http://example.org/article']
+
+
+def test_cached_urls_are_not_requested():
+    cache = _Cache({'http://bit.ly/cached': ('http://example.org/a', None)})
+
+    async def resolve():
+        async with LinkResolver(cache=cache) as resolver:
+            return await resolver.resolve(['http://bit.ly/cached'])
+
+    assert run(resolve()) == ({'http://bit.ly/cached':
+                               'http://example.org/a'}, {})
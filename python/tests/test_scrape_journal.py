@@ -0,0 +1,140 @@
+from datetime import datetime, timedelta
+from importlib.util import module_from_spec, spec_from_file_location
+from os.path import abspath, dirname, join
+
+from pytest import fixture, raises
+
+from scrape_journal import MERGED, MISSING, PARSED, ScrapeJournal
+
+_SCRIPT = join(dirname(abspath(__file__)), '..', 'scripts',
+               '01_scrape_links.py')
+_URL = 'https://eeas.europa.eu/sites/eeas/files/review_01.03.2017_eng.pdf'
+_LINKS = ['http://bit.ly/a', 'http://bit.ly/b']
+
+
+class _Response(object):
+    def __init__(self, status_code, content=b''):
+        self.status_code = status_code
+        self._content = content
+
+    def __iter__(self):
+        return iter([self._content])
+
+
+@fixture
+def journal(tmp_path):
+    return ScrapeJournal(str(tmp_path / 'journal.sqlite'))
+
+
+@fixture
+def scrape(tmp_path, monkeypatch, journal):
+    """The scraping script run from `tmp/python`, with stubbed services.
+
+    `calls` counts the downloads, link extractions and merges, `answers`
+    holds the status of the next downloads and `retry` the failed links
+    returned by the next merges.
+    """
+
+    (tmp_path / 'python').mkdir()
+    (tmp_path / 'resources').mkdir()
+    monkeypatch.chdir(tmp_path / 'python')
+    spec = spec_from_file_location('scrape_links', _SCRIPT)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module._journal = journal
+    module.calls = {'download': 0, 'extract': 0, 'merge': 0}
+    module.answers = []
+    module.retry = []
+
+    def get(url, **kwargs):
+        module.calls['download'] += 1
+        return _Response(module.answers.pop(0), b'%PDF newsletter')
+
+    def extract_links(file_name, prefix):
+        module.calls['extract'] += 1
+        return list(_LINKS)
+
+    def merge_values(links, date):
+        module.calls['merge'] += 1
+        return module.retry.pop(0) if module.retry else 0
+
+    monkeypatch.setattr(module, 'get', get)
+    monkeypatch.setattr(module, 'extract_links', extract_links)
+    monkeypatch.setattr(module, '_merge_values', merge_values)
+    return module
+
+
+def test_url_status_is_replaced(journal):
+    assert journal.get_url(_URL) is None
+    journal.set_url(_URL, PARSED, newsletter_date=datetime(2017, 3, 1),
+                    file_name='a.pdf', digest='abc')
+    journal.set_url(_URL, MERGED, newsletter_date=datetime(2017, 3, 1),
+                    file_name='a.pdf', digest='abc')
+    entry = journal.get_url(_URL)
+    assert (entry['status'], entry['file_name'], entry['sha256']) == \
+        (MERGED, 'a.pdf', 'abc')
+
+
+def test_links_are_kept_for_the_file_content(journal, tmp_path):
+    file_name = str(tmp_path / 'a.pdf')
+    with open(file_name, 'wb') as file:
+        file.write(b'first')
+    digest = journal.file_digest(file_name)
+    journal.set_links(file_name, digest, _LINKS)
+    assert journal.file_digest(file_name) == digest
+    assert journal.get_links(file_name, digest) == _LINKS
+    with open(file_name, 'wb') as file:
+        file.write(b'second version')
+    new_digest = journal.file_digest(file_name)
+    assert new_digest != digest
+    assert journal.get_links(file_name, new_digest) is None
+
+
+def test_merged_newsletter_is_skipped(scrape, journal):
+    scrape.answers = [200]
+    scrape._process_url(_URL, datetime(2017, 3, 1))
+    assert journal.get_url(_URL)['status'] == MERGED
+    scrape._process_url(_URL, datetime(2017, 3, 1))
+    assert scrape.calls == {'download': 1, 'extract': 1, 'merge': 1}
+
+
+def test_changed_file_is_merged_again(scrape, journal, tmp_path):
+    scrape.answers = [200]
+    scrape._process_url(_URL, datetime(2017, 3, 1))
+    with open(journal.get_url(_URL)['file_name'], 'ab') as file:
+        file.write(b' corrected')
+    scrape._process_url(_URL, datetime(2017, 3, 1))
+    assert scrape.calls == {'download': 1, 'extract': 2, 'merge': 2}
+
+
+def test_failed_links_are_merged_again(scrape, journal):
+    scrape.answers = [200]
+    scrape.retry = [1]
+    scrape._process_url(_URL, datetime(2017, 3, 1))
+    assert journal.get_url(_URL)['status'] == PARSED
+    scrape._process_url(_URL, datetime(2017, 3, 1))
+    assert journal.get_url(_URL)['status'] == MERGED
+    # The links of the file are read from the journal.
+    assert scrape.calls == {'download': 1, 'extract': 1, 'merge': 2}
+
+
+def test_missing_newsletter_is_retried_for_a_week(scrape, journal):
+    recent = datetime.utcnow() - timedelta(days=2)
+    scrape.answers = [404, 404]
+    scrape._process_url(_URL, recent)
+    assert journal.get_url(_URL)['status'] == MISSING
+    scrape._process_url(_URL, recent)
+    assert scrape.calls['download'] == 2
+    old = datetime.utcnow() - timedelta(days=8)
+    scrape._process_url(_URL, old)
+    assert scrape.calls['download'] == 2
+
+
+def test_other_errors_are_not_recorded_missing(scrape, journal):
+    scrape.answers = [503]
+    with raises(ValueError):
+        scrape._process_url(_URL, datetime(2017, 3, 1))
+    assert journal.get_url(_URL) is None
+    scrape.answers = [200]
+    scrape._process_url(_URL, datetime(2017, 3, 1))
+    assert journal.get_url(_URL)['status'] == MERGED
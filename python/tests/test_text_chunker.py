@@ -0,0 +1,17 @@
+from text_chunker import chunk_text
+
+_TEXT = ('First sentence.  Second one!\tThird: a very long sentence without '
+         'any break at all\n\nNew paragraph; with   spaces. \n'
+         'Lastwordlongerthanthechunksizeitself.')
+
+
+def test_chunks_join_back_to_the_text():
+    for max_size in range(1, 60):
+        chunks = chunk_text(_TEXT, max_size)
+        assert ''.join(chunk + separator
+                       for chunk, separator in chunks) == _TEXT
+        assert all(len(chunk) <= max_size for chunk, _ in chunks)
+
+
+def test_short_text_is_one_chunk():
+    assert chunk_text(_TEXT, len(_TEXT)) == [(_TEXT, '')]